@@ -0,0 +1,99 @@
+"""
+Compare the old shared-directory build context with the per-build in-memory one.
+
+The old build passed dockerfiles/ as the context, so the daemon received a tar
+of every stored Dockerfile. This creates N Dockerfiles in a scratch directory
+and, for each N, times tarring the whole directory (what `docker build` and
+docker-py send for a path context) against build_context() for one Dockerfile.
+Run from the backend folder:
+
+    python bench_build_context.py --counts 20 200 2000
+
+With --daemon the script also runs real builds both ways against the local
+Docker daemon and reports wall time, so upload cost is included.
+"""
+import argparse
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from utils.docker_tools import CONTEXT_DOCKERFILE, build_context
+
+SAMPLE_DOCKERFILE = """FROM {base}
+RUN echo "build {index}"
+LABEL bench.index="{index}"
+"""
+
+
+def tar_directory(path: str) -> io.BytesIO:
+    """Tar a directory the way a path build context is sent to the daemon."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name in sorted(os.listdir(path)):
+            tar.add(os.path.join(path, name), arcname=name)
+    buffer.seek(0)
+    return buffer
+
+
+def timed(fn, repeat: int):
+    """(best seconds, result) over `repeat` runs."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def daemon_build(client, tag: str, **kwargs) -> float:
+    start = time.perf_counter()
+    for entry in client.api.build(tag=tag, rm=True, decode=True, **kwargs):
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Docker build context size and assembly time")
+    parser.add_argument("--counts", nargs="+", type=int, default=[20, 200, 2000], help="Numbers of stored Dockerfiles")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (best is reported)")
+    parser.add_argument("--base", default="busybox:latest", help="Base image for --daemon builds")
+    parser.add_argument("--daemon", action="store_true", help="Also run real builds against the Docker daemon")
+    args = parser.parse_args()
+
+    client = None
+    if args.daemon:
+        import docker
+        client = docker.from_env()
+
+    print(f"{'stored':>7} {'dir tar KiB':>12} {'dir tar ms':>11} {'mem tar KiB':>12} {'mem tar ms':>11}"
+          + (f" {'dir build s':>12} {'mem build s':>12}" if client else ""))
+    for count in args.counts:
+        scratch = tempfile.mkdtemp(prefix="build-context-bench-")
+        try:
+            for index in range(count):
+                with open(os.path.join(scratch, f"bench-{index}.Dockerfile"), "w", encoding="utf-8") as f:
+                    f.write(SAMPLE_DOCKERFILE.format(base=args.base, index=index))
+            with open(os.path.join(scratch, "bench-0.Dockerfile"), encoding="utf-8") as f:
+                content = f.read()
+
+            dir_seconds, dir_tar = timed(lambda: tar_directory(scratch), args.repeat)
+            mem_seconds, mem_tar = timed(lambda: build_context(content), args.repeat)
+            line = (f"{count:>7} {len(dir_tar.getbuffer()) / 1024:>12.1f} {dir_seconds * 1000:>11.2f} "
+                    f"{len(mem_tar.getbuffer()) / 1024:>12.1f} {mem_seconds * 1000:>11.2f}")
+            if client:
+                dir_build = daemon_build(client, "context-bench:dir", path=scratch, dockerfile="bench-0.Dockerfile")
+                mem_build = daemon_build(client, "context-bench:mem", fileobj=build_context(content),
+                                         custom_context=True, dockerfile=CONTEXT_DOCKERFILE)
+                line += f" {dir_build:>12.2f} {mem_build:>12.2f}"
+            print(line)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Measure create-to-running latency of containers, from scratch vs. from the warm pool.
+
+"cold" is what /docker/container/create does without a pool: create the
+container, then start it. "warm" claims a pre-created container the way the
+pool does: rename, set the restart policy, start. Both publish every port
+the image exposes, as the pool does for "auto" bindings (here on ports the
+daemon picks). Pre-creating is not timed, since the pool does it in the
+background. Run from the backend folder with
+the image already pulled:
+
+    python bench_container_start.py --image nginx:latest --runs 20
+
+Every container the benchmark creates is removed at the end.
+"""
+import argparse
+import time
+import uuid
+
+import docker
+
+from utils.container_pool import create_warm, image_ports, percentile
+
+
+def cold_start(client, image: str, name: str, port_bindings: dict) -> str:
+    host_config = client.api.create_host_config(port_bindings=port_bindings, restart_policy={"Name": "always"})
+    container = client.api.create_container(image=image, name=name, host_config=host_config, detach=True, tty=True, stdin_open=True)
+    client.api.start(container["Id"])
+    return container["Id"]
+
+
+def warm_start(client, container_id: str, name: str) -> str:
+    client.api.rename(container_id, name)
+    client.api.update_container(container_id, restart_policy={"Name": "always"})
+    client.api.start(container_id)
+    return container_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark container start latency with and without the warm pool")
+    parser.add_argument("--image", default="nginx:latest")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    client = docker.from_env()
+    created = []
+    results = {"cold": [], "warm": []}
+    try:
+        port_bindings = {port: None for port in image_ports(args.image)}
+        warm_ids = [create_warm(args.image, port_bindings) for _ in range(args.runs)]
+        created.extend(warm_ids)
+        for i in range(args.runs):
+            start = time.perf_counter()
+            created.append(cold_start(client, args.image, f"bench-cold-{uuid.uuid4().hex[:8]}", port_bindings))
+            results["cold"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            warm_start(client, warm_ids[i], f"bench-warm-{uuid.uuid4().hex[:8]}")
+            results["warm"].append(time.perf_counter() - start)
+    finally:
+        for container_id in created:
+            try:
+                client.api.remove_container(container_id, force=True)
+            except docker.errors.APIError:
+                pass
+
+    print(f"{'path':<6} {'runs':>5} {'p50 s':>8} {'p95 s':>8}")
+    for path, values in results.items():
+        print(f"{path:<6} {len(values):>5} {percentile(values, 0.5):>8.3f} {percentile(values, 0.95):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Measure qemu-img convert throughput for the options /vm/disk/convert exposes.
+
+Builds a synthetic sparse image (a few scattered extents of data) and a
+dense one (random data throughout), converts each into every source format,
+then times every source -> target conversion under each option set:
+coroutine counts (-m), out-of-order writes (-W), compression (-c, qcow2
+targets) and preallocation modes. Run from the backend folder:
+
+    python bench_disk_convert.py --size 2G --dir ../store --csv convert.csv
+
+Throughput is virtual size / wall time, so sparse images show how well a
+path skips unallocated data. Use the results to set
+QEMU_IMG_CONVERT_COROUTINES and QEMU_IMG_CONVERT_OUT_OF_ORDER.
+"""
+import argparse
+import csv
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from utils.qemu_tools import CONVERT_FORMATS, PREALLOCATION_MODES, convert_args, find_qemu_binary, parse_size
+
+EXTENSIONS = {"qcow2": "qcow2", "raw": "raw", "vmdk": "vmdk", "vhdx": "vhdx", "vdi": "vdi"}
+
+
+def make_raw(path: str, size: int, dense: bool) -> None:
+    """Write a raw image: random data throughout, or 1 MiB of data every 64 MiB."""
+    chunk = 1024 * 1024
+    with open(path, "wb") as f:
+        f.truncate(size)
+        step = chunk if dense else 64 * chunk
+        for offset in range(0, size, step):
+            f.seek(offset)
+            f.write(os.urandom(min(chunk, size - offset)))
+
+
+def option_sets(target_format: str, coroutines):
+    """(label, kwargs for convert_args) pairs to time for one target format."""
+    sets = [(f"-m {m}", {"coroutines": m, "out_of_order": False}) for m in coroutines]
+    top = max(coroutines)
+    sets.append((f"-m {top} -W", {"coroutines": top, "out_of_order": True}))
+    if target_format == "qcow2":
+        sets.append((f"-m {top} -c", {"coroutines": top, "out_of_order": False, "compress": True}))
+    for mode in PREALLOCATION_MODES.get(target_format, ()):
+        if mode != "off":
+            sets.append((f"-m {top} prealloc={mode}", {"coroutines": top, "out_of_order": False, "preallocation": mode}))
+    return sets
+
+
+def timed_convert(qemu_img: str, args) -> float:
+    start = time.perf_counter()
+    result = subprocess.run([qemu_img, *args], capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark qemu-img convert options across disk formats")
+    parser.add_argument("--size", default="1G", help="Virtual size of the synthetic images")
+    parser.add_argument("--dir", help="Scratch directory (default: system temp dir); use the store's disk for real numbers")
+    parser.add_argument("--formats", nargs="+", default=list(CONVERT_FORMATS), choices=list(CONVERT_FORMATS))
+    parser.add_argument("--coroutines", nargs="+", type=int, default=[1, 4, 8, 16])
+    parser.add_argument("--images", nargs="+", default=["sparse", "dense"], choices=["sparse", "dense"])
+    parser.add_argument("--csv", help="Also write the results to this CSV file")
+    args = parser.parse_args()
+
+    qemu_img = find_qemu_binary("qemu-img")
+    size = parse_size(args.size)
+    scratch = tempfile.mkdtemp(prefix="convert-bench-", dir=args.dir)
+    rows = []
+    try:
+        print(f"{'image':<7} {'source':<6} {'target':<6} {'options':<22} {'seconds':>8} {'MiB/s':>8}")
+        for kind in args.images:
+            raw = os.path.join(scratch, f"{kind}.raw")
+            make_raw(raw, size, kind == "dense")
+            sources = {}
+            for fmt in args.formats:
+                if fmt == "raw":
+                    # The image itself is the raw source; a plain copy would fill in its holes
+                    sources[fmt] = raw
+                    continue
+                source = os.path.join(scratch, f"{kind}-source.{EXTENSIONS[fmt]}")
+                subprocess.run([qemu_img, *convert_args(raw, "raw", source, fmt)], check=True, capture_output=True)
+                sources[fmt] = source
+
+            for source_format, source in sources.items():
+                for target_format in args.formats:
+                    for label, options in option_sets(target_format, args.coroutines):
+                        target = os.path.join(scratch, f"target.{EXTENSIONS[target_format]}")
+                        try:
+                            seconds = timed_convert(qemu_img, convert_args(source, source_format, target, target_format, **options))
+                        except Exception as e:
+                            print(f"{kind:<7} {source_format:<6} {target_format:<6} {label:<22} failed: {getattr(e, 'detail', e)}")
+                            continue
+                        finally:
+                            if os.path.exists(target):
+                                os.remove(target)
+                        throughput = size / 1024 ** 2 / seconds
+                        rows.append({"image": kind, "source": source_format, "target": target_format,
+                                     "options": label, "seconds": round(seconds, 3), "mib_per_s": round(throughput, 1)})
+                        print(f"{kind:<7} {source_format:<6} {target_format:<6} {label:<22} {seconds:>8.3f} {throughput:>8.1f}")
+            for path in [raw, *sources.values()]:
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.csv and rows:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"\nWrote {len(rows)} results to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Compare the host-side drive settings (cache mode and AIO backend) of the QEMU presets.
+
+Prints the command each preset produces on this host, then runs
+`qemu-img bench` against a scratch image with the same cache mode and AIO
+backend the preset would give the guest's disk. Run from the backend folder:
+
+    python bench_drive_io.py --size 1G --count 20000 --depth 16
+
+This measures QEMU's block layer on the host only. It does not boot a guest,
+so it can't show what the presets change inside one: virtio-blk versus IDE,
+iothreads and hugepages. Presets that share a cache/AIO pair report the same
+numbers.
+
+Use --image to benchmark an existing image (it is opened read-only unless
+--write is given), and --dir to place the scratch image on the store's disk.
+"""
+import argparse
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+from utils.qemu_tools import QEMU_PRESETS, QemuCommandBuilder, disk_format_for, find_qemu_binary
+
+
+def drive_settings(builder: QemuCommandBuilder, image: str):
+    """(cache, aio) the preset would put on this image's -drive."""
+    options = dict(part.split("=", 1) for part in builder.drive_options(image).split(","))
+    return options["cache"], options["aio"]
+
+
+def run_bench(qemu_img: str, image: str, cache: str, aio: str, args, write: bool) -> float:
+    cmd = [
+        qemu_img, "bench",
+        "-f", disk_format_for(image),
+        "-t", cache,
+        "-i", aio,
+        "-c", str(args.count),
+        "-d", str(args.depth),
+        "-s", args.block_size,
+    ]
+    if write:
+        cmd.append("-w")
+    cmd.append(image)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or result.stdout.strip())
+    # qemu-img prints "Run completed in 1.234 seconds."
+    match = re.search(r"completed in ([\d.]+) seconds", result.stdout)
+    return float(match.group(1)) if match else elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the host-side cache/AIO drive settings of QEMU presets with qemu-img bench")
+    parser.add_argument("--image", help="Existing image to benchmark (default: a scratch qcow2)")
+    parser.add_argument("--dir", help="Directory for the scratch image (default: system temp dir)")
+    parser.add_argument("--size", default="1G", help="Scratch image size")
+    parser.add_argument("--count", type=int, default=20000, help="Requests per run")
+    parser.add_argument("--depth", type=int, default=16, help="Queue depth")
+    parser.add_argument("--block-size", default="4k", help="Request size")
+    parser.add_argument("--write", action="store_true", help="Also run a write pass")
+    parser.add_argument("--presets", nargs="+", default=list(QEMU_PRESETS), choices=list(QEMU_PRESETS))
+    args = parser.parse_args()
+
+    qemu_img = find_qemu_binary("qemu-img")
+    qemu = find_qemu_binary("qemu-system-x86_64")
+
+    scratch = None
+    image = args.image
+    if not image:
+        fd, scratch = tempfile.mkstemp(suffix=".qcow2", dir=args.dir)
+        os.close(fd)
+        # Preallocate so the read pass measures the I/O path, not unallocated clusters
+        subprocess.run([qemu_img, "create", "-f", "qcow2", "-o", "preallocation=falloc", scratch, args.size],
+                       check=True, capture_output=True)
+        image = scratch
+
+    try:
+        for preset in args.presets:
+            builder = QemuCommandBuilder(qemu, preset).memory(2048).cpus(2).disk(image)
+            print(f"[{preset}] {' '.join(builder.build())}")
+
+        print(f"\n{'preset':<12} {'cache':<10} {'aio':<9} {'pass':<6} {'seconds':>8} {'IOPS':>9}")
+        for preset in args.presets:
+            builder = QemuCommandBuilder(qemu, preset)
+            cache, aio = drive_settings(builder, image)
+            for write in ([False, True] if args.write or scratch else [False]):
+                try:
+                    seconds = run_bench(qemu_img, image, cache, aio, args, write)
+                except RuntimeError as e:
+                    print(f"{preset:<12} {cache:<10} {aio:<9} {'write' if write else 'read':<6} failed: {e}")
+                    continue
+                iops = args.count / seconds if seconds else 0
+                print(f"{preset:<12} {cache:<10} {aio:<9} {'write' if write else 'read':<6} {seconds:>8.3f} {iops:>9.0f}")
+    finally:
+        if scratch:
+            os.remove(scratch)
+
+
+if __name__ == "__main__":
+    main()
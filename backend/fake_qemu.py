@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+Stand-in for qemu-system-x86_64 when testing multi-node placement.
+
+Point QEMU_SYSTEM_X86_64_BINARY at this file; it prints the arguments it was
+given and idles until terminated, like a running guest.
+"""
+import signal
+import sys
+import time
+
+print("fake-qemu started:", " ".join(sys.argv[1:]), flush=True)
+signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+while True:
+    time.sleep(3600)
@@ -0,0 +1,148 @@
+"""
+VirtCloud host agent.
+
+Runs on every VM node and lets the API server spawn, stop and inspect QEMU
+processes there. Start one per node, e.g.
+
+    AGENT_TOKEN=<secret> AGENT_HOST_ID=node1 uvicorn host_agent:app --host 0.0.0.0 --port 9001
+
+and list the agents in the API server's VM_HOSTS setting. For local testing,
+point QEMU_SYSTEM_X86_64_BINARY at fake_qemu.py and run several agents on
+different ports.
+"""
+import asyncio
+import hmac
+import os
+import socket
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Header, WebSocket, Query
+from pydantic import BaseModel
+
+from utils.proc_stats import local_host_stats, pid_alive, sample_processes
+from utils.qemu_tools import get_store_dir, find_qemu_binary, spawn_vm_process, terminate_process
+from utils import vnc_console
+from utils.qmp import QMPError, qmp_execute
+
+load_dotenv()
+
+HOST_ID = os.getenv("AGENT_HOST_ID", socket.gethostname())
+STORE_DIR = os.getenv("AGENT_STORE_DIR", get_store_dir())
+AGENT_TOKEN = os.getenv("AGENT_TOKEN", "")
+# The agent spawns and kills processes on this node, so it never runs unauthenticated
+if not AGENT_TOKEN:
+    raise RuntimeError("AGENT_TOKEN is not set; give every agent and the API server the same secret")
+
+app = FastAPI(title="VirtCloud Host Agent", version="1.0.0")
+
+# Popen handles of the guests this agent started, so exited ones get reaped
+processes = {}
+
+class SpawnRequest(BaseModel):
+    vm_id: Optional[str] = None
+    disk_name: str
+    iso_path: Optional[str] = None
+    memory_mb: int
+    cpu_count: int
+    display: Optional[str] = None
+    qemu_preset: Optional[str] = None
+    include_iso: bool = False
+
+class StopRequest(BaseModel):
+    pid: int
+
+class StatsRequest(BaseModel):
+    pids: List[int] = []
+
+class QMPRequest(BaseModel):
+    vm_id: str
+    execute: str
+    arguments: Optional[dict] = None
+
+def token_valid(token: Optional[str]) -> bool:
+    return bool(AGENT_TOKEN) and hmac.compare_digest((token or "").encode(), AGENT_TOKEN.encode())
+
+def check_token(token: Optional[str]):
+    if not token_valid(token):
+        raise HTTPException(status_code=401, detail="Invalid agent token")
+
+def is_vm_process(pid: int) -> bool:
+    """Whether a PID is a guest of this node, including ones started before an agent restart"""
+    if pid in processes:
+        return True
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            argv = f.read().decode(errors="replace").split("\0")
+    except OSError:
+        return False
+    return find_qemu_binary("qemu-system-x86_64") in argv[:2]
+
+def reap_exited():
+    for pid, process in list(processes.items()):
+        if process.poll() is not None:
+            del processes[pid]
+
+@app.post("/spawn")
+def spawn(req: SpawnRequest, x_agent_token: Optional[str] = Header(None)):
+    """Launch a QEMU guest from a disk in this node's store"""
+    check_token(x_agent_token)
+    exe = find_qemu_binary("qemu-system-x86_64")
+    vm = {**req.dict(), "_id": req.vm_id}
+    process, placement = spawn_vm_process(exe, vm, req.include_iso, STORE_DIR)
+    processes[process.pid] = process
+    print(f"✅ [{HOST_ID}] VM launched with PID {process.pid}")
+    return {"host_id": HOST_ID, "pid": process.pid, **placement}
+
+@app.post("/stop")
+def stop(req: StopRequest, x_agent_token: Optional[str] = Header(None)):
+    """Terminate a guest started by this agent"""
+    check_token(x_agent_token)
+    reap_exited()
+    if not pid_alive(req.pid) or not is_vm_process(req.pid):
+        raise HTTPException(status_code=404, detail=f"No running VM process with PID {req.pid}")
+    terminate_process(req.pid)
+    return {"host_id": HOST_ID, "pid": req.pid, "status": "stopping"}
+
+@app.post("/stats")
+def stats(req: StatsRequest, x_agent_token: Optional[str] = Header(None)):
+    """Node capacity plus live RSS of the requested guest PIDs"""
+    check_token(x_agent_token)
+    reap_exited()
+    return {"host_id": HOST_ID, **local_host_stats(req.pids)}
+
+@app.post("/samples")
+def samples(req: StatsRequest, x_agent_token: Optional[str] = Header(None)):
+    """Cumulative CPU, memory and I/O counters of the requested guest PIDs"""
+    check_token(x_agent_token)
+    return {"host_id": HOST_ID, "samples": sample_processes(req.pids, cgroup=True)}
+
+@app.post("/qmp")
+async def qmp(req: QMPRequest, x_agent_token: Optional[str] = Header(None)):
+    """Run one QMP command against a guest on this node"""
+    check_token(x_agent_token)
+    try:
+        result = await qmp_execute(req.vm_id, req.execute, req.arguments)
+    except QMPError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=503, detail=f"QMP socket of VM {req.vm_id} unavailable: {str(e)}")
+    return {"host_id": HOST_ID, "return": result}
+
+@app.websocket("/console/{vm_id}")
+async def console(websocket: WebSocket, vm_id: str, token: Optional[str] = Query(None)):
+    """Relay a guest's VNC socket to the API server's console proxy"""
+    await websocket.accept()
+    if not token_valid(token):
+        await websocket.close(code=1008)
+        return
+    try:
+        upstream = await vnc_console.UnixConsole.connect(vm_id)
+    except OSError:
+        await websocket.close(code=vnc_console.CLOSE_UNAVAILABLE)
+        return
+    await vnc_console.relay(websocket, upstream)
+
+@app.get("/")
+def root():
+    return {"message": f"VirtCloud host agent {HOST_ID} is running 🚀"}
@@ -1,10 +1,12 @@
+import asyncio
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from routers import vm, auth, billing, vm_management, vm_disk, vm_stats
+from routers import vm, auth, billing, vm_management, vm_disk, vm_stats, vm_iso
 from database import db  # import Mongo client database
 from pymongo import ReadPreference
 from routers.auth import get_current_user
-from routers.docker import router as docker_router  # Import directly from the docker module
+from routers.docker import router as docker_router, build_queue_worker  # Import directly from the docker module
+from utils import vm_metrics, disk_inventory, iso_library, container_stats, container_pool, port_allocator
 
 app = FastAPI(
     title="VirtCloud API",
@@ -29,8 +31,49 @@ app.include_router(billing.router, prefix="/billing", tags=["Billing & Plans"])
 app.include_router(vm_management.router, prefix="/vm", tags=["VM Management"])
 app.include_router(vm_disk.router, prefix="/vm/disk", tags=["VM Disk"])
 app.include_router(vm_stats.router, prefix="/vm/stats", tags=["VM Stats"])
+app.include_router(vm_iso.router, prefix="/vm/iso", tags=["VM ISO Library"])
 app.include_router(docker_router, prefix="/docker", tags=["Docker"])
 
+@app.on_event("startup")
+async def start_vm_launch_queue():
+    # Periodically launch queued VMs once host capacity frees up
+    asyncio.create_task(vm_management.launch_queue_worker())
+
+@app.on_event("startup")
+async def start_vm_metrics_sampler():
+    # Sample CPU, memory and I/O of every running VM for the monitor page
+    asyncio.create_task(vm_metrics.sampler_worker())
+
+@app.on_event("startup")
+async def start_disk_inventory():
+    # Keep the disks collection in sync with store/ (inotify watcher + periodic reconcile)
+    asyncio.create_task(disk_inventory.inventory_worker())
+
+@app.on_event("startup")
+async def start_iso_gc():
+    # Delete library ISOs no user and no VM references anymore
+    asyncio.create_task(iso_library.gc_worker())
+
+@app.on_event("startup")
+async def start_build_queue():
+    # Start queued Docker builds as slots free up and recover slots of dead workers
+    asyncio.create_task(build_queue_worker())
+
+@app.on_event("startup")
+async def start_container_stats():
+    # Follow the stats stream of every running container for /docker/containers/stats
+    asyncio.create_task(container_stats.collector_worker())
+
+@app.on_event("startup")
+async def start_container_pool():
+    # Keep pre-created containers of the warm templates ready for /docker/container/create
+    asyncio.create_task(container_pool.pool_worker())
+
+@app.on_event("startup")
+async def start_port_allocator():
+    # Load reserved host ports and release those of containers that are gone
+    asyncio.create_task(port_allocator.reconcile_worker())
+
 @app.on_event("startup")
 async def check_mongo_connection():
     try:
@@ -17,6 +17,7 @@ class Plan(BaseModel):
     max_cpu: int
     max_ram: int  # in GB
     max_disk: int  # in GB
+    build_weight: int = 1  # share of Docker build slots when users compete for them
     features: List[str]
 
 class CreditTransaction(BaseModel):
@@ -42,6 +43,7 @@ plans = [
         "max_cpu": 2,
         "max_ram": 2,
         "max_disk": 20,
+        "build_weight": 1,
         "features": [
             "Max runtime per VM: 4 hours",
             "Up to 2 CPUs",
@@ -59,6 +61,7 @@ plans = [
         "max_cpu": 4,
         "max_ram": 8,
         "max_disk": 50,
+        "build_weight": 2,
         "features": [
             "Unlimited VM session length",
             "Up to 4 CPUs",
@@ -76,6 +79,7 @@ plans = [
         "max_cpu": 8,
         "max_ram": 16,
         "max_disk": 200,
+        "build_weight": 4,
         "features": [
             "All Pro features",
             "Up to 8 CPUs",
@@ -94,6 +98,7 @@ plans = [
         "max_cpu": 8,
         "max_ram": 16,
         "max_disk": 200,
+        "build_weight": 4,
         "features": [
             "No monthly credits",
             "Pay only for what you use",
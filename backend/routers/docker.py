@@ -5,13 +5,20 @@ import docker
 import os
 import requests
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
+import asyncio
 from database import db
 from .auth import get_current_user
 from bson.objectid import ObjectId
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from pymongo import UpdateOne, DeleteOne
 import uuid
+from utils.docker_tools import (
+    build_context, check_engine, classic_build, buildkit_build, user_cache_dir, content_key,
+    DOCKERFILE_MAX_VERSIONS, dockerfile_hash, dockerfile_cache_path, materialize_dockerfile
+)
+from utils import build_scheduler, dockerfile_lint, container_stats, container_logs, container_pool, port_allocator
 
 router = APIRouter()
 
@@ -37,6 +44,8 @@ class DockerImageBuildRequest(BaseModel):
     dockerfile_name: str = Field(..., description="Name of the Dockerfile to use")
     image_name: str = Field(..., description="Name for the image (e.g., 'my-app')")
     tag: str = Field("latest", description="Tag for the image (e.g., 'latest', 'v1')")
+    context_files: Optional[Dict[str, str]] = Field(None, description="Extra files for COPY/ADD, as relative path -> content")
+    engine: Optional[str] = Field(None, description="Build engine: 'classic' or 'buildkit' (default from DOCKER_BUILD_ENGINE)")
 
 class DockerContainerCreateRequest(BaseModel):
     image: str = Field(..., description="Image name to use (e.g., 'nginx:latest')")
@@ -55,6 +64,12 @@ class DockerContainerDeleteRequest(BaseModel):
     container_id: str = Field(..., description="ID or name of the container to delete")
     force: bool = Field(False, description="Force removal of the container")
 
+class DockerContainerBulkRequest(BaseModel):
+    container_ids: List[str] = Field(..., description="IDs or names of the containers to act on")
+    action: str = Field(..., description="Action to apply to every container: 'start', 'stop' or 'delete'")
+    timeout: int = Field(10, description="Stop timeout in seconds (stop action only)")
+    force: bool = Field(False, description="Force removal of running containers (delete action only)")
+
 class DockerImageSearchRequest(BaseModel):
     term: str = Field(..., description="Search term")
     limit: int = Field(10, description="Maximum number of results to return")
@@ -70,6 +85,7 @@ class DockerfileUpdateRequest(BaseModel):
     name: str = Field(..., description="Name of the Dockerfile to update")
     content: str = Field(..., description="New content for the Dockerfile")
     description: Optional[str] = Field(None, description="Optional updated description")
+    expected_version: Optional[int] = Field(None, description="Version the edit is based on; the update fails with 409 if it has moved on")
 
 class DockerfileDeleteRequest(BaseModel):
     name: str = Field(..., description="Name of the Dockerfile to delete")
@@ -78,6 +94,10 @@ class DockerImageDeleteRequest(BaseModel):
     image_id: str = Field(..., description="ID or name of the image to delete")
     force: bool = Field(False, description="Force removal of the image")
 
+# Upper bound on concurrent Docker API calls made by bulk container operations
+BULK_CONTAINER_CONCURRENCY = int(os.getenv("DOCKER_BULK_CONCURRENCY", "8"))
+BULK_CONTAINER_ACTIONS = ("start", "stop", "delete")
+
 # Helper function to ensure docker client is available
 def get_docker_client():
     if not docker_client:
@@ -114,30 +134,11 @@ async def create_dockerfile(
         # Debug: print raw request data to diagnose field swapping
         print(f"Raw Dockerfile creation request: name={repr(req.name)}, content={repr(req.content[:40] if req.content else '')}")
         
-        # Extra safeguard against swapped fields: if name looks like Dockerfile content, swap fields
-        if req.name and req.content and (
-            req.name.startswith('FROM ') or 
-            req.name.startswith('#') or
-            '\n' in req.name or
-            'RUN ' in req.name
-        ):
-            print(f"⚠️ DETECTED SWAPPED FIELDS - name contains Dockerfile syntax! Swapping fields automatically.")
-            # Store original values
-            original_name = req.name
-            original_content = req.content
-            
-            # Swap values if content looks more like a name and name looks like content
-            if len(req.content) < 50 and len(req.name) > 50:
-                print(f"Fixing swapped fields: old name: {repr(req.name[:40])}..., old content: {repr(req.content)}")
-                # Update the Pydantic model fields
-                # Note: Since Pydantic models are immutable, we need to use a workaround
-                # We'll extract the actual name from the content and use it
-                req_dict = req.dict()
-                req_dict["name"] = original_content
-                req_dict["content"] = original_name
-                # Create a new request object with the swapped fields
-                req = DockerfileCreateRequest(**req_dict)
-                print(f"Fields swapped: new name: {repr(req.name)}, new content: {repr(req.content[:40])}...")
+        # Some clients send name and content the wrong way round; swap only when the
+        # name parses as a Dockerfile and the content does not
+        if req.name and req.content and dockerfile_lint.looks_like_dockerfile(req.name) and not dockerfile_lint.looks_like_dockerfile(req.content):
+            print(f"⚠️ Dockerfile name and content are swapped, fixing: content={repr(req.content[:40])}")
+            req = DockerfileCreateRequest(name=req.content.strip(), content=req.name, description=req.description)
         
         # Log raw incoming request data for debugging
         print(f"Processing with: name={repr(req.name)}, content length={len(req.content) if req.content else 0}")
@@ -158,22 +159,9 @@ async def create_dockerfile(
         # Add debug log
         print(f"Creating Dockerfile: {safe_filename} for user {user['email']}")
         
-        # Get the dockerfiles directory and ensure it exists
-        dockerfiles_dir = get_dockerfiles_dir()
-        print(f"Using dockerfiles directory: {dockerfiles_dir}")
-        
-        # Double-check directory exists
-        if not os.path.exists(dockerfiles_dir):
-            print(f"Creating dockerfiles directory: {dockerfiles_dir}")
-            os.makedirs(dockerfiles_dir, exist_ok=True)
-        
-        # Create the full path for the Dockerfile - ensure we're not using the content as the name
-        dockerfile_path = os.path.join(dockerfiles_dir, f"{safe_filename}.Dockerfile")
-        print(f"Dockerfile path: {dockerfile_path}")
-        
-        # Check if a file with this name already exists
-        if os.path.exists(dockerfile_path):
-            print(f"Dockerfile already exists: {dockerfile_path}")
+        # Mongo holds the content; nothing is written to disk until a build needs it
+        existing = await db.dockerfiles.find_one({"name": safe_filename, "user_email": user["email"]}, {"_id": 1})
+        if existing:
             raise HTTPException(
                 status_code=409,
                 detail=f"A Dockerfile with the name '{safe_filename}' already exists"
@@ -184,30 +172,23 @@ async def create_dockerfile(
         if not isinstance(content, str):
             content = str(content)
         
-        # Write content to a separate log for debugging    
-        print(f"Dockerfile content to write: {repr(content[:100])}...")
-            
-        # Write the Dockerfile content to disk with explicit encoding
-        print(f"Writing content to Dockerfile: {dockerfile_path}")
-        try:
-            with open(dockerfile_path, "w", encoding="utf-8") as f:
-                f.write(content)
-        except Exception as write_error:
-            print(f"Error writing Dockerfile: {str(write_error)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to write Dockerfile to disk: {str(write_error)}"
-            )
-        
-        # Save the Dockerfile record in the database
+        # Save the Dockerfile record in the database, starting its version history
         try:
             creation_time = datetime.utcnow()
+            content_hash = dockerfile_hash(content)
             dockerfile_record = {
                 "user_email": user["email"],
                 "name": safe_filename,
-                "path": dockerfile_path,
                 "description": req.description,
                 "content": content,
+                "content_hash": content_hash,
+                "version": 1,
+                "versions": [{
+                    "version": 1,
+                    "content": content,
+                    "content_hash": content_hash,
+                    "created_at": creation_time
+                }],
                 "created_at": creation_time,
                 "updated_at": creation_time
             }
@@ -215,23 +196,16 @@ async def create_dockerfile(
             print(f"Inserting Dockerfile record into database")
             result = await db.dockerfiles.insert_one(dockerfile_record)
             print(f"Dockerfile record inserted with ID: {result.inserted_id}")
+            dockerfile_lint.lint_in_background(content_hash, content)
             
             return {
                 "message": "Dockerfile created successfully",
                 "id": str(result.inserted_id),
                 "name": safe_filename,
-                "path": dockerfile_path
+                "version": 1
             }
         except Exception as db_error:
-            # If we failed to insert in the database but created the file,
-            # try to clean up the file
             print(f"Database error: {str(db_error)}")
-            if os.path.exists(dockerfile_path):
-                try:
-                    os.remove(dockerfile_path)
-                    print(f"Removed Dockerfile due to DB error: {dockerfile_path}")
-                except:
-                    pass
             raise HTTPException(
                 status_code=500,
                 detail=f"Failed to save Dockerfile record in database: {str(db_error)}"
@@ -254,71 +228,116 @@ async def create_dockerfile(
 @router.post("/image/build")#Mostafa
 async def build_docker_image(
     req: DockerImageBuildRequest, 
-    background_tasks: BackgroundTasks,
     user=Depends(get_current_user)
 ):
-    """Build a Docker image from an existing Dockerfile"""
+    """
+    Queue a Docker image build from an existing Dockerfile.
+
+    At most DOCKER_BUILD_CONCURRENCY builds run at once; free slots are shared
+    fairly between users, weighted by plan. Submitting a build identical to one
+    of yours that is still queued or running returns that build instead.
+    """
     try:
         # Get Docker client
         client = get_docker_client()
         
-        # Get the dockerfiles directory
-        dockerfiles_dir = get_dockerfiles_dir()
-        dockerfile_path = os.path.join(dockerfiles_dir, f"{req.dockerfile_name}.Dockerfile")
+        # Verify the user owns this Dockerfile; the build uses the version current right now
+        dockerfile = await db.dockerfiles.find_one(
+            {"name": req.dockerfile_name, "user_email": user["email"]},
+            {"versions": 0}
+        )
         
-        # Check if the Dockerfile exists
-        if not os.path.exists(dockerfile_path):
+        if not dockerfile:
             raise HTTPException(
                 status_code=404,
                 detail=f"Dockerfile '{req.dockerfile_name}' not found"
             )
             
-        # Verify the user owns this Dockerfile
-        dockerfile = await db.dockerfiles.find_one({
-            "name": req.dockerfile_name,
-            "user_email": user["email"]
-        })
-        
-        if not dockerfile:
+        # Dockerfiles the builder would reject never reach the queue
+        content = dockerfile["content"]
+        lint = await dockerfile_lint.lint_cached(dockerfile.get("content_hash") or dockerfile_hash(content), content)
+        if lint["summary"]["error"]:
             raise HTTPException(
-                status_code=403,
-                detail="You don't have permission to use this Dockerfile"
+                status_code=400,
+                detail={
+                    "message": f"Dockerfile '{req.dockerfile_name}' has {lint['summary']['error']} error(s); fix them before building",
+                    "findings": [f for f in lint["findings"] if f["severity"] == "error"]
+                }
             )
-            
-        # Create a build record in the database with status "building"
-        build_id = str(ObjectId())
+
+        # Building the context now rejects bad paths and gives the build its identity
+        context = build_context(content, req.context_files)
+        engine = check_engine(req.engine)
         image_tag = f"{req.image_name}:{req.tag}"
-        build_record = {
-            "_id": ObjectId(build_id),
-            "user_email": user["email"],
-            "dockerfile_id": str(dockerfile["_id"]),
-            "dockerfile_name": req.dockerfile_name,
-            "image_name": req.image_name,
-            "tag": req.tag,
-            "image_tag": image_tag,
-            "status": "building",
-            "logs": [],
-            "started_at": datetime.utcnow(),
-            "finished_at": None,
-            "success": None
-        }
-        
-        await db.docker_builds.insert_one(build_record)
+        key = build_scheduler.build_key(context.getvalue(), image_tag.lower(), engine)
+
+        # Same Dockerfile, files and base images as an earlier successful build: retag its image.
+        # Only classic builds use the daemon's local base images, so only they can be predicted
+        inputs_key = None
+        if engine == "classic":
+            loop = asyncio.get_event_loop()
+            inputs_key = await loop.run_in_executor(None, content_key, client, context.getvalue(), content)
+        if inputs_key:
+            reused = await reuse_previous_build(client, user, dockerfile, req, image_tag, engine, inputs_key)
+            if reused:
+                return reused
+
+        async with build_scheduler.dispatch_lock:
+            # Same content, tag and engine already on its way: hand back that build
+            existing = await db.docker_builds.find_one({
+                "user_email": user["email"],
+                "build_key": key,
+                "status": {"$in": ["queued", "building"]}
+            })
+            if existing:
+                return {
+                    "message": "An identical build is already in progress",
+                    "build_id": str(existing["_id"]),
+                    "image_tag": existing["image_tag"],
+                    "status": existing["status"],
+                    "queue_position": existing.get("queue_position"),
+                    "deduplicated": True
+                }
+
+            # Create a build record in the database; the scheduler starts it when a slot is free
+            build_id = str(ObjectId())
+            build_record = {
+                "_id": ObjectId(build_id),
+                "user_email": user["email"],
+                "plan": user.get("plan"),
+                "dockerfile_id": str(dockerfile["_id"]),
+                "dockerfile_name": req.dockerfile_name,
+                "dockerfile_version": dockerfile.get("version"),
+                "dockerfile_hash": dockerfile.get("content_hash") or dockerfile_hash(content),
+                "lint_summary": lint["summary"],
+                "image_name": req.image_name,
+                "tag": req.tag,
+                "image_tag": image_tag,
+                "engine": engine,
+                "context_files": req.context_files,
+                "build_key": key,
+                "content_key": inputs_key,
+                "cache_hit": False,
+                "status": "queued",
+                "logs": [],
+                "queued_at": datetime.utcnow(),
+                "started_at": None,
+                "finished_at": None,
+                "success": None
+            }
+            
+            await db.docker_builds.insert_one(build_record)
         
-        # Start the build process in the background
-        background_tasks.add_task(
-            build_image_task,
-            build_id,
-            dockerfile_path,
-            image_tag,
-            user["email"]
-        )
+        await process_build_queue()
+        build = await db.docker_builds.find_one({"_id": ObjectId(build_id)}, {"status": 1, "queue_position": 1})
         
         return {
-            "message": "Docker image build started",
+            "message": "Docker image build started" if build["status"] != "queued" else "⏳ Build slots are busy, build queued",
             "build_id": build_id,
             "image_tag": image_tag,
-            "status": "building"
+            "status": build["status"],
+            "queue_position": build.get("queue_position"),
+            "deduplicated": False
         }
         
     except HTTPException:
@@ -329,10 +348,214 @@ async def build_docker_image(
             detail=f"Failed to start image build: {str(e)}"
         )
 
+async def save_image_record(user_email, image_tag, image_info, build_id):
+    """Record a built image for the user, replacing the record of an earlier build of the same tag"""
+    img_name, _, img_tag = image_tag.rpartition(":")
+    await db.docker_images.update_one(
+        {"user_email": user_email, "name": img_name, "tag": img_tag},
+        {
+            "$set": {
+                "image_id": image_info.id,
+                "size": image_info.attrs.get('Size', 0),
+                "build_id": build_id
+            },
+            "$setOnInsert": {"created_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+
+async def reuse_previous_build(client, user, dockerfile, req, image_tag, engine, inputs_key):
+    """
+    Finish a build request from the user's last successful build with the same
+    inputs, if its image is still on the daemon. Returns the response, or None
+    to build normally.
+    """
+    previous = await db.docker_builds.find_one(
+        {"user_email": user["email"], "content_key": inputs_key, "success": True, "image_id": {"$ne": None}},
+        sort=[("finished_at", -1)]
+    )
+    if not previous:
+        return None
+    try:
+        image = client.images.get(previous["image_id"])
+    except docker.errors.ImageNotFound:
+        return None
+
+    image_tag = image_tag.lower()
+    repository, _, tag = image_tag.rpartition(":")
+    image.tag(repository, tag)
+
+    build_id = str(ObjectId())
+    now = datetime.utcnow()
+    await db.docker_builds.insert_one({
+        "_id": ObjectId(build_id),
+        "user_email": user["email"],
+        "plan": user.get("plan"),
+        "dockerfile_id": str(dockerfile["_id"]),
+        "dockerfile_name": req.dockerfile_name,
+        "image_name": req.image_name,
+        "tag": req.tag,
+        "image_tag": image_tag,
+        "engine": engine,
+        "content_key": inputs_key,
+        "cache_hit": True,
+        "reused_build_id": str(previous["_id"]),
+        "image_id": image.id,
+        "status": "completed",
+        "logs": [{"log": f"Inputs unchanged since build {previous['_id']}; tagged existing image {image.id} as {image_tag}", "timestamp": now}],
+        "queued_at": now,
+        "started_at": now,
+        "finished_at": now,
+        "success": True
+    })
+    await save_image_record(user["email"], image_tag, image, build_id)
+    print(f"♻️ Build of {image_tag} for {user['email']} reused image {image.id[:19]}")
+
+    return {
+        "message": "✅ Nothing changed since the last build, existing image tagged",
+        "build_id": build_id,
+        "image_tag": image_tag,
+        "image_id": image.id,
+        "status": "completed",
+        "cache_hit": True
+    }
+
+# Builds this worker process is running, by build id
+running_builds = {}
+
+async def process_build_queue():
+    """Start queued builds in fair order while build slots are free, and refresh queue positions"""
+    async with build_scheduler.dispatch_lock:
+        running = {}
+        async for row in db.docker_builds.aggregate([
+            {"$match": {"status": "building"}},
+            {"$group": {"_id": "$user_email", "count": {"$sum": 1}}}
+        ]):
+            running[row["_id"]] = row["count"]
+        queued = await db.docker_builds.find(
+            {"status": "queued"},
+            {"user_email": 1, "plan": 1, "queued_at": 1, "queue_position": 1}
+        ).to_list(None)
+        if not queued:
+            return 0
+
+        free_slots = build_scheduler.DOCKER_BUILD_CONCURRENCY - sum(running.values())
+        started = 0
+        waiting = []
+        for build in build_scheduler.fair_order(queued, running):
+            if started < free_slots:
+                now = datetime.utcnow()
+                # The status condition keeps another worker process from starting it too
+                claimed = await db.docker_builds.update_one(
+                    {"_id": build["_id"], "status": "queued"},
+                    {
+                        "$set": {"status": "building", "started_at": now, "heartbeat_at": now},
+                        "$unset": {"queue_position": ""}
+                    }
+                )
+                if claimed.modified_count:
+                    build_id = str(build["_id"])
+                    running_builds[build_id] = asyncio.create_task(run_queued_build(build_id))
+                    started += 1
+                continue
+            waiting.append(build)
+        # Positions follow the fair order, so they show when each build will actually start
+        updates = [
+            UpdateOne({"_id": build["_id"]}, {"$set": {"queue_position": position}})
+            for position, build in enumerate(waiting, start=1)
+            if build.get("queue_position") != position
+        ]
+        if updates:
+            await db.docker_builds.bulk_write(updates, ordered=False)
+        return started
+
+async def dockerfile_for_build(build):
+    """
+    Path of the Dockerfile version a build was queued with, taken from the
+    content-addressed cache and written there from Mongo if it's missing.
+    """
+    content_hash = build.get("dockerfile_hash")
+    if not content_hash:
+        # Queued before Dockerfiles moved to Mongo
+        return os.path.join(get_dockerfiles_dir(), f"{build['dockerfile_name']}.Dockerfile")
+    path = dockerfile_cache_path(content_hash)
+    if os.path.exists(path):
+        return path
+    dockerfile = await db.dockerfiles.find_one(
+        {"_id": ObjectId(build["dockerfile_id"])},
+        {"content": 1, "content_hash": 1, "versions": {"$elemMatch": {"content_hash": content_hash}}}
+    )
+    if dockerfile and dockerfile.get("versions"):
+        content = dockerfile["versions"][0]["content"]
+    elif dockerfile and (dockerfile.get("content_hash") or dockerfile_hash(dockerfile["content"])) == content_hash:
+        content = dockerfile["content"]
+    else:
+        # build_image_task reports the missing file as the build's error
+        return path
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, materialize_dockerfile, content)
+
+async def run_queued_build(build_id):
+    """Run one dispatched build, then hand its slot to the next queued build"""
+    try:
+        build = await db.docker_builds.find_one({"_id": ObjectId(build_id)})
+        dockerfile_path = await dockerfile_for_build(build)
+        print(f"🔨 Starting queued build {build_id} ({build['image_tag']}) for {build['user_email']}")
+        await build_image_task(
+            build_id,
+            dockerfile_path,
+            build["image_tag"],
+            build["user_email"],
+            build.get("context_files"),
+            build.get("engine", "classic")
+        )
+    finally:
+        running_builds.pop(build_id, None)
+        try:
+            await process_build_queue()
+        except Exception as e:
+            print(f"Build queue check failed: {str(e)}")
+
+async def build_queue_worker():
+    """
+    Background loop that keeps the build queue moving: refreshes the heartbeat
+    of this process's builds and fails builds whose worker died, so their slots
+    come back.
+    """
+    while True:
+        await asyncio.sleep(build_scheduler.DOCKER_BUILD_QUEUE_POLL_SECONDS)
+        try:
+            now = datetime.utcnow()
+            if running_builds:
+                await db.docker_builds.update_many(
+                    {"_id": {"$in": [ObjectId(b) for b in running_builds]}, "status": "building"},
+                    {"$set": {"heartbeat_at": now}}
+                )
+            cutoff = now - timedelta(seconds=build_scheduler.DOCKER_BUILD_HEARTBEAT_TIMEOUT_SECONDS)
+            stale = await db.docker_builds.update_many(
+                {"status": "building", "heartbeat_at": {"$not": {"$gte": cutoff}}},
+                {
+                    "$set": {"status": "failed", "success": False, "finished_at": now},
+                    "$push": {"logs": {"log": "Build failed: the server running it stopped", "timestamp": now}}
+                }
+            )
+            if stale.modified_count:
+                print(f"⚠️ Marked {stale.modified_count} orphaned build(s) as failed")
+            await process_build_queue()
+        except Exception as e:
+            print(f"Build queue check failed: {str(e)}")
+
 # Background task to build Docker image
-async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
+async def push_build_log(build_id, logs, text):
+    """Append a line to the in-memory and stored log of a build"""
+    entry = {"log": text, "timestamp": datetime.utcnow()}
+    logs.append(entry)
+    await db.docker_builds.update_one({"_id": ObjectId(build_id)}, {"$push": {"logs": entry}})
+
+async def build_image_task(build_id, dockerfile_path, image_tag, user_email, context_files=None, engine="classic"):
     client = docker.from_env()
     success = False
+    built_image_id = None
     logs = []
     
     try:
@@ -340,12 +563,6 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
         image_tag = image_tag.lower()
         print(f"Building Docker image: {image_tag} from {dockerfile_path}")
         
-        # Add more debug information about the build context
-        build_context = os.path.dirname(dockerfile_path)
-        dockerfile_name = os.path.basename(dockerfile_path)
-        print(f"Docker build context: {build_context}")
-        print(f"Dockerfile name: {dockerfile_name}")
-        
         # Debug: Check if the Dockerfile exists and print its content
         if os.path.exists(dockerfile_path):
             try:
@@ -361,6 +578,7 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
                     "log": f"ERROR: Failed to read Dockerfile: {str(e)}",
                     "timestamp": datetime.utcnow()
                 })
+                raise
         else:
             error_msg = f"Dockerfile not found at path: {dockerfile_path}"
             print(error_msg)
@@ -373,70 +591,78 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
                 {"$push": {"logs": {"log": f"ERROR: {error_msg}", "timestamp": datetime.utcnow()}}}
             )
             raise FileNotFoundError(error_msg)
-        
-        # Execute the build with enhanced error handling
-        try:
-            build_logs = client.api.build(
-                path=build_context,
-                dockerfile=dockerfile_name,
-                tag=image_tag,
-                rm=True,
-                decode=True
-            )
-            
-            # Process and save the build logs
-            for log in build_logs:
-                if 'stream' in log:
-                    log_text = log['stream'].strip()
-                    if log_text:
-                        print(f"Build log: {log_text}")
+
+        # The context holds only this Dockerfile and the declared files, never the
+        # shared dockerfiles/ directory, so its size doesn't grow with stored Dockerfiles
+        context = build_context(content, context_files)
+        print(f"Docker build context: {1 + len(context_files or {})} file(s), {len(context.getbuffer())} bytes")
+        
+        if engine == "buildkit":
+            # BuildKit reuses layers from this user's local cache and exports the updated cache
+            async def log_line(text):
+                print(f"Build log: {text}")
+                await push_build_log(build_id, logs, text)
+
+            result = await buildkit_build(context, image_tag, user_cache_dir(user_email), log_line)
+            cache = result["cache"]
+            await push_build_log(build_id, logs, f"BuildKit cache: {cache['cached']}/{cache['steps']} steps reused")
+            await db.docker_builds.update_one({"_id": ObjectId(build_id)}, {"$set": {"cache": cache}})
+        else:
+            # Execute the build with enhanced error handling
+            try:
+                # Process and save the build logs; the stream is read off the event loop
+                async for log in classic_build(client, context, image_tag):
+                    if 'stream' in log:
+                        log_text = log['stream'].strip()
+                        if log_text:
+                            print(f"Build log: {log_text}")
+                            logs.append({
+                                "log": log_text,
+                                "timestamp": datetime.utcnow()
+                            })
+                            # Update the build record in the database
+                            await db.docker_builds.update_one(
+                                {"_id": ObjectId(build_id)},
+                                {"$push": {"logs": {"log": log_text, "timestamp": datetime.utcnow()}}}
+                            )
+                        
+                    if 'error' in log:
+                        error_msg = log['error'].strip()
+                        print(f"Build error: {error_msg}")
                         logs.append({
-                            "log": log_text,
+                            "log": f"ERROR: {error_msg}",
                             "timestamp": datetime.utcnow()
                         })
-                        # Update the build record in the database
                         await db.docker_builds.update_one(
                             {"_id": ObjectId(build_id)},
-                            {"$push": {"logs": {"log": log_text, "timestamp": datetime.utcnow()}}}
+                            {"$push": {"logs": {"log": f"ERROR: {error_msg}", "timestamp": datetime.utcnow()}}}
                         )
-                        
-                if 'error' in log:
-                    error_msg = log['error'].strip()
-                    print(f"Build error: {error_msg}")
-                    logs.append({
-                        "log": f"ERROR: {error_msg}",
-                        "timestamp": datetime.utcnow()
-                    })
-                    await db.docker_builds.update_one(
-                        {"_id": ObjectId(build_id)},
-                        {"$push": {"logs": {"log": f"ERROR: {error_msg}", "timestamp": datetime.utcnow()}}}
-                    )
-                    raise Exception(error_msg)
+                        raise Exception(error_msg)
                     
-                # Also capture auxiliary messages
-                if 'aux' in log:
-                    aux_text = f"AUX: {json.dumps(log['aux'])}"
-                    print(aux_text)
-                    logs.append({
-                        "log": aux_text,
-                        "timestamp": datetime.utcnow()
-                    })
-                    await db.docker_builds.update_one(
-                        {"_id": ObjectId(build_id)},
-                        {"$push": {"logs": {"log": aux_text, "timestamp": datetime.utcnow()}}}
-                    )
-        except docker.errors.BuildError as build_error:
-            error_msg = f"Docker build error: {str(build_error)}"
-            print(error_msg)
-            logs.append({
-                "log": f"ERROR: {error_msg}",
-                "timestamp": datetime.utcnow()
-            })
-            await db.docker_builds.update_one(
-                {"_id": ObjectId(build_id)},
-                {"$push": {"logs": {"log": f"ERROR: {error_msg}", "timestamp": datetime.utcnow()}}}
-            )
-            raise build_error
+                    # Also capture auxiliary messages
+                    if 'aux' in log:
+                        aux_text = f"AUX: {json.dumps(log['aux'])}"
+                        print(aux_text)
+                        logs.append({
+                            "log": aux_text,
+                            "timestamp": datetime.utcnow()
+                        })
+                        await db.docker_builds.update_one(
+                            {"_id": ObjectId(build_id)},
+                            {"$push": {"logs": {"log": aux_text, "timestamp": datetime.utcnow()}}}
+                        )
+            except docker.errors.BuildError as build_error:
+                error_msg = f"Docker build error: {str(build_error)}"
+                print(error_msg)
+                logs.append({
+                    "log": f"ERROR: {error_msg}",
+                    "timestamp": datetime.utcnow()
+                })
+                await db.docker_builds.update_one(
+                    {"_id": ObjectId(build_id)},
+                    {"$push": {"logs": {"log": f"ERROR: {error_msg}", "timestamp": datetime.utcnow()}}}
+                )
+                raise build_error
                 
         # Build successful
         success = True
@@ -450,7 +676,7 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
             max_retries = 3
             while retry_count < max_retries:
                 try:
-                    image_info = client.images.get(image_tag)
+                    image_info = await asyncio.get_event_loop().run_in_executor(None, client.images.get, image_tag)
                     print(f"Image verified with ID: {image_info.id}")
                     break
                 except docker.errors.ImageNotFound:
@@ -461,27 +687,11 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
                         await asyncio.sleep(2)
                     else:
                         raise
-            
-            # Extract the name and tag components
-            name_parts = image_tag.split(":")
-            img_name = name_parts[0]
-            img_tag = name_parts[1] if len(name_parts) > 1 else "latest"
-            
-            print(f"Preparing image record for database: name={img_name}, tag={img_tag}")
+            built_image_id = image_info.id
             
             # Add the image to the database with explicit name/tag
-            image_record = {
-                "user_email": user_email,
-                "name": img_name,
-                "tag": img_tag,
-                "image_id": image_info.id,
-                "created_at": datetime.utcnow(),
-                "size": image_info.attrs.get('Size', 0),
-                "build_id": build_id
-            }
-            
-            print(f"Saving image record to database: {image_record}")
-            await db.docker_images.insert_one(image_record)
+            print(f"Saving image record to database: {image_tag} ({image_info.id})")
+            await save_image_record(user_email, image_tag, image_info, build_id)
             print(f"Image record saved to database successfully")
         except docker.errors.ImageNotFound:
             error_msg = f"Image {image_tag} not found after build!"
@@ -530,7 +740,9 @@ async def build_image_task(build_id, dockerfile_path, image_tag, user_email):
                 "$set": {
                     "status": "completed" if success else "failed",
                     "finished_at": datetime.utcnow(),
-                    "success": success
+                    "success": success,
+                    # Later builds with the same content_key can reuse this image
+                    "image_id": built_image_id if success else None
                 }
             }
         )
@@ -839,6 +1051,10 @@ async def list_containers(user=Depends(get_current_user)):
         result = []
         for container in containers:
             try:
+                # Unclaimed warm containers belong to the pool, not to any user
+                if container_pool.is_pool_member(container):
+                    continue
+
                 # Format the base container info with defensive coding
                 container_info = {
                     "id": container.id,
@@ -922,10 +1138,84 @@ async def list_containers(user=Depends(get_current_user)):
             "suggestions": ["Restart Docker service", "Check Docker logs"]
         }
 
+@router.get("/containers/stats")
+async def list_container_stats(since: Optional[float] = None, user=Depends(get_current_user)):
+    """
+    CPU, memory, network and disk rates of all the user's containers, served
+    from the collector's in-memory buffers. Pass `since` (epoch seconds) to
+    also get each container's points newer than that.
+    """
+    containers = await db.docker_containers.find(
+        {"user_email": user["email"]},
+        {"container_id": 1, "name": 1, "image": 1}
+    ).to_list(None)
+    stats = []
+    for record in containers:
+        container_id = record.get("container_id")
+        if not container_id:
+            continue
+        entry = {
+            "container_id": container_id,
+            "name": record.get("name"),
+            "image": record.get("image"),
+            "streaming": container_id in container_stats.streams,
+            # Running, but past DOCKER_STATS_MAX_STREAMS: no stats until a stream frees up
+            "stream_limited": container_id in container_stats.skipped,
+            "current": container_stats.latest(container_id)
+        }
+        if since is not None:
+            entry["points"] = container_stats.live_points(container_id, since)
+        stats.append(entry)
+    return {
+        "fields": container_stats.POINT_FIELDS,
+        "containers": stats,
+        "stream_limit": container_stats.DOCKER_STATS_MAX_STREAMS,
+        "stream_limited": sum(1 for entry in stats if entry["stream_limited"])
+    }
+
+@router.get("/container/{container_id}/logs")
+async def get_container_logs(
+    container_id: str,
+    tail: Optional[int] = 100,
+    since: Optional[int] = None,
+    follow: bool = False,
+    user=Depends(get_current_user)
+):
+    """
+    A container's output as Server-Sent Events: the last `tail` lines (after
+    `since`, epoch seconds), then with `follow` new lines as they are written.
+    Viewers of the same container share one daemon stream.
+    """
+    client = get_docker_client()
+    try:
+        container = client.containers.get(container_id)
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail=f"Container '{container_id}' not found")
+    owned = await db.docker_containers.find_one({"container_id": container.id, "user_email": user["email"]}, {"_id": 1})
+    if not owned:
+        raise HTTPException(status_code=403, detail="You don't have permission to read this container's logs")
+
+    if follow and container.status == "running":
+        events = container_logs.follow(client, container.id, tail, since)
+    else:
+        async def events():
+            loop = asyncio.get_event_loop()
+            for line in await loop.run_in_executor(None, container_logs.history, client, container.id, tail, since):
+                yield container_logs.sse_event(line)
+            yield container_logs.sse_event("end of log", event="end")
+        events = events()
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # Proxies must pass events through as they are written
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # 5. Create and run a container
 @router.post("/container/create")#y
 async def create_container(request: Request, user=Depends(get_current_user)):
     print("🔵 [API] /container/create called")
+    requested_at = time.perf_counter()
     data = await request.json()
     print(f"🟢 Received data: {data}")
 
@@ -953,12 +1243,56 @@ async def create_container(request: Request, user=Depends(get_current_user)):
 
     exposed_ports = data.get("ExposedPorts", {})
     print(f"🟢 Exposed ports: {exposed_ports}")
+    restart_policy = data.get("HostConfig", {}).get("RestartPolicy", {"Name": "always"})
+
+    if container_name.startswith(container_pool.POOL_NAME_PREFIX):
+        return {"error": f"Container names starting with '{container_pool.POOL_NAME_PREFIX}' are reserved", "status_code": 400}
+
+    # Warm containers already publish their image's ports on "auto" host ports, so
+    # requests with "auto" bindings (and the default TTY settings) can use one
+    if set(exposed_ports) <= set(port_bindings) and data.get("Tty", True) and data.get("OpenStdin", True):
+        try:
+            claimed = await container_pool.claim(image, container_name, restart_policy, port_bindings, user["email"])
+        except Exception as pool_error:
+            print(f"🟠 Warning: Warm pool claim failed, creating from scratch: {str(pool_error)}")
+            claimed = None
+        if claimed:
+            container_id, port_bindings = claimed
+            container_pool.record_latency("warm", time.perf_counter() - requested_at)
+            print(f"🟢 Container {container_name} started from the warm pool: {container_id}")
+            try:
+                now = datetime.utcnow()
+                await db.docker_containers.insert_one({
+                    "container_id": container_id,
+                    "user_email": user["email"],
+                    "name": container_name,
+                    "image": image,
+                    "created_at": now,
+                    "started_at": now,
+                    "status": "running",
+                    "port_bindings": port_bindings,
+                    "warm_pool": True
+                })
+            except Exception as db_error:
+                print(f"🟠 Warning: Failed to save container to database: {str(db_error)}")
+            return {"id": container_id, "name": container_name, "status": "running", "warm_pool": True}
+
+    # Reserve the host ports before anything is created; "auto" ones get a free port
+    reservation = None
+    if port_bindings:
+        try:
+            reservation, port_bindings = await port_allocator.reserve(port_bindings, user["email"])
+        except port_allocator.PortConflict as conflict:
+            print(f"🔴 Port reservation failed: {str(conflict)}")
+            return {"error": str(conflict), "status_code": 409}
+        print(f"🟢 Host ports reserved: {port_bindings}")
 
+    container_id = None
     try:
         # Create host config
         host_config = docker_client.api.create_host_config(
             port_bindings=port_bindings,
-            restart_policy=data.get("HostConfig", {}).get("RestartPolicy", {"Name": "always"})
+            restart_policy=restart_policy
         )
         
         # Handle exposed ports properly - use lowercase 'exposed_ports' not 'ExposedPorts'
@@ -987,6 +1321,8 @@ async def create_container(request: Request, user=Depends(get_current_user)):
             return {"error": "Failed to create container - no container ID returned"}
             
         print(f"🟢 Container created with ID: {container_id}")
+        if reservation:
+            await port_allocator.attach(reservation, container_id)
 
         # Get the current user's email directly from the user dependency
         current_user_email = user["email"]
@@ -1024,17 +1360,34 @@ async def create_container(request: Request, user=Depends(get_current_user)):
             except Exception as db_update_error:
                 print(f"🟠 Warning: Failed to update container status: {str(db_update_error)}")
             
+            container_pool.record_latency("cold", time.perf_counter() - requested_at)
             return {"id": container_id, "name": container_name, "status": "running"}
         except Exception as start_error:
+            # Don't leave a never-started container, its record and its ports behind
             print(f"🔴 Error starting container {container_id}: {str(start_error)}")
-            return {"id": container_id, "name": container_name, "status": "created", "error": f"Container created but failed to start: {str(start_error)}"}
+            try:
+                docker_client.api.remove_container(container_id, force=True)
+                await db.docker_containers.delete_one({"container_id": container_id})
+            except Exception as cleanup_error:
+                print(f"🟠 Warning: Failed to clean up container {container_id}: {str(cleanup_error)}")
+            if reservation:
+                await port_allocator.release(reservation)
+            return {"name": container_name, "status": "failed", "error": f"Container failed to start and was removed: {str(start_error)}"}
     
     except Exception as e:
         print(f"🔴 Error creating/starting container: {e}")
         import traceback
         traceback.print_exc()
+        # Creation itself failed, so nothing holds the reserved ports
+        if reservation and not container_id:
+            await port_allocator.release(reservation)
         return {"error": str(e)}
 
+@router.get("/containers/pool")
+async def get_container_pool(user=Depends(get_current_user)):
+    """Warm pool sizes per template and p50/p95 create-to-running latency, warm vs. from scratch"""
+    return container_pool.status()
+
 # Also add these routes to ensure compatibility with different URL formats
 @router.post("/docker/container/create")#y
 async def create_docker_container(request: Request, user=Depends(get_current_user)):
@@ -1052,6 +1405,8 @@ async def start_container(name: str):
     print(f"🔵 [API] /container/{name}/start called")
     try:
         container = docker_client.containers.get(name)
+        if container_pool.is_pool_member(container):
+            raise docker.errors.NotFound(name)
         container.start()
         print(f"🟢 Container {name} started successfully")
         return {"message": f"Container {name} started successfully"}
@@ -1067,9 +1422,14 @@ async def start_container(name: str):
 async def start_container_by_id(container_id: str):
     print(f"🔵 [API] /container/id/{container_id}/start called")
     try:
+        if container_pool.is_pool_member(docker_client.containers.get(container_id)):
+            raise docker.errors.NotFound(container_id)
         docker_client.api.start(container_id)
         print(f"🟢 Container {container_id} started successfully")
         return {"message": f"Container {container_id} started successfully"}
+    except docker.errors.NotFound:
+        print(f"🔴 Container {container_id} not found")
+        return {"error": f"Container {container_id} not found", "status_code": 404}
     except Exception as e:
         print(f"🔴 Error starting container by ID: {e}")
         return {"error": str(e)}
@@ -1084,6 +1444,8 @@ async def stop_container(req: DockerContainerStopRequest, user=Depends(get_curre
         # Check if container exists
         try:
             container = client.containers.get(req.container_id)
+            if container_pool.is_pool_member(container):
+                raise docker.errors.NotFound(req.container_id)
         except docker.errors.NotFound:
             raise HTTPException(
                 status_code=404,
@@ -1134,6 +1496,8 @@ async def stop_container_by_id(container_id: str):
         # Check if container exists
         try:
             container = client.containers.get(container_id)
+            if container_pool.is_pool_member(container):
+                raise docker.errors.NotFound(container_id)
         except docker.errors.NotFound:
             return JSONResponse(
                 status_code=404,
@@ -1176,6 +1540,8 @@ async def delete_container(
         # Check if container exists
         try:
             container = client.containers.get(req.container_id)
+            if container_pool.is_pool_member(container):
+                raise docker.errors.NotFound(req.container_id)
         except docker.errors.NotFound:
             raise HTTPException(
                 status_code=404,
@@ -1205,6 +1571,7 @@ async def delete_container(
         # Remove container from database if it exists there
         if db_container:
             await db.docker_containers.delete_one({"container_id": container.id})
+        await port_allocator.release_container(container.id)
         
         return {
             "message": "Container deleted successfully",
@@ -1220,6 +1587,101 @@ async def delete_container(
             detail=f"Failed to delete container: {str(e)}"
         )
 
+# 6. Bulk start/stop/delete for many containers in one request
+@router.post("/containers/bulk")
+async def bulk_container_action(
+    req: DockerContainerBulkRequest,
+    user=Depends(get_current_user)
+):
+    """Apply start, stop or delete to a list of containers and report per-item results"""
+    if req.action not in BULK_CONTAINER_ACTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid action '{req.action}'. Supported actions: {', '.join(BULK_CONTAINER_ACTIONS)}"
+        )
+    if not req.container_ids:
+        raise HTTPException(status_code=400, detail="No container IDs provided")
+
+    client = get_docker_client()
+    # Drop duplicates but keep the caller's ordering for the results list
+    container_ids = list(dict.fromkeys(req.container_ids))
+
+    def apply_action(container_ref):
+        # Runs in a worker thread - the Docker SDK is blocking
+        container = client.containers.get(container_ref)
+        if container_pool.is_pool_member(container):
+            raise docker.errors.NotFound(container_ref)
+        if req.action == "start":
+            container.start()
+        elif req.action == "stop":
+            container.stop(timeout=req.timeout)
+        else:
+            container.remove(force=req.force)
+        return container.id, container.name
+
+    semaphore = asyncio.Semaphore(BULK_CONTAINER_CONCURRENCY)
+    loop = asyncio.get_event_loop()
+
+    async def run_one(container_ref):
+        async with semaphore:
+            try:
+                full_id, name = await loop.run_in_executor(None, apply_action, container_ref)
+                return {"container_id": full_id, "container_name": name, "requested": container_ref, "success": True}
+            except docker.errors.NotFound:
+                return {"requested": container_ref, "success": False, "status_code": 404,
+                        "error": f"Container '{container_ref}' not found"}
+            except docker.errors.APIError as e:
+                if req.action == "delete" and "running" in str(e).lower():
+                    return {"requested": container_ref, "success": False, "status_code": 400,
+                            "error": "Container is running. Stop it first or use force=true."}
+                return {"requested": container_ref, "success": False, "status_code": 500,
+                        "error": f"Docker API error: {str(e)}"}
+            except Exception as e:
+                return {"requested": container_ref, "success": False, "status_code": 500, "error": str(e)}
+
+    results = await asyncio.gather(*(run_one(ref) for ref in container_ids))
+
+    # One round trip for every status change instead of an update per container
+    now = datetime.utcnow()
+    operations = []
+    for result in results:
+        if not result["success"]:
+            continue
+        if req.action == "start":
+            operations.append(UpdateOne(
+                {"container_id": result["container_id"]},
+                {"$set": {"status": "running", "started_at": now}}
+            ))
+        elif req.action == "stop":
+            operations.append(UpdateOne(
+                {"container_id": result["container_id"]},
+                {"$set": {"status": "stopped", "stopped_at": now}}
+            ))
+        else:
+            operations.append(DeleteOne({"container_id": result["container_id"]}))
+            await port_allocator.release_container(result["container_id"])
+
+    db_error = None
+    if operations:
+        try:
+            await db.docker_containers.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # The Docker side already happened, so report rather than fail the request
+            print(f"🟠 Warning: Bulk container status update failed: {str(e)}")
+            db_error = str(e)
+
+    succeeded = sum(1 for r in results if r["success"])
+    response = {
+        "action": req.action,
+        "requested": len(container_ids),
+        "succeeded": succeeded,
+        "failed": len(container_ids) - succeeded,
+        "results": results
+    }
+    if db_error:
+        response["db_error"] = db_error
+    return response
+
 # 7. Search for local images
 @router.get("/image/search/local")#M
 async def search_local_images(
@@ -1535,6 +1997,20 @@ async def get_build_status(
             detail=f"Failed to get build status: {str(e)}"
         )
 
+@router.get("/builds")
+async def list_builds(limit: int = 50, user=Depends(get_current_user)):
+    """The user's build history, newest first; cache_hit marks builds that reused an existing image"""
+    builds = await db.docker_builds.find(
+        {"user_email": user["email"]},
+        {"logs": 0, "context_files": 0, "build_key": 0}
+    ).sort("queued_at", -1).limit(max(1, min(limit, 500))).to_list(None)
+    for build in builds:
+        build["_id"] = str(build["_id"])
+    return {
+        "builds": builds,
+        "cache_hits": sum(1 for build in builds if build.get("cache_hit"))
+    }
+
 # Add this new endpoint to get build logs
 @router.get("/build/{build_id}/logs")
 async def get_build_logs(
@@ -1607,19 +2083,12 @@ async def get_pull_status(
 async def list_dockerfiles(user=Depends(get_current_user)):
     """List all Dockerfiles created by the user"""
     try:
-        cursor = db.dockerfiles.find({"user_email": user["email"]})
+        cursor = db.dockerfiles.find({"user_email": user["email"]}, {"versions": 0})
         dockerfiles = []
         
         async for dockerfile in cursor:
             # Convert ObjectId to string for JSON serialization
             dockerfile["_id"] = str(dockerfile["_id"])
-            
-            # Check if the file still exists on disk
-            if os.path.exists(dockerfile["path"]):
-                dockerfile["exists"] = True
-            else:
-                dockerfile["exists"] = False
-                
             dockerfiles.append(dockerfile)
             
         return {"dockerfiles": dockerfiles}
@@ -1635,162 +2104,82 @@ async def update_dockerfile(
     req: DockerfileUpdateRequest,
     user=Depends(get_current_user)
 ):
-    """Update an existing Dockerfile with new content"""
+    """
+    Save new content for a Dockerfile as its next version.
+
+    The content, version counter and history change in one atomic update,
+    conditional on the version read here; pass expected_version to be told
+    (409) when someone else saved in between.
+    """
     try:
-        # Add detailed logging for troubleshooting
-        print(f"Updating dockerfile: {req.name} for user {user['email']}")
-        
         # Verify the user owns this Dockerfile
-        dockerfile = await db.dockerfiles.find_one({
-            "name": req.name,
-            "user_email": user["email"]
-        })
+        dockerfile = await db.dockerfiles.find_one(
+            {"name": req.name, "user_email": user["email"]},
+            {"versions": 0}
+        )
         
         if not dockerfile:
-            print(f"Dockerfile not found: {req.name} for user {user['email']}")
             raise HTTPException(
                 status_code=404,
                 detail=f"Dockerfile '{req.name}' not found or you don't have permission to modify it"
             )
-            
-        # Get the file path
-        dockerfile_path = dockerfile.get("path")
-        print(f"Dockerfile path from database: {dockerfile_path}")
-        
-        # Verify the path exists and is valid
-        if not dockerfile_path:
-            print(f"Dockerfile path is missing in database record")
-            
-            # Recreate the path consistently with how it's created in the create operation
-            dockerfiles_dir = get_dockerfiles_dir()
-            dockerfile_path = os.path.join(dockerfiles_dir, f"{req.name}.Dockerfile")
-            print(f"Recreated dockerfile path: {dockerfile_path}")
-            
-            # Update the path in the database for future operations
-            await db.dockerfiles.update_one(
-                {"name": req.name, "user_email": user["email"]},
-                {"$set": {"path": dockerfile_path}}
+        current_version = dockerfile.get("version")
+        if req.expected_version is not None and req.expected_version != (current_version or 0):
+            raise HTTPException(
+                status_code=409,
+                detail=f"Dockerfile '{req.name}' is at version {current_version}, not {req.expected_version}; reload it first"
             )
-            print(f"Updated path in database to: {dockerfile_path}")
-        
-        if not os.path.exists(os.path.dirname(dockerfile_path)):
-            print(f"Directory doesn't exist for path: {dockerfile_path}")
             
-            # Try to recreate the directory structure if it doesn't exist
-            try:
-                os.makedirs(os.path.dirname(dockerfile_path), exist_ok=True)
-                print(f"Created directory: {os.path.dirname(dockerfile_path)}")
-            except Exception as dir_error:
-                print(f"Error creating directory: {str(dir_error)}")
-        
         # Ensure the content is a valid string
-        if not isinstance(req.content, str):
-            print(f"Content is not a string type: {type(req.content)}")
-            content = str(req.content)
-        else:
-            content = req.content
-        
-        # Write the file using a completely new approach with explicit close
-        try:
-            print(f"Writing content to file: {dockerfile_path}")
-            
-            # Use a more direct file writing approach with explicit flush and close
-            with open(dockerfile_path, "w", encoding="utf-8") as f:
-                f.write(content)
-                f.flush()  # Force flush to disk
-                os.fsync(f.fileno())  # Force sync to filesystem
-            
-            print(f"Successfully wrote content to file: {dockerfile_path}")
-            
-            # Double-check the file was actually written by reading it back
-            if os.path.exists(dockerfile_path):
-                with open(dockerfile_path, "r", encoding="utf-8") as check:
-                    first_100 = check.read(100)
-                    print(f"File verification: First 100 chars: {first_100}")
-                    
-                    # Check if content length seems correct
-                    check.seek(0, os.SEEK_END)
-                    file_size = check.tell()
-                    print(f"File size after write: {file_size} bytes (expected approx. {len(content)} bytes)")
-                    
-                    if file_size < 10 and len(content) > 10:
-                        print("WARNING: File appears to be truncated!")
-            else:
-                print(f"ERROR: After writing, file does not exist at {dockerfile_path}")
-                
-            # Force a file close of any potentially open handles
-            import gc
-            gc.collect()
-                
-            # Try an alternative write method as a backup if something went wrong
-            if not os.path.exists(dockerfile_path) or os.path.getsize(dockerfile_path) < 10:
-                print("Using alternative file writing method...")
-                import io
-                with io.open(dockerfile_path, "w", encoding="utf-8", newline="\n") as f:
-                    f.write(content)
-                print("Alternative write completed")
-        except Exception as write_error:
-            print(f"Error writing to file: {str(write_error)}")
-            
-            # If standard open fails, try with absolute path and administrator privileges if available
-            try:
-                print("Attempting alternative write method with absolute path...")
-                absolute_path = os.path.abspath(dockerfile_path)
-                print(f"Absolute path: {absolute_path}")
-                
-                # Try writing to a temporary file and then moving it
-                temp_path = absolute_path + ".tmp"
-                with open(temp_path, "w", encoding="utf-8") as f:
-                    f.write(content)
-                
-                # Replace the original file with the temp file
-                import shutil
-                shutil.move(temp_path, absolute_path)
-                
-                print(f"Successfully wrote file using alternative method")
-            except Exception as second_write_error:
-                print(f"Second write attempt failed: {str(second_write_error)}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to write to file: {str(second_write_error)}"
-                )
+        content = req.content if isinstance(req.content, str) else str(req.content)
+        content_hash = dockerfile_hash(content)
+        if content_hash == dockerfile.get("content_hash") and req.description in (None, dockerfile.get("description")):
+            return {
+                "message": f"Dockerfile '{req.name}' is unchanged",
+                "version": current_version,
+                "updated_at": dockerfile["updated_at"]
+            }
         
-        # Update the database record
+        now = datetime.utcnow()
+        version = (current_version or 0) + 1
         update_data = {
             "content": content,
-            "updated_at": datetime.utcnow()
+            "content_hash": content_hash,
+            "version": version,
+            "updated_at": now
         }
         
         # Add description if provided
         if req.description is not None:
             update_data["description"] = req.description
         
-        try:
-            print(f"Updating database record for: {req.name}")
-            result = await db.dockerfiles.update_one(
-                {"name": req.name, "user_email": user["email"]},
-                {"$set": update_data}
-            )
-            
-            print(f"Database update result - matched: {result.matched_count}, modified: {result.modified_count}")
-            
-            if result.matched_count == 0:
-                print(f"No matching records found in database update")
-                raise HTTPException(
-                    status_code=404,
-                    detail="Dockerfile record not found in database"
-                )
-                
-            return {
-                "message": f"Dockerfile '{req.name}' updated successfully",
-                "updated_at": datetime.utcnow()
+        result = await db.dockerfiles.update_one(
+            {
+                "_id": dockerfile["_id"],
+                # Records from before versioning have no counter yet
+                "version": current_version if current_version is not None else {"$exists": False}
+            },
+            {
+                "$set": update_data,
+                "$push": {"versions": {
+                    "$each": [{"version": version, "content": content, "content_hash": content_hash, "created_at": now}],
+                    "$slice": -DOCKERFILE_MAX_VERSIONS
+                }}
             }
-        except Exception as db_error:
-            print(f"Database error: {str(db_error)}")
+        )
+        if result.matched_count == 0:
             raise HTTPException(
-                status_code=500,
-                detail=f"Database error: {str(db_error)}"
+                status_code=409,
+                detail=f"Dockerfile '{req.name}' was changed by another request; reload it and try again"
             )
+            
+        print(f"📝 Dockerfile {req.name} of {user['email']} saved as version {version}")
+        dockerfile_lint.lint_in_background(content_hash, content)
+        return {
+            "message": f"Dockerfile '{req.name}' updated successfully",
+            "version": version,
+            "updated_at": now
+        }
         
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -1824,10 +2213,8 @@ async def delete_dockerfile(
                 detail=f"Dockerfile '{req.name}' not found or you don't have permission to delete it"
             )
             
-        # Get the file path
+        # Records created before Mongo storage may still have a file in dockerfiles/
         dockerfile_path = dockerfile.get("path")
-        
-        # Delete the file from disk if it exists
         if dockerfile_path and os.path.exists(dockerfile_path):
             try:
                 os.remove(dockerfile_path)
@@ -1849,8 +2236,7 @@ async def delete_dockerfile(
             )
             
         return {
-            "message": f"Dockerfile '{req.name}' deleted successfully",
-            "deleted_from_disk": dockerfile_path and os.path.exists(dockerfile_path)
+            "message": f"Dockerfile '{req.name}' deleted successfully"
         }
         
     except HTTPException:
@@ -1861,27 +2247,52 @@ async def delete_dockerfile(
             detail=f"Failed to delete Dockerfile: {str(e)}"
         )
 
+@router.get("/dockerfile/{name}/versions")
+async def list_dockerfile_versions(name: str, user=Depends(get_current_user)):
+    """Saved versions of a Dockerfile, newest first (content omitted)"""
+    dockerfile = await db.dockerfiles.find_one(
+        {"name": name, "user_email": user["email"]},
+        {"version": 1, "versions.version": 1, "versions.content_hash": 1, "versions.created_at": 1}
+    )
+    if not dockerfile:
+        raise HTTPException(status_code=404, detail=f"Dockerfile '{name}' not found or you don't have permission to view it")
+    return {
+        "name": name,
+        "version": dockerfile.get("version"),
+        "versions": list(reversed(dockerfile.get("versions", [])))
+    }
+
 @router.get("/dockerfile/{name}")#3
 async def get_dockerfile(
     name: str,
+    version: Optional[int] = None,
     user=Depends(get_current_user)
 ):
-    """Get a Dockerfile by name"""
+    """Get a Dockerfile by name, at its latest or an earlier version"""
     try:
         # Verify the user owns this Dockerfile
-        dockerfile = await db.dockerfiles.find_one({
-            "name": name,
-            "user_email": user["email"]
-        })
+        projection = {"versions": {"$elemMatch": {"version": version}}} if version is not None else {"versions": 0}
+        dockerfile = await db.dockerfiles.find_one(
+            {"name": name, "user_email": user["email"]},
+            projection
+        )
         
         if not dockerfile:
             raise HTTPException(
                 status_code=404,
                 detail=f"Dockerfile '{name}' not found or you don't have permission to view it"
             )
+        if version is not None:
+            # An $elemMatch projection returns only the _id and the matched version
+            if not dockerfile.get("versions"):
+                raise HTTPException(status_code=404, detail=f"Version {version} of Dockerfile '{name}' is not in its history")
+            dockerfile = {"_id": dockerfile["_id"], "name": name, **dockerfile["versions"][0]}
             
         # Convert ObjectId to string for JSON serialization
         dockerfile["_id"] = str(dockerfile["_id"])
+        # Findings are normally ready from the save; older records are linted now
+        content_hash = dockerfile.get("content_hash") or dockerfile_hash(dockerfile.get("content", ""))
+        dockerfile["lint"] = await dockerfile_lint.lint_cached(content_hash, dockerfile.get("content", ""))
         
         return dockerfile
         
@@ -1906,24 +2317,14 @@ async def check_dockerfile_exists(
         if not safe_filename:
             raise HTTPException(status_code=400, detail="Invalid filename")
             
-        # Get the dockerfiles directory and ensure it exists
-        dockerfiles_dir = get_dockerfiles_dir()
-        
-        # Create the full path for the Dockerfile
-        dockerfile_path = os.path.join(dockerfiles_dir, f"{safe_filename}.Dockerfile")
-        
-        # Check if the file exists on disk
-        file_exists = os.path.exists(dockerfile_path)
-        
-        # Check if the file exists in the database for this user
+        # Check if the Dockerfile exists in the database for this user
         db_exists = await db.dockerfiles.find_one({
             "name": safe_filename,
             "user_email": user["email"]
-        }) is not None
+        }, {"_id": 1}) is not None
         
         return {
-            "exists": file_exists or db_exists,
-            "file_exists": file_exists,
+            "exists": db_exists,
             "database_exists": db_exists
         }
         
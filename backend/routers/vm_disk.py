@@ -1,16 +1,38 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
-import subprocess
-import shutil
+import asyncio
 import os
-from typing import Optional
+import re
+import time
+import uuid
+from typing import Optional, List
 from database import db
 from .auth import get_current_user
+from .billing import plans
 from datetime import datetime
 from bson.objectid import ObjectId
+from utils import host_pool
+from utils import disk_info as disk_info_tools
+from utils import disk_inventory, disk_transfer, storage_quota
+from utils.qemu_tools import get_store_dir, run_qemu_img, convert_args, parse_size
+from utils.qmp import QMPError
 
 router = APIRouter()
 
+def store_path(disk_name: str) -> str:
+    """Path of a disk in the store; rejects names that would escape it"""
+    if not disk_name or os.path.basename(disk_name) != disk_name:
+        raise HTTPException(status_code=400, detail=f"Invalid disk name '{disk_name}'")
+    return os.path.join(get_store_dir(), disk_name)
+
+def disk_quota_bytes(user) -> int:
+    """Storage the user's billing plan allows across all their disks (max_disk GB)"""
+    plan = next((p for p in plans if p["id"] == user.get("plan")), plans[0])
+    return plan["max_disk"] * 1024 ** 3
+
 # Request schema for disk creation
 class CreateDiskRequest(BaseModel):
     name: str       # Disk name (without extension)
@@ -18,13 +40,19 @@ class CreateDiskRequest(BaseModel):
     format: str     # Disk format: "qcow2", "raw", "vmdk", "vhdx", "vdi"
 
 class DiskInfoRequest(BaseModel):  # Request model for disk info
-    name: str  # e.g., "ubuntu_disk.qcow2"
+    name: Optional[str] = None          # e.g., "ubuntu_disk.qcow2"
+    names: Optional[List[str]] = None   # several disks in one call
 
 class ConvertDiskRequest(BaseModel):  # Request model for disk conversion
     source_name: str       # e.g., "ubuntu_disk.qcow2"
     source_format: str     # e.g., qcow2
     target_format: str     # e.g., raw
     target_name: str       # e.g., "ubuntu_disk.raw"
+    coroutines: Optional[int] = None        # qemu-img -m, parallel conversion coroutines (1-16)
+    out_of_order: Optional[bool] = None     # qemu-img -W; defaults to on for raw targets
+    compress: bool = False                  # qemu-img -c, qcow2 targets only
+    preallocation: Optional[str] = None     # off/metadata/falloc/full (qcow2), off/falloc/full (raw)
+    keep_source: bool = False               # keep the source disk instead of replacing it
 
 class ResizeDiskRequest(BaseModel):  # Request model for resizing disks
     name: str       # Disk filename e.g., "ubuntu_disk.qcow2"
@@ -34,25 +62,29 @@ class RenameDiskRequest(BaseModel):
     current_name: str       # Current disk filename (with extension)
     new_name: str           # New disk name (without extension)
 
+class CreateSnapshotRequest(BaseModel):
+    disk_name: str                      # qcow2 disk filename e.g., "ubuntu_disk.qcow2"
+    name: str                           # Snapshot name e.g., "before-upgrade"
+    description: Optional[str] = None
+
+class SnapshotActionRequest(BaseModel):
+    disk_name: str  # qcow2 disk filename
+    name: str       # Snapshot name
+
+# Snapshot names end up on qemu-img/QMP command lines
+SNAPSHOT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+# Every preset names the VM's disk drive disk0 (see QemuCommandBuilder)
+VM_DISK_DEVICE = "disk0"
+# Format qemu-img must detect for an imported file with this extension
+IMPORT_FORMATS = {".qcow2": "qcow2", ".raw": "raw", ".img": "raw", ".vmdk": "vmdk", ".vhdx": "vhdx", ".vdi": "vdi"}
+# Uploads with a chunk in progress; a second writer for the same disk is turned away
+_importing = set()
+
 @router.post("/create")#M
-def create_disk(req: CreateDiskRequest):
+async def create_disk(req: CreateDiskRequest, user=Depends(get_current_user)):
     """
     Creates a virtual disk image using qemu-img based on user input.
     """
-    # Step 1: Locate qemu-img executable
-    qemu_img_path = shutil.which("qemu-img")
-
-    # Fallback for Windows typical install path (if not in PATH)
-    if qemu_img_path is None:
-        default_windows_path = r"C:\Program Files\qemu\qemu-img.exe"
-        if os.path.exists(default_windows_path):
-            qemu_img_path = default_windows_path
-        else:
-            raise HTTPException(
-                status_code=500,
-                detail="❌ 'qemu-img' not found. Please install QEMU or set the correct path."
-            )
-
     # Validate disk format
     valid_formats = ["qcow2", "raw", "vmdk", "vhdx", "vdi"]
     if req.format not in valid_formats:
@@ -61,191 +93,181 @@ def create_disk(req: CreateDiskRequest):
             detail=f"Invalid disk format '{req.format}'. Supported formats: {', '.join(valid_formats)}"
         )
 
-    # Step 2: Construct the full disk path
+    # Construct the full disk path
     disk_filename = f"{req.name}.{req.format}"
-    project_base = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-    store_folder = os.path.join(project_base, "store")
-    os.makedirs(store_folder, exist_ok=True)
-    full_disk_path = os.path.join(store_folder, disk_filename)
-
-    print(f"📦 Creating virtual disk at: {full_disk_path}")
-
-    # Step 3: Build the qemu-img command
-    command = [
-        qemu_img_path, "create",
-        "-f", req.format,
-        full_disk_path,
-        req.size
-    ]
-
-    # Step 4: Run the command using subprocess
-    try:
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        print("✅ Command output:", result.stdout.strip())
-        print("⚠️  Command errors:", result.stderr.strip())
+    full_disk_path = store_path(disk_filename)
+    os.makedirs(get_store_dir(), exist_ok=True)
+    if os.path.exists(full_disk_path):
+        raise HTTPException(status_code=400, detail=f"A disk with name '{disk_filename}' already exists")
 
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr.strip())
+    # Hold the new disk's size against the plan's quota until it is indexed
+    async with storage_quota.reserve(user["email"], disk_quota_bytes(user), parse_size(req.size)):
+        print(f"📦 Creating virtual disk at: {full_disk_path}")
+        output = await run_qemu_img_async(["create", "-f", req.format, full_disk_path, req.size])
+        print("✅ Command output:", output.strip())
 
-        return {
-            "message": "✅ Virtual disk created successfully!",
-            "path": full_disk_path,
-            "format": req.format,
-            "size": req.size
-        }
+        # Index it right away so it shows up in /list with its owner
+        await disk_inventory.refresh_disk(disk_filename, user["email"])
+    return {
+        "message": "✅ Virtual disk created successfully!",
+        "path": full_disk_path,
+        "format": req.format,
+        "size": req.size
+    }
 
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=500,
-            detail="❌ qemu-img executable not found at runtime. Check installation."
-        )
+@router.get("/list")
+async def list_disks(user=Depends(get_current_user)):
+    """
+    List the user's disks from the disks collection.
 
-    except Exception as e:
-        print("💥 Unexpected error:", str(e))
-        raise HTTPException(status_code=500, detail=str(e))
+    Served from Mongo only; the inventory watcher and reconciler keep the
+    records in line with store/.
+    """
+    email = user["email"]
+    disks = []
+    cursor = db.disks.find({"$or": [{"owner_email": email}, {"attached_vms.user_email": email}]}).sort("_id", 1)
+    async for disk in cursor:
+        disk["name"] = disk.pop("_id")
+        disk["attached_vms"] = [vm for vm in disk.get("attached_vms", []) if vm["user_email"] == email]
+        disks.append(disk)
+    return {"disks": disks, "count": len(disks)}
 
 @router.post("/info")#M
-def disk_info(req: DiskInfoRequest):
-    """Get information about a disk image"""
-    # ensure qemu-img is available (or fallback)
-    exe = shutil.which("qemu-img")
-    if exe is None:
-        default_win = r"C:\Program Files\qemu\qemu-img.exe"
-        if os.path.exists(default_win):
-            exe = default_win
-        else:
-            raise HTTPException(status_code=500, detail="qemu-img not found. Install QEMU or adjust PATH.")
-    # resolve disk path
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-    store_dir = os.path.join(base_dir, "store")
-    disk_path = os.path.join(store_dir, req.name)
-    # check existence
-    if not os.path.exists(disk_path):
-        raise HTTPException(status_code=404, detail=f"Disk '{req.name}' not found in store.")
-    # prepare command
-    command = [exe, "info", disk_path]
-    try:
-        result = subprocess.run(command, capture_output=True, text=True)
-        # debug logs
-        print("✅ stdout:", result.stdout)
-        print("❌ stderr:", result.stderr)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
+async def disk_info(req: DiskInfoRequest):
+    """
+    Get information about one disk image (`name`) or many at once (`names`).
+
+    Probes use `qemu-img info --output=json` and are cached until the image's
+    mtime or size changes; a batch probes its uncached disks concurrently.
+    """
+    if req.names is None:
+        if not req.name:
+            raise HTTPException(status_code=400, detail="Provide 'name' or 'names'")
+        info = await disk_info_tools.get_disk_info(store_path(req.name))
         return {
             "message": "Disk info retrieved successfully ✅",
             "disk": req.name,
-            "info": result.stdout
+            "info": info.summary(req.name),
+            "details": info
         }
-    except Exception as e:
-        # catch any errors
-        raise HTTPException(status_code=500, detail=f"💥 {str(e)}")
+
+    async def probe(name):
+        try:
+            info = await disk_info_tools.get_disk_info(store_path(name))
+            return {"disk": name, "success": True, "info": info.summary(name), "details": info}
+        except HTTPException as e:
+            return {"disk": name, "success": False, "error": e.detail}
+
+    results = await asyncio.gather(*(probe(name) for name in dict.fromkeys(req.names)))
+    return {"message": "Disk info retrieved successfully ✅", "disks": results}
 
 @router.post("/convert")#K
 async def convert_disk(req: ConvertDiskRequest, user=Depends(get_current_user)):
-    """Convert a disk from one format to another"""
+    """
+    Convert a disk from one format to another.
+
+    qemu-img runs in a worker thread with the requested -m/-W/-c/preallocation
+    options. Unless keep_source is set the source is deleted afterwards and
+    the user's VMs are pointed at the new disk.
+    """
     # Prevent converting to the same disk/name
     if req.source_name == req.target_name:
         raise HTTPException(status_code=400, detail="Source and target disk names must differ")
-    # Locate qemu-img executable (or fallback to Windows path)
-    exe = shutil.which("qemu-img")
-    if exe is None:
-        default_path = r"C:\Program Files\qemu\qemu-img.exe"
-        if os.path.exists(default_path):
-            exe = default_path
-        else:
-            raise HTTPException(status_code=500, detail="❌ qemu-img not found. Install QEMU or adjust PATH.")
-
-    # Resolve input and output file paths
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-    store_dir = os.path.join(base_dir, "store")
-    input_path = os.path.join(store_dir, req.source_name)
+    input_path = store_path(req.source_name)
+    output_path = store_path(req.target_name)
     if not os.path.exists(input_path):
         raise HTTPException(status_code=404, detail=f"Source disk '{req.source_name}' not found.")
-    output_path = os.path.join(store_dir, req.target_name)
-
-    # Build qemu-img convert command
-    command = [
-        exe, "convert",
-        "-f", req.source_format,
-        "-O", req.target_format,
-        input_path,
-        output_path
-    ]
+    if os.path.exists(output_path):
+        raise HTTPException(status_code=400, detail=f"A disk with name '{req.target_name}' already exists")
+    if not await disk_inventory.user_owns_disk(req.source_name, user["email"]):
+        raise HTTPException(status_code=403, detail="This disk does not belong to you")
+    args = convert_args(input_path, req.source_format, output_path, req.target_format,
+                        req.coroutines, req.out_of_order, req.compress, req.preallocation)
 
+    # A kept source means a second disk of the same virtual size
+    source_size = (await disk_info_tools.get_disk_info(input_path)).virtual_size
+    reserved = source_size if req.keep_source else 0
+    started = time.perf_counter()
     try:
-        result = subprocess.run(command, capture_output=True, text=True)
-        # Log output for debugging
-        print("✅ stdout:", result.stdout)
-        print("❌ stderr:", result.stderr)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
+        async with storage_quota.reserve(user["email"], disk_quota_bytes(user), reserved):
+            await run_qemu_img_async(args)
+            elapsed = time.perf_counter() - started
+            disk_info_tools.invalidate(output_path)
+            await disk_inventory.refresh_disk(req.target_name, user["email"])
+    except HTTPException:
+        remove_quietly(output_path)
+        raise
+    print(f"🔁 Converted {req.source_name} -> {req.target_name} in {elapsed:.1f}s ({' '.join(args[:-2])})")
+
+    vms_updated = 0
+    if not req.keep_source:
         # Remove the original disk file to clean up old format
-        try:
-            os.remove(os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "store", req.source_name))
-        except Exception:
-            pass
+        remove_quietly(input_path)
+        disk_info_tools.invalidate(input_path)
         # Update database: change disk_name for all this user's VMs
         update_result = await db.vms.update_many(
             {"disk_name": req.source_name, "user_email": user["email"]},
             {"$set": {"disk_name": req.target_name}}
         )
-        return {
-            "message": "✅ Disk converted and database updated!",
-            "source": req.source_name,
-            "target": req.target_name,
-            "vms_updated": update_result.modified_count,
-            "info": result.stdout
-        }
-    except Exception as e:
-        # Handle conversion errors
-        raise HTTPException(status_code=500, detail=f"💥 {str(e)}")
+        vms_updated = update_result.modified_count
+        # qemu-img convert does not carry internal snapshots over
+        await db.disk_snapshots.delete_many({"disk_name": req.source_name})
+        await disk_inventory.remove_disk(req.source_name)
+        await disk_inventory.sync_attachments([req.target_name])
+    return {
+        "message": "✅ Disk converted and database updated!",
+        "source": req.source_name,
+        "target": req.target_name,
+        "vms_updated": vms_updated,
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_mb_s": round(source_size / 1024 ** 2 / elapsed, 1) if elapsed else None,
+        "options": args[1:-2]
+    }
 
 @router.post("/resize")#K
-def resize_disk(req: ResizeDiskRequest):
+async def resize_disk(req: ResizeDiskRequest, user=Depends(get_current_user)):
     """Resize a disk image"""
-    # Locate qemu-img executable
-    exe = shutil.which("qemu-img")
-    if exe is None:
-        default_win = r"C:\Program Files\qemu\qemu-img.exe"
-        if os.path.exists(default_win):
-            exe = default_win
-        else:
-            raise HTTPException(status_code=500, detail="❌ qemu-img not found. Install QEMU or adjust PATH.")
-
-    # Resolve disk path in store
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-    store_dir = os.path.join(base_dir, "store")
-    disk_path = os.path.join(store_dir, req.name)
+    disk_path = store_path(req.name)
     if not os.path.exists(disk_path):
         raise HTTPException(status_code=404, detail=f"Disk '{req.name}' not found in store.")
+    if not await disk_inventory.user_owns_disk(req.name, user["email"]):
+        raise HTTPException(status_code=403, detail="This disk does not belong to you")
 
-    # Build qemu-img resize command
-    command = [exe, "resize", disk_path, req.resize_by]
-    try:
-        result = subprocess.run(command, capture_output=True, text=True)
-        # Debug logs
-        print("✅ stdout:", result.stdout)
-        print("❌ stderr:", result.stderr)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
-        return {
-            "message": "✅ Disk resized successfully!",
-            "disk": req.name,
-            "resize_by": req.resize_by,
-            "info": result.stdout
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"💥 {str(e)}")
+    # Growth counts against the quota: "+5G" adds 5G, "20G" adds the difference to the current size
+    amount = req.resize_by.strip()
+    if amount.startswith("-"):
+        growth = 0
+    elif amount.startswith("+"):
+        growth = parse_size(amount[1:])
+    else:
+        record = await db.disks.find_one({"_id": req.name}, {"virtual_size": 1})
+        current = record["virtual_size"] if record else (await disk_info_tools.get_disk_info(disk_path)).virtual_size
+        growth = parse_size(amount) - current
+
+    async with storage_quota.reserve(user["email"], disk_quota_bytes(user), growth):
+        output = await run_qemu_img_async(["resize", disk_path, req.resize_by])
+        print("✅ stdout:", output)
+        disk_info_tools.invalidate(disk_path)
+        await disk_inventory.refresh_disk(req.name)
+    return {
+        "message": "✅ Disk resized successfully!",
+        "disk": req.name,
+        "resize_by": req.resize_by,
+        "info": output
+    }
+
+@router.get("/usage")
+async def storage_usage(user=Depends(get_current_user)):
+    """Storage the user's disks take up against their plan's quota"""
+    usage = await storage_quota.get_usage(user["email"])
+    return {**usage, "quota_bytes": disk_quota_bytes(user)}
 
 @router.post("/rename")
 async def rename_disk(req: RenameDiskRequest, user=Depends(get_current_user)):
     """Rename a disk and update all references"""
     try:
         # Resolve paths
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-        store_dir = os.path.join(base_dir, "store")
-        current_path = os.path.join(store_dir, req.current_name)
+        current_path = store_path(req.current_name)
         
         # Check if disk exists
         if not os.path.exists(current_path):
@@ -254,29 +276,27 @@ async def rename_disk(req: RenameDiskRequest, user=Depends(get_current_user)):
         # Extract extension from current name
         extension = os.path.splitext(req.current_name)[1]
         new_filename = f"{req.new_name}{extension}"
-        new_path = os.path.join(store_dir, new_filename)
+        new_path = store_path(new_filename)
         
         # Check if new name already exists
         if os.path.exists(new_path):
             raise HTTPException(status_code=400, detail=f"A disk with name '{new_filename}' already exists")
         
-        # Verify user owns VMs using this disk
-        vm_count = await db.vms.count_documents({
-            "user_email": user["email"],
-            "disk_name": req.current_name
-        })
-        
-        if vm_count == 0:
-            raise HTTPException(status_code=403, detail="No VMs found with this disk that belong to you")
+        # Verify user owns the disk or a VM using it
+        if not await disk_inventory.user_owns_disk(req.current_name, user["email"]):
+            raise HTTPException(status_code=403, detail="This disk does not belong to you")
         
         # Rename the file
         os.rename(current_path, new_path)
+        disk_info_tools.invalidate(current_path)
         
         # Update all VMs that use this disk
         update_result = await db.vms.update_many(
             {"disk_name": req.current_name, "user_email": user["email"]},
             {"$set": {"disk_name": new_filename}}
         )
+        await db.disk_snapshots.update_many({"disk_name": req.current_name}, {"$set": {"disk_name": new_filename}})
+        await disk_inventory.rename_disk(req.current_name, new_filename)
         
         return {
             "message": f"Disk renamed successfully from '{req.current_name}' to '{new_filename}'",
@@ -287,3 +307,302 @@ async def rename_disk(req: RenameDiskRequest, user=Depends(get_current_user)):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to rename disk: {str(e)}")
+
+def remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@router.get("/{disk_name}/export")
+async def export_disk(disk_name: str, format: str = "qcow2", compression: str = "zstd", user=Depends(get_current_user)):
+    """
+    Download a disk as compressed qcow2 (format=qcow2) or as a raw image
+    (format=raw), zstd-compressed unless compression=none.
+
+    Raw exports are read extent by extent with SEEK_DATA/SEEK_HOLE so holes
+    are never read from disk; memory use is bounded by the chunk size.
+    """
+    disk_path = store_path(disk_name)
+    if format not in ("qcow2", "raw"):
+        raise HTTPException(status_code=400, detail="format must be 'qcow2' or 'raw'")
+    if compression not in ("zstd", "none"):
+        raise HTTPException(status_code=400, detail="compression must be 'zstd' or 'none'")
+    if not await disk_inventory.user_owns_disk(disk_name, user["email"]):
+        raise HTTPException(status_code=403, detail="This disk does not belong to you")
+    if await db.vms.count_documents({"disk_name": disk_name, "status": "running"}, limit=1):
+        raise HTTPException(status_code=409, detail="Stop the VM using this disk before exporting it")
+    if format == "raw" and compression == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="zstd export needs the 'zstandard' package; use compression=none")
+
+    source_format = (await disk_info_tools.get_disk_info(disk_path)).format
+    stem = os.path.splitext(disk_name)[0]
+
+    if format == "qcow2":
+        # qcow2 output needs a seekable target, so it is built in scratch space first
+        export_path = os.path.join(disk_transfer.export_dir(), f"{uuid.uuid4().hex}.qcow2")
+        try:
+            await run_qemu_img_async(["convert", "-c", "-f", source_format, "-O", "qcow2", disk_path, export_path])
+        except HTTPException:
+            remove_quietly(export_path)
+            raise
+        return FileResponse(export_path, media_type="application/octet-stream", filename=f"{stem}.qcow2",
+                            background=BackgroundTask(remove_quietly, export_path))
+
+    raw_path, temporary = disk_path, False
+    if source_format != "raw":
+        # qemu-img writes zeros as holes, so the scratch copy stays sparse
+        raw_path, temporary = os.path.join(disk_transfer.export_dir(), f"{uuid.uuid4().hex}.raw"), True
+        try:
+            await run_qemu_img_async(["convert", "-f", source_format, "-O", "raw", disk_path, raw_path])
+        except HTTPException:
+            remove_quietly(raw_path)
+            raise
+
+    if compression == "none":
+        # Served with sendfile when the server supports zero-copy sends
+        return FileResponse(raw_path, media_type="application/octet-stream", filename=f"{stem}.raw",
+                            background=BackgroundTask(remove_quietly, raw_path) if temporary else None)
+    return StreamingResponse(
+        disk_transfer.iter_zstd_raw(raw_path, remove_after=temporary),
+        media_type="application/zstd",
+        headers={"Content-Disposition": f'attachment; filename="{stem}.raw.zst"'}
+    )
+
+async def get_upload(disk_name: str, user):
+    """The caller's in-progress import of a disk, or None"""
+    upload = await db.disk_uploads.find_one({"_id": disk_name})
+    if upload and upload["user_email"] != user["email"]:
+        raise HTTPException(status_code=409, detail=f"Another upload of '{disk_name}' is in progress")
+    return upload
+
+@router.get("/import/{disk_name}")
+async def import_status(disk_name: str, user=Depends(get_current_user)):
+    """Offset to resume an interrupted import from"""
+    store_path(disk_name)
+    upload = await get_upload(disk_name, user)
+    if upload is None:
+        raise HTTPException(status_code=404, detail=f"No upload in progress for '{disk_name}'")
+    return {"name": disk_name, "offset": upload["offset"], "updated_at": upload["updated_at"]}
+
+@router.post("/import")
+async def import_disk(request: Request, name: str, offset: int = 0, final: bool = False, user=Depends(get_current_user)):
+    """
+    Upload a disk image in chunks; the request body is the chunk.
+
+    Each chunk is written at `offset`, which must equal the bytes received so
+    far (GET /import/{name} reports it after an interruption). The chunk with
+    final=true validates the image and moves it into the store.
+    """
+    disk_path = store_path(name)
+    expected_format = IMPORT_FORMATS.get(os.path.splitext(name)[1])
+    if expected_format is None:
+        raise HTTPException(status_code=400, detail=f"Disk name must end with one of: {', '.join(IMPORT_FORMATS)}")
+    if int(request.headers.get("content-length") or 0) > disk_transfer.IMPORT_MAX_CHUNK_BYTES:
+        raise HTTPException(status_code=413, detail=f"Chunks are limited to {disk_transfer.IMPORT_MAX_CHUNK_BYTES} bytes")
+    if name in _importing:
+        raise HTTPException(status_code=409, detail=f"A chunk of '{name}' is already being uploaded")
+
+    _importing.add(name)
+    try:
+        upload = await get_upload(name, user)
+        if upload is None:
+            if offset != 0:
+                raise HTTPException(status_code=404, detail=f"No upload in progress for '{name}'; start at offset 0")
+            if os.path.exists(disk_path) or await db.disks.find_one({"_id": name}, {"_id": 1}):
+                raise HTTPException(status_code=400, detail=f"A disk with name '{name}' already exists")
+            upload = {"_id": name, "user_email": user["email"], "offset": 0,
+                      "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
+            await db.disk_uploads.insert_one(upload)
+        elif offset != upload["offset"]:
+            raise HTTPException(status_code=409, detail=f"Upload of '{name}' is at offset {upload['offset']}; resume from there")
+        # Stored bytes can't exceed what the quota has left (the virtual size is checked at the end)
+        usage = await storage_quota.get_usage(user["email"])
+        remaining = disk_quota_bytes(user) - usage["allocated_bytes"] - usage["reserved_bytes"]
+        if offset + int(request.headers.get("content-length") or 0) > remaining:
+            raise HTTPException(status_code=403, detail=f"Storage quota exceeded: {disk_info_tools.format_bytes(max(remaining, 0))} left")
+
+        part_path = os.path.join(disk_transfer.upload_dir(), name)
+        loop = asyncio.get_event_loop()
+        position, buffered, buffered_bytes = offset, [], 0
+        try:
+            async for chunk in request.stream():
+                buffered.append(chunk)
+                buffered_bytes += len(chunk)
+                if position + buffered_bytes - offset > disk_transfer.IMPORT_MAX_CHUNK_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Chunks are limited to {disk_transfer.IMPORT_MAX_CHUNK_BYTES} bytes")
+                # Chunked requests have no content-length, so the quota is also enforced as bytes arrive
+                if position + buffered_bytes > remaining:
+                    raise HTTPException(status_code=403, detail=f"Storage quota exceeded: {disk_info_tools.format_bytes(max(remaining, 0))} left")
+                if buffered_bytes >= disk_transfer.TRANSFER_CHUNK_BYTES:
+                    position = await loop.run_in_executor(None, disk_transfer.write_chunk, part_path, position, buffered)
+                    buffered, buffered_bytes = [], 0
+            if buffered:
+                position = await loop.run_in_executor(None, disk_transfer.write_chunk, part_path, position, buffered)
+        except ClientDisconnect:
+            # Keep what was written; the client resumes from the saved offset
+            final = False
+        finally:
+            await db.disk_uploads.update_one({"_id": name}, {"$set": {"offset": position, "updated_at": datetime.utcnow()}})
+
+        if not final:
+            return {"name": name, "offset": position}
+
+        # Validate before the file becomes visible in the store
+        info = await disk_info_tools.get_disk_info(part_path)
+        disk_info_tools.invalidate(part_path)
+        if info.format != expected_format:
+            raise HTTPException(status_code=400, detail=f"Uploaded image is {info.format}, expected {expected_format} for '{name}'")
+        if info.backing_file:
+            raise HTTPException(status_code=400, detail="Images with a backing file can't be imported")
+        if os.path.exists(disk_path):
+            raise HTTPException(status_code=400, detail=f"A disk with name '{name}' already exists")
+        async with storage_quota.reserve(user["email"], disk_quota_bytes(user), info.virtual_size):
+            os.rename(part_path, disk_path)
+            await db.disk_uploads.delete_one({"_id": name})
+            await disk_inventory.refresh_disk(name, user["email"])
+        print(f"📥 Imported disk {name} ({disk_info_tools.format_bytes(position)}) for {user['email']}")
+        return {
+            "message": "✅ Disk imported successfully!",
+            "name": name,
+            "format": info.format,
+            "virtual_size": info.virtual_size,
+            "offset": position
+        }
+    finally:
+        _importing.discard(name)
+
+@router.delete("/import/{disk_name}")
+async def cancel_import(disk_name: str, user=Depends(get_current_user)):
+    """Abandon an import and drop its partial file"""
+    store_path(disk_name)
+    if await get_upload(disk_name, user) is None or disk_name in _importing:
+        raise HTTPException(status_code=404, detail=f"No idle upload for '{disk_name}'")
+    remove_quietly(os.path.join(disk_transfer.upload_dir(), disk_name))
+    await db.disk_uploads.delete_one({"_id": disk_name})
+    return {"message": f"Upload of '{disk_name}' cancelled"}
+
+async def get_snapshot_disk(disk_name: str, user):
+    """
+    Resolve a qcow2 disk the user may snapshot.
+
+    Returns the disk path and the VM currently running on it (None when the
+    disk is idle and can be handled offline with qemu-img).
+    """
+    if os.path.basename(disk_name) != disk_name:
+        raise HTTPException(status_code=400, detail="Invalid disk name")
+    if not disk_name.endswith(".qcow2"):
+        raise HTTPException(status_code=400, detail="Snapshots need a qcow2 disk; convert the disk to qcow2 first")
+    if not await disk_inventory.user_owns_disk(disk_name, user["email"]):
+        raise HTTPException(status_code=403, detail="This disk does not belong to you")
+    vms = await db.vms.find({"disk_name": disk_name}, {"status": 1, "host_id": 1, "qmp_socket": 1}).to_list(None)
+    running = next((vm for vm in vms if vm.get("status") == "running"), None)
+    disk_path = os.path.join(get_store_dir(), disk_name)
+    if running is None and not os.path.exists(disk_path):
+        raise HTTPException(status_code=404, detail=f"Disk '{disk_name}' not found in store.")
+    return disk_path, running
+
+async def run_snapshot_qmp(vm, command: str, arguments: dict):
+    """Run a snapshot command through the QMP socket of the VM using the disk"""
+    if not vm.get("qmp_socket"):
+        raise HTTPException(status_code=409, detail="VM was started without a control socket; stop it to manage snapshots offline")
+    try:
+        return await host_pool.get_host(vm.get("host_id")).qmp(str(vm["_id"]), command, arguments)
+    except QMPError as e:
+        raise HTTPException(status_code=409, detail=f"QEMU refused {command}: {e.desc}")
+    except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=503, detail=f"VM control socket unavailable: {str(e)}")
+
+async def run_qemu_img_async(args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, run_qemu_img, args)
+
+@router.post("/snapshot")
+async def create_snapshot(req: CreateSnapshotRequest, user=Depends(get_current_user)):
+    """Take an internal qcow2 snapshot, live through QMP if a VM is running on the disk"""
+    if not SNAPSHOT_NAME_PATTERN.match(req.name):
+        raise HTTPException(status_code=400, detail="Snapshot names may use letters, digits, '.', '_' and '-' (max 64)")
+    disk_path, running = await get_snapshot_disk(req.disk_name, user)
+    if await db.disk_snapshots.find_one({"disk_name": req.disk_name, "name": req.name}):
+        raise HTTPException(status_code=400, detail=f"Snapshot '{req.name}' already exists on '{req.disk_name}'")
+
+    started = time.perf_counter()
+    if running:
+        await run_snapshot_qmp(running, "blockdev-snapshot-internal-sync", {"device": VM_DISK_DEVICE, "name": req.name})
+        method = "live"
+    else:
+        await run_qemu_img_async(["snapshot", "-c", req.name, disk_path])
+        disk_info_tools.invalidate(disk_path)
+        method = "offline"
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    snapshot = {
+        "disk_name": req.disk_name,
+        "name": req.name,
+        "description": req.description,
+        "user_email": user["email"],
+        "method": method,
+        "vm_id": str(running["_id"]) if running else None,
+        "created_at": datetime.utcnow()
+    }
+    result = await db.disk_snapshots.insert_one(snapshot)
+    print(f"📸 Snapshot '{req.name}' of {req.disk_name} taken {method} in {elapsed_ms} ms")
+    return {
+        "message": "✅ Snapshot created",
+        "id": str(result.inserted_id),
+        "disk_name": req.disk_name,
+        "name": req.name,
+        "method": method,
+        "elapsed_ms": elapsed_ms
+    }
+
+@router.get("/snapshot/list")
+async def list_snapshots(disk_name: str, user=Depends(get_current_user)):
+    """List snapshots of a disk from their Mongo metadata (no qemu-img call)"""
+    await get_snapshot_disk(disk_name, user)
+    snapshots = []
+    async for snapshot in db.disk_snapshots.find({"disk_name": disk_name}).sort("created_at", -1):
+        snapshot["id"] = str(snapshot.pop("_id"))
+        snapshots.append(snapshot)
+    return {"disk_name": disk_name, "snapshots": snapshots}
+
+@router.post("/snapshot/revert")
+async def revert_snapshot(req: SnapshotActionRequest, user=Depends(get_current_user)):
+    """Roll a stopped disk back to a snapshot in place (no copy)"""
+    disk_path, running = await get_snapshot_disk(req.disk_name, user)
+    if running:
+        # QMP can take and drop internal snapshots live, but not apply them
+        raise HTTPException(status_code=409, detail="Stop the VM using this disk before reverting it")
+    if not await db.disk_snapshots.find_one({"disk_name": req.disk_name, "name": req.name}):
+        raise HTTPException(status_code=404, detail=f"Snapshot '{req.name}' not found on '{req.disk_name}'")
+
+    started = time.perf_counter()
+    await run_qemu_img_async(["snapshot", "-a", req.name, disk_path])
+    disk_info_tools.invalidate(disk_path)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    await db.disk_snapshots.update_one(
+        {"disk_name": req.disk_name, "name": req.name},
+        {"$set": {"reverted_at": datetime.utcnow()}}
+    )
+    return {
+        "message": f"✅ Disk '{req.disk_name}' reverted to '{req.name}'",
+        "elapsed_ms": elapsed_ms
+    }
+
+@router.post("/snapshot/delete")
+async def delete_snapshot(req: SnapshotActionRequest, user=Depends(get_current_user)):
+    """Delete a snapshot, live through QMP if a VM is running on the disk"""
+    disk_path, running = await get_snapshot_disk(req.disk_name, user)
+    if not await db.disk_snapshots.find_one({"disk_name": req.disk_name, "name": req.name}):
+        raise HTTPException(status_code=404, detail=f"Snapshot '{req.name}' not found on '{req.disk_name}'")
+
+    if running:
+        await run_snapshot_qmp(running, "blockdev-snapshot-delete-internal-sync", {"device": VM_DISK_DEVICE, "name": req.name})
+    else:
+        await run_qemu_img_async(["snapshot", "-d", req.name, disk_path])
+        disk_info_tools.invalidate(disk_path)
+    await db.disk_snapshots.delete_one({"disk_name": req.disk_name, "name": req.name})
+    return {"message": f"✅ Snapshot '{req.name}' deleted", "disk_name": req.disk_name}
@@ -0,0 +1,72 @@
+from fastapi import APIRouter, HTTPException, Depends, Request
+import asyncio
+import os
+from database import db
+from .auth import get_current_user
+from utils import iso_library
+from utils.disk_transfer import TRANSFER_CHUNK_BYTES
+
+router = APIRouter()
+
+@router.post("/upload")
+async def upload_iso(request: Request, filename: str, user=Depends(get_current_user)):
+    """
+    Add an ISO to the user's library; the request body is the ISO.
+
+    The upload is hashed while it streams to disk and stored once per
+    SHA-256, so re-uploads of a known image only add it to the library.
+    Use the returned `iso_path` when creating a VM.
+    """
+    if not filename.lower().endswith(".iso") or os.path.basename(filename) != filename:
+        raise HTTPException(status_code=400, detail="Give the ISO's file name, e.g. ubuntu-24.04.iso")
+    if int(request.headers.get("content-length") or 0) > iso_library.ISO_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"ISOs are limited to {iso_library.ISO_MAX_BYTES} bytes")
+
+    loop = asyncio.get_event_loop()
+    writer = iso_library.IsoWriter()
+    try:
+        buffered, buffered_bytes = [], 0
+        async for chunk in request.stream():
+            buffered.append(chunk)
+            buffered_bytes += len(chunk)
+            if buffered_bytes >= TRANSFER_CHUNK_BYTES:
+                await loop.run_in_executor(None, writer.write, buffered)
+                buffered, buffered_bytes = [], 0
+        await loop.run_in_executor(None, writer.write, buffered)
+        if writer.size == 0:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        result = await iso_library.publish(writer, filename, user["email"])
+    except BaseException:
+        writer.discard()
+        raise
+
+    print(f"💿 ISO {filename} ({result['id'][:12]}) added for {user['email']}, deduplicated={result['deduplicated']}")
+    return {"message": "✅ ISO added to your library", **result}
+
+@router.get("/list")
+async def list_isos(user=Depends(get_current_user)):
+    """ISOs in the user's library"""
+    isos = []
+    async for iso in db.isos.find({"owners": user["email"]}).sort("filename", 1):
+        isos.append({
+            "id": iso["_id"],
+            "iso_path": iso_library.iso_ref(iso["_id"]),
+            "filename": iso["filename"],
+            "size": iso["size"],
+            "vms_using": iso.get("vm_refs", 0),
+            "created_at": iso["created_at"]
+        })
+    return {"isos": isos}
+
+@router.delete("/{iso_id}")
+async def remove_iso(iso_id: str, user=Depends(get_current_user)):
+    """
+    Remove an ISO from the user's library. The file is deleted by the GC once
+    no library and no VM references it.
+    """
+    if not iso_library.SHA256_PATTERN.match(iso_id):
+        raise HTTPException(status_code=400, detail="Invalid ISO id")
+    result = await db.isos.update_one({"_id": iso_id, "owners": user["email"]}, {"$pull": {"owners": user["email"]}})
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="ISO not found in your library")
+    return {"message": "ISO removed from your library", "id": iso_id}
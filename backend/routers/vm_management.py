@@ -1,22 +1,34 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, WebSocket, Query
 from pydantic import BaseModel
 import subprocess
-import shutil
+import asyncio
 import os
-from typing import Optional
+from typing import Optional, List
 from database import db
 from .auth import get_current_user
+from .billing import plans
 from datetime import datetime
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from utils.qemu_tools import get_store_dir, session_usage, check_preset, resolve_iso_path, DEFAULT_QEMU_PRESET, LEGACY_QEMU_PRESET
+from utils import vm_scheduler, host_pool, vnc_console, disk_inventory, iso_library
 
 router = APIRouter()
 
+# Host-capacity semaphore: bounds how many QEMU processes are spawned or torn down at once
+VM_PROCESS_CONCURRENCY = int(os.getenv("VM_PROCESS_CONCURRENCY", str(os.cpu_count() or 4)))
+vm_process_slots = asyncio.Semaphore(VM_PROCESS_CONCURRENCY)
+# How often the launch queue is re-checked for VMs that now fit
+VM_QUEUE_POLL_SECONDS = int(os.getenv("VM_QUEUE_POLL_SECONDS", "30"))
+
 class CreateVMRequest(BaseModel):  # Request model for creating a VM
     disk_name: str          # name of a disk file in store (e.g., "ubuntu_disk.qcow2")
-    iso_path: Optional[str] = None  # optional path to an ISO file
+    iso_path: Optional[str] = None  # library ISO ("iso:<sha256>" from /vm/iso/upload) or a server path
     memory_mb: int          # RAM in MB
     cpu_count: int          # number of CPUs
-    display: Optional[str] = "sdl"  # display type
+    display: Optional[str] = None  # display type; defaults to headless with a VNC console
+    preset: Optional[str] = None  # QEMU device preset: compat, balanced or performance
 
 class VMActionRequest(BaseModel):
     vm_id: str  # MongoDB ID for the VM
@@ -26,6 +38,7 @@ class UpdateVMResourcesRequest(BaseModel):
     vm_id: str            # MongoDB ID for the VM
     cpu_count: int        # New CPU count
     memory_mb: int        # New memory in MB
+    preset: Optional[str] = None  # New QEMU device preset (unchanged if omitted)
 
 class DeductCreditsRequest(BaseModel):
     vm_id: str       # ID of the VM
@@ -36,67 +49,214 @@ class DeleteVMRequest(BaseModel):
     vm_id: str  # MongoDB ID for the VM
     delete_disk: bool = True  # Whether to delete the associated disk file
 
+class BulkVMActionRequest(BaseModel):
+    vm_ids: List[str]  # MongoDB IDs of the VMs
+    include_iso: bool = False  # Only used when starting
+
+class BulkDeleteVMRequest(BaseModel):
+    vm_ids: List[str]  # MongoDB IDs of the VMs
+    delete_disk: bool = True  # Whether to delete disks no other VM uses
+
+async def fetch_user_vms(vm_ids, user_email):
+    """Load many of a user's VMs in one query; returns (vms_by_id, results for invalid ids)"""
+    object_ids = []
+    invalid = []
+    for vm_id in dict.fromkeys(vm_ids):
+        try:
+            object_ids.append(ObjectId(vm_id))
+        except (InvalidId, TypeError):
+            invalid.append({"vm_id": vm_id, "success": False, "error": "Invalid VM ID"})
+    vms = await db.vms.find({"_id": {"$in": object_ids}, "user_email": user_email}).to_list(None)
+    vms_by_id = {str(vm["_id"]): vm for vm in vms}
+    for oid in object_ids:
+        if str(oid) not in vms_by_id:
+            invalid.append({"vm_id": str(oid), "success": False, "error": "VM not found or doesn't belong to you"})
+    return vms_by_id, invalid
+
+def check_plan_limits(user, cpu_count, memory_mb):
+    """Reject VM sizes above the max_cpu/max_ram of the user's billing plan"""
+    plan = next((p for p in plans if p["id"] == user.get("plan")), plans[0])
+    if cpu_count > plan["max_cpu"]:
+        raise HTTPException(
+            status_code=403,
+            detail=f"{plan['name']} allows up to {plan['max_cpu']} CPUs per VM (requested {cpu_count})"
+        )
+    if memory_mb > plan["max_ram"] * 1024:
+        raise HTTPException(
+            status_code=403,
+            detail=f"{plan['name']} allows up to {plan['max_ram']}GB RAM per VM (requested {memory_mb} MB)"
+        )
+
+def check_host_fit(usages, cpu_count, memory_mb):
+    """Reject VM sizes no host could ever run, so they aren't queued forever"""
+    if not usages:
+        raise HTTPException(status_code=503, detail="No VM host is reachable")
+    if not host_pool.fits_cluster(usages, cpu_count, memory_mb):
+        raise HTTPException(
+            status_code=400,
+            detail=f"A VM with {cpu_count} CPUs and {memory_mb} MB RAM exceeds every host's capacity"
+        )
+
+async def stop_vm_process(vm):
+    """Terminate a VM's QEMU process on whichever host runs it"""
+    await host_pool.get_host(vm.get("host_id")).stop(vm["pid"])
+
+def launch_fields(launch):
+    """VM record fields describing a freshly spawned QEMU process"""
+    return {
+        "pid": launch["pid"],
+        "cgroup": launch.get("cgroup"),
+        "pinned_cpus": launch.get("cpus"),
+        "console_socket": launch.get("console"),
+        "qmp_socket": launch.get("qmp")
+    }
+
+async def queue_position(vm_id):
+    """1-based position of a queued VM and the estimated wait before it launches"""
+    vm = await db.vms.find_one({"_id": ObjectId(vm_id)}, {"queued_at": 1})
+    position = await db.vms.count_documents({"status": "queued", "queued_at": {"$lte": vm["queued_at"]}})
+    return {
+        "queue_position": position,
+        "estimated_wait_minutes": await vm_scheduler.estimate_wait_minutes(position)
+    }
+
+async def process_launch_queue():
+    """Launch queued VMs in FIFO order for as long as they fit on the host"""
+    async with vm_scheduler.admission_lock:
+        queued = await db.vms.find({"status": "queued"}).sort("queued_at", 1).to_list(None)
+        if not queued:
+            return 0
+        usages = await host_pool.get_cluster_usage()
+        launched = 0
+        for vm in queued:
+            # Strict FIFO: a large VM at the head is not starved by smaller ones behind it
+            host_id, reason = host_pool.place(usages, vm["cpu_count"], vm["memory_mb"])
+            if reason:
+                break
+            try:
+                launch = await host_pool.get_host(host_id).spawn(vm, vm.get("iso_included", False))
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                print(f"Failed to launch queued VM {vm['_id']}: {detail}")
+                await db.vms.update_one(
+                    {"_id": vm["_id"]},
+                    {"$set": {"status": "stopped", "queue_error": detail}, "$unset": {"queued_at": ""}}
+                )
+                continue
+            vm_scheduler.commit(usages[host_id], vm["cpu_count"], vm["memory_mb"])
+            start_time = datetime.utcnow()
+            await db.vms.update_one(
+                {"_id": vm["_id"]},
+                {
+                    "$set": {
+                        "status": "running",
+                        **launch_fields(launch),
+                        "host_id": host_id,
+                        "started_at": start_time,
+                        "restarted_at": start_time
+                    },
+                    "$unset": {"queued_at": "", "queue_reason": ""}
+                }
+            )
+            print(f"✅ Queued VM {vm['_id']} launched on {host_id} with PID {launch['pid']}")
+            launched += 1
+        return launched
+
+async def launch_queue_worker():
+    """Background loop that picks up capacity freed by guests shutting themselves down"""
+    while True:
+        await asyncio.sleep(VM_QUEUE_POLL_SECONDS)
+        try:
+            await process_launch_queue()
+        except Exception as e:
+            print(f"Launch queue check failed: {str(e)}")
+
 @router.post("/create")#M
 async def create_vm(req: CreateVMRequest, user=Depends(get_current_user)):
     """
     Launch a QEMU x86_64 VM using specified disk, ISO, memory, CPU, and display.
     """
-    # Locate qemu-system binary
-    exe = shutil.which("qemu-system-x86_64")
-    if exe is None:
-        default_path = r"C:\Program Files\qemu\qemu-system-x86_64.exe"
-        if os.path.exists(default_path):
-            exe = default_path
-        else:
-            raise HTTPException(status_code=500, detail="❌ qemu-system-x86_64 not found. Install QEMU or adjust PATH.")
-
-    # Resolve disk path
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-    store_dir = os.path.join(base_dir, "store")
-    disk_path = os.path.join(store_dir, req.disk_name)
-    if not os.path.exists(disk_path):
-        raise HTTPException(status_code=404, detail=f"Disk '{req.disk_name}' not found in store.")
-
-    # Build command args
-    cmd = [
-        exe,
-        "-drive", f"file={disk_path},format={'qcow2' if req.disk_name.endswith('.qcow2') else 'raw'}",
-        "-m", str(req.memory_mb),
-        "-smp", str(req.cpu_count),
-        "-display", req.display
-    ]
-    # Add ISO boot if provided
-    if req.iso_path:
-        if not os.path.exists(req.iso_path):
+    # Enforce the per-VM limits of the user's plan
+    check_plan_limits(user, req.cpu_count, req.memory_mb)
+    if req.preset:
+        check_preset(req.preset)
+
+    # Library ISOs ("iso:<sha256>") must be in the user's library
+    await iso_library.check_access(req.iso_path, user["email"])
+
+    # With only the local host the disk and ISO can be checked up front;
+    # host agents validate them against their own store at spawn time
+    if host_pool.local_only():
+        disk_path = os.path.join(get_store_dir(), req.disk_name)
+        if not os.path.exists(disk_path):
+            raise HTTPException(status_code=404, detail=f"Disk '{req.disk_name}' not found in store.")
+        if req.iso_path and not os.path.exists(resolve_iso_path(req.iso_path)):
             raise HTTPException(status_code=404, detail=f"ISO '{req.iso_path}' not found.")
-        cmd += ["-cdrom", req.iso_path, "-boot", "d"]
 
-    try:
-        # Launch VM process in background
-        process = subprocess.Popen(cmd)
-        # Record VM in database for this user
-        await db.vms.insert_one({
-            "user_email": user["email"],
-            "disk_name": req.disk_name,
-            "iso_path": req.iso_path,
-            "memory_mb": req.memory_mb,
-            "cpu_count": req.cpu_count,
-            "display": req.display,
-            "pid": process.pid,
-            "status": "running",
-            "started_at": datetime.utcnow(),
-            "created_at": datetime.utcnow()
-        })
-        print("✅ VM launched with PID", process.pid)
-        return {
-            "message": "✅ VM launched successfully",
-            "pid": process.pid
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"💥 {str(e)}")
+    vm_record = {
+        # Id assigned up front so the VM's cgroup can be named after it
+        "_id": ObjectId(),
+        "user_email": user["email"],
+        "disk_name": req.disk_name,
+        "iso_path": req.iso_path,
+        "memory_mb": req.memory_mb,
+        "cpu_count": req.cpu_count,
+        "display": req.display,
+        "qemu_preset": req.preset or DEFAULT_QEMU_PRESET,
+        "created_at": datetime.utcnow()
+    }
+
+    async with vm_scheduler.admission_lock:
+        usages = await host_pool.get_cluster_usage()
+        check_host_fit(usages, req.cpu_count, req.memory_mb)
+
+        # Pick a host, or queue the launch instead of overcommitting one
+        host_id, reason = host_pool.place(usages, req.cpu_count, req.memory_mb)
+        if reason:
+            vm_record.update({
+                "status": "queued",
+                "queued_at": datetime.utcnow(),
+                "queue_reason": reason,
+                "iso_included": bool(req.iso_path)
+            })
+            result = await db.vms.insert_one(vm_record)
+            await disk_inventory.sync_attachments([req.disk_name])
+            await iso_library.add_vm_refs([req.iso_path], 1)
+            return {
+                "message": "⏳ Host is at capacity, VM launch queued",
+                "vm_id": str(result.inserted_id),
+                "status": "queued",
+                "reason": reason,
+                **await queue_position(result.inserted_id)
+            }
+
+        try:
+            # Launch VM process in background on the chosen host
+            launch = await host_pool.get_host(host_id).spawn(vm_record, True)
+            pid = launch["pid"]
+            # Record VM in database for this user
+            vm_record.update({
+                **launch_fields(launch),
+                "host_id": host_id,
+                "status": "running",
+                "started_at": datetime.utcnow()
+            })
+            await db.vms.insert_one(vm_record)
+            await disk_inventory.sync_attachments([req.disk_name])
+            await iso_library.add_vm_refs([req.iso_path], 1)
+            print(f"✅ VM launched on {host_id} with PID", pid)
+            return {
+                "message": "✅ VM launched successfully",
+                "pid": pid,
+                "host_id": host_id
+            }
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"💥 {str(e)}")
 
 @router.post("/stop")#Molla
-async def stop_vm(req: VMActionRequest, user=Depends(get_current_user)):
+async def stop_vm(req: VMActionRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     """
     Stop a running VM
     """
@@ -110,23 +270,28 @@ async def stop_vm(req: VMActionRequest, user=Depends(get_current_user)):
         if vm.get("status") == "stopped":
             return {"message": "VM is already stopped"}
 
+        # A queued VM has no process yet - just take it out of the queue
+        if vm.get("status") == "queued":
+            await db.vms.update_one(
+                {"_id": ObjectId(req.vm_id)},
+                {"$set": {"status": "stopped"}, "$unset": {"queued_at": "", "queue_reason": ""}}
+            )
+            return {"message": "Queued VM launch cancelled", "status": "stopped"}
+
         # Get PID
         pid = vm.get("pid")
         if not pid:
             raise HTTPException(status_code=400, detail="VM has no associated process ID")
 
+        # Freed capacity may let queued VMs start once this request completes
+        background_tasks.add_task(process_launch_queue)
+
         try:
-            # On Windows, use taskkill
-            if os.name == 'nt':
-                subprocess.run(["taskkill", "/F", "/PID", str(pid)], check=True)
-            # On Unix-like, use kill
-            else:
-                import signal
-                os.kill(pid, signal.SIGTERM)
+            # taskkill on Windows, SIGTERM on Unix-like systems
+            await stop_vm_process(vm)
                 
-            # Allow time for graceful shutdown
-            import time
-            time.sleep(1)
+            # Allow time for graceful shutdown without blocking the event loop
+            await asyncio.sleep(1)
             
             # Get the stop time and calculate runtime
             stop_time = datetime.utcnow()
@@ -134,21 +299,11 @@ async def stop_vm(req: VMActionRequest, user=Depends(get_current_user)):
             
             # Calculate runtime if we have a start time
             if vm.get("started_at"):
-                start_time = vm["started_at"]
-                runtime_seconds = (stop_time - start_time).total_seconds()
-                runtime_minutes = runtime_seconds / 60
-                
                 # Compute costs for this session based on VM resources
-                # Use the same constants as frontend for consistency
-                BASE_COST = 0.5
-                CPU_COST = 0.2
-                RAM_COST = 0.1
-                
-                hourly_rate = BASE_COST + (vm["cpu_count"] * CPU_COST) + ((vm["memory_mb"] / 1024) * RAM_COST)
-                session_cost = hourly_rate * (runtime_minutes / 60)
-                
-                # Round to 2 decimal places
-                session_cost = round(session_cost, 2)
+                usage = session_usage(vm, stop_time)
+                runtime_minutes = usage["runtime_minutes"]
+                hourly_rate = usage["hourly_rate"]
+                session_cost = usage["session_cost"]
                 
                 # Deduct credits for ALL users (removed the plan check)
                 user_info = await db.users.find_one({"email": user["email"]})
@@ -205,7 +360,7 @@ async def stop_vm(req: VMActionRequest, user=Depends(get_current_user)):
             
             return {"message": "VM stopped successfully", "status": "stopped"}
             
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, ProcessLookupError):
             # Process likely no longer exists
             await db.vms.update_one(
                 {"_id": ObjectId(req.vm_id)},
@@ -230,47 +385,40 @@ async def start_vm(req: VMActionRequest, user=Depends(get_current_user)):
             raise HTTPException(status_code=404, detail="VM not found or doesn't belong to you")
             
         # Check if already running
+        if vm.get("status") == "queued":
+            return {"message": "VM is already queued for launch", "status": "queued", **await queue_position(req.vm_id)}
         if vm.get("status") != "stopped":
             return {"message": "VM is already running"}
+
+        # Enforce the per-VM limits of the user's plan
+        check_plan_limits(user, vm["cpu_count"], vm["memory_mb"])
             
-        # Locate qemu-system binary
-        exe = shutil.which("qemu-system-x86_64")
-        if exe is None:
-            default_path = r"C:\Program Files\qemu\qemu-system-x86_64.exe"
-            if os.path.exists(default_path):
-                exe = default_path
-            else:
-                raise HTTPException(status_code=500, detail="qemu-system-x86_64 not found. Install QEMU or adjust PATH.")
-                
-        # Resolve disk path
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-        store_dir = os.path.join(base_dir, "store")
-        disk_path = os.path.join(store_dir, vm["disk_name"])
-        
-        if not os.path.exists(disk_path):
-            raise HTTPException(status_code=404, detail=f"Disk '{vm['disk_name']}' not found in store.")
-            
-        # Build command args
-        cmd = [
-            exe,
-            "-drive", f"file={disk_path},format={'qcow2' if vm['disk_name'].endswith('.qcow2') else 'raw'}",
-            "-m", str(vm["memory_mb"]),
-            "-smp", str(vm["cpu_count"]),
-            "-display", vm["display"]
-        ]
-        
-        # Add ISO if specified and user wants it included
-        if vm.get("iso_path") and req.include_iso:
-            if os.path.exists(vm["iso_path"]):
-                cmd += ["-cdrom", vm["iso_path"], "-boot", "d"]
-                print(f"Including ISO: {vm['iso_path']}")
-            else:
-                print(f"ISO file not found: {vm['iso_path']}")
-        else:
-            print("Starting VM without ISO")
-                
-        # Launch VM
-        process = subprocess.Popen(cmd)
+        async with vm_scheduler.admission_lock:
+            usages = await host_pool.get_cluster_usage()
+            check_host_fit(usages, vm["cpu_count"], vm["memory_mb"])
+
+            # Pick a host, or queue the launch instead of overcommitting one
+            host_id, reason = host_pool.place(usages, vm["cpu_count"], vm["memory_mb"])
+            if reason:
+                await db.vms.update_one(
+                    {"_id": ObjectId(req.vm_id)},
+                    {"$set": {
+                        "status": "queued",
+                        "queued_at": datetime.utcnow(),
+                        "queue_reason": reason,
+                        "iso_included": req.include_iso
+                    }}
+                )
+                return {
+                    "message": "Host is at capacity, VM launch queued",
+                    "status": "queued",
+                    "reason": reason,
+                    **await queue_position(req.vm_id)
+                }
+
+            # Launch VM on the chosen host
+            launch = await host_pool.get_host(host_id).spawn(vm, req.include_iso)
+            pid = launch["pid"]
         
         # Get the current time for runtime tracking
         start_time = datetime.utcnow()
@@ -281,7 +429,8 @@ async def start_vm(req: VMActionRequest, user=Depends(get_current_user)):
             {
                 "$set": {
                     "status": "running",
-                    "pid": process.pid,
+                    **launch_fields(launch),
+                    "host_id": host_id,
                     "started_at": start_time,
                     "restarted_at": start_time,
                     "iso_included": req.include_iso
@@ -292,10 +441,13 @@ async def start_vm(req: VMActionRequest, user=Depends(get_current_user)):
         return {
             "message": "VM started successfully",
             "status": "running",
-            "pid": process.pid,
+            "pid": pid,
+            "host_id": host_id,
             "iso_included": req.include_iso
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to start VM: {str(e)}")
 
@@ -313,23 +465,28 @@ async def update_vm_resources(req: UpdateVMResourcesRequest, user=Depends(get_cu
         # Check if VM is running (we can't update resources of a running VM)
         if vm.get("status") != "stopped":
             raise HTTPException(status_code=400, detail="VM must be stopped before updating resources")
+
+        # Enforce the per-VM limits of the user's plan
+        check_plan_limits(user, req.cpu_count, req.memory_mb)
+        if req.preset:
+            check_preset(req.preset)
         
+        updates = {
+            "cpu_count": req.cpu_count,
+            "memory_mb": req.memory_mb,
+            "updated_at": datetime.utcnow()
+        }
+        if req.preset:
+            updates["qemu_preset"] = req.preset
+
         # Update VM in database
-        await db.vms.update_one(
-            {"_id": ObjectId(req.vm_id)},
-            {
-                "$set": {
-                    "cpu_count": req.cpu_count,
-                    "memory_mb": req.memory_mb,
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
+        await db.vms.update_one({"_id": ObjectId(req.vm_id)}, {"$set": updates})
         
         return {
             "message": "VM resources updated successfully",
             "cpu_count": req.cpu_count,
-            "memory_mb": req.memory_mb
+            "memory_mb": req.memory_mb,
+            "preset": req.preset or vm.get("qemu_preset") or LEGACY_QEMU_PRESET
         }
         
     except HTTPException:
@@ -406,7 +563,7 @@ async def deduct_credits(req: DeductCreditsRequest, user=Depends(get_current_use
         raise HTTPException(status_code=500, detail=f"Credit deduction error: {str(e)}")
 
 @router.post("/delete")#3
-async def delete_vm(req: DeleteVMRequest, user=Depends(get_current_user)):
+async def delete_vm(req: DeleteVMRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     """
     Delete a VM and optionally its associated disk file
     """
@@ -418,15 +575,12 @@ async def delete_vm(req: DeleteVMRequest, user=Depends(get_current_user)):
 
         # If VM is still running, stop it first
         if vm.get("status") == "running":
+            background_tasks.add_task(process_launch_queue)
             pid = vm.get("pid")
             if pid:
                 try:
                     # Stop the process
-                    if os.name == 'nt':
-                        subprocess.run(["taskkill", "/F", "/PID", str(pid)], check=True)
-                    else:
-                        import signal
-                        os.kill(pid, signal.SIGTERM)
+                    await stop_vm_process(vm)
                 except Exception as e:
                     print(f"Failed to stop VM process: {str(e)}")
                     # Continue with deletion even if stopping fails
@@ -449,16 +603,21 @@ async def delete_vm(req: DeleteVMRequest, user=Depends(get_current_user)):
                 
                 # Only delete if this was the only VM using it
                 if disk_usage_count == 0:
-                    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
-                    store_dir = os.path.join(base_dir, "store")
-                    disk_path = os.path.join(store_dir, disk_name)
+                    disk_path = os.path.join(get_store_dir(), disk_name)
                     
                     if os.path.exists(disk_path):
                         os.remove(disk_path)
                         disk_deleted = True
+                        await db.disk_snapshots.delete_many({"disk_name": disk_name})
             except Exception as e:
                 print(f"Failed to delete disk file: {str(e)}")
                 # Continue even if disk deletion fails
+        if delete_result.deleted_count:
+            await iso_library.add_vm_refs([vm.get("iso_path")], -1)
+        if disk_deleted:
+            await disk_inventory.remove_disk(disk_name)
+        else:
+            await disk_inventory.sync_attachments([disk_name])
         
         return {
             "message": "VM deleted successfully",
@@ -484,3 +643,309 @@ async def list_user_vms(user=Depends(get_current_user)):
         return {"vms": vms}
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to fetch VMs: " + str(e))
+
+@router.post("/bulk/start")
+async def bulk_start_vms(req: BulkVMActionRequest, user=Depends(get_current_user)):
+    """
+    Start many stopped VMs concurrently and report the outcome for each one
+    """
+    vms_by_id, results = await fetch_user_vms(req.vm_ids, user["email"])
+
+    async def start_one(vm_id, vm, admitted):
+        if vm.get("status") == "queued":
+            return {"vm_id": vm_id, "success": True, "status": "queued", "message": "VM is already queued for launch"}
+        if vm.get("status") != "stopped":
+            return {"vm_id": vm_id, "success": True, "status": vm.get("status"), "message": "VM is already running"}
+        if not admitted["ok"]:
+            return {"vm_id": vm_id, **admitted["result"]}
+        async with vm_process_slots:
+            try:
+                launch = await host_pool.get_host(admitted["host_id"]).spawn(vm, req.include_iso)
+                return {"vm_id": vm_id, "success": True, "status": "running", **launch_fields(launch),
+                        "host_id": admitted["host_id"]}
+            except HTTPException as e:
+                return {"vm_id": vm_id, "success": False, "error": e.detail}
+            except Exception as e:
+                return {"vm_id": vm_id, "success": False, "error": f"Failed to start VM: {str(e)}"}
+
+    async with vm_scheduler.admission_lock:
+        # Admit VMs in request order against one capacity snapshot
+        usages = await host_pool.get_cluster_usage()
+        admissions = {}
+        queued = []
+        for vm_id, vm in vms_by_id.items():
+            if vm.get("status") != "stopped":
+                admissions[vm_id] = {"ok": False}
+                continue
+            try:
+                check_plan_limits(user, vm["cpu_count"], vm["memory_mb"])
+                check_host_fit(usages, vm["cpu_count"], vm["memory_mb"])
+            except HTTPException as e:
+                admissions[vm_id] = {"ok": False, "result": {"success": False, "error": e.detail}}
+                continue
+            host_id, reason = host_pool.place(usages, vm["cpu_count"], vm["memory_mb"])
+            if reason:
+                queued.append((vm["_id"], reason))
+                admissions[vm_id] = {"ok": False, "result": {"success": True, "status": "queued", "reason": reason}}
+            else:
+                vm_scheduler.commit(usages[host_id], vm["cpu_count"], vm["memory_mb"])
+                admissions[vm_id] = {"ok": True, "host_id": host_id}
+
+        if queued:
+            # Each VM keeps the reason it was queued for, as a single start records it
+            queued_at = datetime.utcnow()
+            await db.vms.bulk_write([
+                UpdateOne(
+                    {"_id": _id},
+                    {"$set": {
+                        "status": "queued",
+                        "queued_at": queued_at,
+                        "queue_reason": reason,
+                        "iso_included": req.include_iso
+                    }}
+                )
+                for _id, reason in queued
+            ], ordered=False)
+
+        outcomes = await asyncio.gather(*(
+            start_one(vm_id, vm, admissions[vm_id]) for vm_id, vm in vms_by_id.items()
+        ))
+
+    start_time = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": ObjectId(outcome["vm_id"])},
+            {"$set": {
+                "status": "running",
+                "pid": outcome["pid"],
+                "cgroup": outcome["cgroup"],
+                "pinned_cpus": outcome["pinned_cpus"],
+                "console_socket": outcome["console_socket"],
+                "qmp_socket": outcome["qmp_socket"],
+                "host_id": outcome["host_id"],
+                "started_at": start_time,
+                "restarted_at": start_time,
+                "iso_included": req.include_iso
+            }}
+        )
+        for outcome in outcomes if outcome.get("pid")
+    ]
+    if operations:
+        await db.vms.bulk_write(operations, ordered=False)
+
+    results.extend(outcomes)
+    return {
+        "requested": len(req.vm_ids),
+        "started": len(operations),
+        "queued": len(queued),
+        "results": results
+    }
+
+@router.post("/bulk/stop")
+async def bulk_stop_vms(req: BulkVMActionRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+    """
+    Stop many running VMs concurrently and bill all finished sessions in one batch
+    """
+    vms_by_id, results = await fetch_user_vms(req.vm_ids, user["email"])
+
+    async def stop_one(vm_id, vm):
+        if vm.get("status") == "stopped":
+            return {"vm_id": vm_id, "success": True, "status": "stopped", "message": "VM is already stopped"}
+        if vm.get("status") == "queued":
+            return {"vm_id": vm_id, "success": True, "status": "stopped", "message": "Queued VM launch cancelled"}
+        pid = vm.get("pid")
+        if not pid:
+            return {"vm_id": vm_id, "success": False, "error": "VM has no associated process ID"}
+        async with vm_process_slots:
+            try:
+                await stop_vm_process(vm)
+                return {"vm_id": vm_id, "success": True, "status": "stopped", "billable": True}
+            except (subprocess.CalledProcessError, ProcessLookupError):
+                # Process likely no longer exists
+                return {"vm_id": vm_id, "success": True, "status": "stopped",
+                        "message": "VM process no longer running, status updated"}
+            except Exception as e:
+                return {"vm_id": vm_id, "success": False, "error": f"Failed to stop VM: {str(e)}"}
+
+    outcomes = await asyncio.gather(*(stop_one(vm_id, vm) for vm_id, vm in vms_by_id.items()))
+
+    # One shared grace period for every VM rather than a second per VM
+    if any(outcome.get("billable") for outcome in outcomes):
+        await asyncio.sleep(1)
+
+    stop_time = datetime.utcnow()
+    vm_operations = []
+    ledger = []
+    for outcome in outcomes:
+        if not outcome["success"] or outcome.get("message") == "VM is already stopped":
+            continue
+        vm = vms_by_id[outcome["vm_id"]]
+        update = {"$set": {"status": "stopped", "stopped_at": stop_time}}
+        if vm.get("status") == "queued":
+            update = {"$set": {"status": "stopped"}, "$unset": {"queued_at": "", "queue_reason": ""}}
+        if outcome.pop("billable", False) and vm.get("started_at"):
+            usage = session_usage(vm, stop_time)
+            update["$inc"] = {"total_runtime_minutes": usage["runtime_minutes"]}
+            outcome["runtime_minutes"] = usage["runtime_minutes"]
+            outcome["session_cost"] = usage["session_cost"]
+            ledger.append({
+                "user_email": user["email"],
+                "vm_id": outcome["vm_id"],
+                "disk_name": vm["disk_name"],
+                "action": "vm_usage",
+                "cost": usage["session_cost"],
+                "runtime_minutes": usage["runtime_minutes"],
+                "timestamp": stop_time,
+                "details": {
+                    "cpu": vm["cpu_count"],
+                    "ram_gb": vm["memory_mb"] / 1024,
+                    "hourly_rate": usage["hourly_rate"]
+                }
+            })
+        vm_operations.append(UpdateOne({"_id": vm["_id"]}, update))
+
+    total_cost = round(sum(entry["cost"] for entry in ledger), 2)
+    if ledger:
+        user_info = await db.users.find_one({"email": user["email"]})
+        if user_info:
+            await db.users.update_one(
+                {"email": user["email"]},
+                {"$set": {"credits": max(0, user_info.get("credits", 0) - total_cost)}}
+            )
+            await db.billing.insert_many(ledger)
+    if vm_operations:
+        await db.vms.bulk_write(vm_operations, ordered=False)
+        # Freed capacity may let queued VMs start once this request completes
+        background_tasks.add_task(process_launch_queue)
+
+    results.extend(outcomes)
+    return {
+        "requested": len(req.vm_ids),
+        "stopped": len(vm_operations),
+        "total_cost": total_cost,
+        "results": results
+    }
+
+@router.post("/bulk/delete")
+async def bulk_delete_vms(req: BulkDeleteVMRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+    """
+    Delete many VMs, stopping running ones concurrently and removing disks no other VM uses
+    """
+    vms_by_id, results = await fetch_user_vms(req.vm_ids, user["email"])
+
+    async def stop_if_running(vm):
+        if vm.get("status") == "running" and vm.get("pid"):
+            async with vm_process_slots:
+                try:
+                    await stop_vm_process(vm)
+                except Exception as e:
+                    # Continue with deletion even if stopping fails
+                    print(f"Failed to stop VM process: {str(e)}")
+
+    await asyncio.gather(*(stop_if_running(vm) for vm in vms_by_id.values()))
+
+    delete_result = await db.vms.delete_many({"_id": {"$in": [vm["_id"] for vm in vms_by_id.values()]}})
+    await iso_library.add_vm_refs((vm.get("iso_path") for vm in vms_by_id.values()), -1)
+    background_tasks.add_task(process_launch_queue)
+
+    # Only delete disks that no remaining VM of this user still references
+    deleted_disks = set()
+    if req.delete_disk:
+        disk_names = {vm["disk_name"] for vm in vms_by_id.values() if vm.get("disk_name")}
+        still_used = set(await db.vms.distinct("disk_name", {
+            "disk_name": {"$in": list(disk_names)},
+            "user_email": user["email"]
+        }))
+        store_dir = get_store_dir()
+        for disk_name in disk_names - still_used:
+            disk_path = os.path.join(store_dir, disk_name)
+            try:
+                if os.path.exists(disk_path):
+                    os.remove(disk_path)
+                    deleted_disks.add(disk_name)
+            except Exception as e:
+                print(f"Failed to delete disk file: {str(e)}")
+
+    if deleted_disks:
+        await db.disk_snapshots.delete_many({"disk_name": {"$in": list(deleted_disks)}})
+    for disk_name in deleted_disks:
+        await disk_inventory.remove_disk(disk_name)
+    await disk_inventory.sync_attachments(vm.get("disk_name") for vm in vms_by_id.values() if vm.get("disk_name") not in deleted_disks)
+
+    for vm_id, vm in vms_by_id.items():
+        results.append({
+            "vm_id": vm_id,
+            "success": True,
+            "disk_name": vm.get("disk_name"),
+            "disk_deleted": vm.get("disk_name") in deleted_disks
+        })
+    return {
+        "requested": len(req.vm_ids),
+        "vms_deleted": delete_result.deleted_count,
+        "results": results
+    }
+
+@router.get("/queue")
+async def list_queued_vms(user=Depends(get_current_user)):
+    """List the current user's VMs waiting for host capacity"""
+    try:
+        queued = []
+        async for vm in db.vms.find({"status": "queued", "user_email": user["email"]}).sort("queued_at", 1):
+            vm["id"] = str(vm.pop("_id"))
+            vm.update(await queue_position(vm["id"]))
+            queued.append(vm)
+        return {"queued": queued}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch launch queue: {str(e)}")
+
+@router.get("/capacity")
+async def host_capacity(user=Depends(get_current_user)):
+    """Committed vs. available CPU and memory of every VM host, used for admission control"""
+    usages = await host_pool.get_cluster_usage()
+    return {
+        "hosts": {
+            host_id: {
+                **usage,
+                "cpu_capacity": vm_scheduler.cpu_capacity(usage),
+                "memory_capacity_mb": vm_scheduler.memory_capacity_mb(usage)
+            }
+            for host_id, usage in usages.items()
+        },
+        "unreachable_hosts": [host_id for host_id in host_pool.hosts if host_id not in usages],
+        "cpu_overcommit_ratio": vm_scheduler.CPU_OVERCOMMIT_RATIO,
+        "ram_overcommit_ratio": vm_scheduler.RAM_OVERCOMMIT_RATIO,
+        "queued_vms": await db.vms.count_documents({"status": "queued"})
+    }
+
+@router.websocket("/{vm_id}/console")
+async def vm_console(websocket: WebSocket, vm_id: str, token: str = Query(...)):
+    """
+    Websocket VNC console of a running headless VM (connect noVNC here).
+
+    Browsers can't set headers on websockets, so the JWT comes as ?token=.
+    """
+    await vnc_console.accept(websocket)
+    try:
+        user = await get_current_user(token)
+        vm = await db.vms.find_one({"_id": ObjectId(vm_id), "user_email": user["email"]})
+    except (HTTPException, InvalidId):
+        await websocket.close(code=1008)
+        return
+    if not vm or vm.get("status") != "running" or not vm.get("console_socket"):
+        await websocket.close(code=vnc_console.CLOSE_UNAVAILABLE, reason="VM is not running with a console")
+        return
+
+    rejection = vnc_console.limiter.acquire(vm_id)
+    if rejection:
+        await websocket.close(code=vnc_console.CLOSE_TRY_AGAIN, reason=rejection)
+        return
+    try:
+        try:
+            upstream = await host_pool.get_host(vm.get("host_id")).open_console(vm_id)
+        except Exception as e:
+            print(f"Console for VM {vm_id} unavailable: {str(e)}")
+            await websocket.close(code=vnc_console.CLOSE_UNAVAILABLE, reason="Console unavailable")
+            return
+        await vnc_console.relay(websocket, upstream)
+    finally:
+        vnc_console.limiter.release(vm_id)
@@ -1,7 +1,10 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from database import db
 from .auth import get_current_user
-from datetime import datetime
+from datetime import datetime, timedelta
+from utils import vm_metrics
 
 router = APIRouter()
 
@@ -63,3 +66,38 @@ async def get_runtime_stats(user=Depends(get_current_user)):
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get runtime stats: {str(e)}")
+
+@router.get("/{vm_id}/metrics")
+async def get_vm_metrics(
+    vm_id: str,
+    minutes: int = Query(60, ge=1, le=60 * 24 * 30),
+    since: float = Query(0, description="Only live points newer than this epoch timestamp"),
+    user=Depends(get_current_user)
+):
+    """Measured CPU, memory and disk I/O of a VM: live points plus persisted rollups"""
+    try:
+        vm = await db.vms.find_one({"_id": ObjectId(vm_id), "user_email": user["email"]})
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid VM ID")
+    if not vm:
+        raise HTTPException(status_code=404, detail="VM not found")
+
+    # Downsampled windows from Mongo cover history beyond the in-memory ring buffer
+    cutoff = datetime.utcnow() - timedelta(minutes=minutes)
+    rollups = []
+    cursor = db.vm_metrics.find(
+        {"vm_id": vm_id, "timestamp": {"$gte": cutoff}},
+        {"_id": 0, "vm_id": 0, "user_email": 0}
+    ).sort("timestamp", 1)
+    async for entry in cursor:
+        rollups.append(entry)
+
+    return {
+        "vm_id": vm_id,
+        "status": vm.get("status"),
+        "sample_interval_seconds": vm_metrics.SAMPLE_INTERVAL_SECONDS,
+        "rollup_seconds": vm_metrics.ROLLUP_SECONDS,
+        "live": vm_metrics.live_points(vm_id, since),
+        "rollups": rollups,
+        "usage": vm.get("usage", {})
+    }
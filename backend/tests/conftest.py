@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Tests import the backend modules the way main.py does (utils.*, routers.*)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+# database.py refuses to load without a URI; the client connects lazily, so nothing is contacted
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
@@ -0,0 +1,24 @@
+"""Plan-weighted fair ordering of utils/build_scheduler.py."""
+from datetime import datetime, timedelta
+
+from routers.billing import plans
+from utils.build_scheduler import fair_order, plan_weight
+
+
+def queued(user, plan, minute):
+    return {"user_email": user, "plan": plan, "queued_at": datetime(2024, 1, 1) + timedelta(minutes=minute)}
+
+
+def test_weights_come_from_the_billing_plans():
+    for plan in plans:
+        assert plan_weight(plan["id"]) == plan["build_weight"]
+    assert plan_weight("payg") == plan_weight("unlimited")
+    assert plan_weight("retired-plan") == plans[0]["build_weight"]
+
+
+def test_fair_order_follows_plan_weights():
+    builds = [queued("free@x", "free", m) for m in range(4)] + [queued("payg@x", "payg", 10 + m) for m in range(8)]
+    order = [build["user_email"] for build in fair_order(builds, {})]
+    # payg (weight 4) gets four picks for each free (weight 1) pick, despite queueing later
+    assert order[:5].count("payg@x") == 4
+    assert order[:10].count("free@x") == 2
@@ -0,0 +1,37 @@
+"""Line assembly of utils/container_logs.py's shared follow streams."""
+from utils.container_logs import END_OF_STREAM, LogBroadcaster
+
+
+class FakeAPI:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def logs(self, container_id, **kwargs):
+        return iter(self.chunks)
+
+
+class FakeClient:
+    def __init__(self, chunks):
+        self.api = FakeAPI(chunks)
+
+
+def published(chunks):
+    broadcaster = LogBroadcaster(FakeClient(chunks), "c0ffee" * 10)
+    lines = []
+    broadcaster._publish = lines.append
+    broadcaster._read()
+    return lines
+
+
+def test_lines_split_across_chunks_are_joined():
+    chunks = [b"2024-01-01T00:00:00Z hel", b"lo\r", b"\n2024-01-01T00:00:01Z wor", b"ld\n"]
+    assert published(chunks) == ["2024-01-01T00:00:00Z hello", "2024-01-01T00:00:01Z world", END_OF_STREAM]
+
+
+def test_multibyte_characters_split_across_chunks():
+    text = "2024-01-01T00:00:00Z café\n".encode("utf-8")
+    assert published([text[:-2], text[-2:]]) == ["2024-01-01T00:00:00Z café", END_OF_STREAM]
+
+
+def test_unterminated_last_line_is_sent_when_the_stream_ends():
+    assert published([b"a\nb\n", b"partial"]) == ["a", "b", "partial", END_OF_STREAM]
@@ -0,0 +1,121 @@
+"""Warm containers of utils/container_pool.py and the ports they publish."""
+import asyncio
+from collections import deque
+
+import pytest
+
+from utils import container_pool, port_allocator
+
+
+class FakeAPI:
+    def __init__(self):
+        self.created = {}
+        self.started = []
+        self.next_port = 20000
+
+    def inspect_image(self, image):
+        return {"Config": {"ExposedPorts": {"80/tcp": {}}}}
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, image, name, host_config, **kwargs):
+        container_id = f"id{len(self.created)}"
+        self.created[container_id] = {"name": name, "host_config": host_config, "labels": kwargs.get("labels")}
+        return {"Id": container_id}
+
+    def rename(self, container_id, name):
+        self.created[container_id]["name"] = name
+
+    def update_container(self, container_id, restart_policy):
+        pass
+
+    def start(self, container_id):
+        self.started.append(container_id)
+
+
+class FakeClient:
+    def __init__(self):
+        self.api = FakeAPI()
+
+
+class FakeContainer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    client = FakeClient()
+    ports = {"owners": {}}
+
+    async def reserve(port_bindings, user_email):
+        resolved = {}
+        for container_port in port_bindings:
+            client.api.next_port += 1
+            resolved[container_port] = [{"HostPort": str(client.api.next_port)}]
+        return "r1", resolved
+
+    async def attach(reservation, container_id):
+        ports["owners"][container_id] = None
+
+    async def assign(container_id, user_email):
+        ports["owners"][container_id] = user_email
+
+    monkeypatch.setattr(container_pool, "_client", client)
+    monkeypatch.setattr(container_pool, "DOCKER_WARM_TEMPLATES", ["nginx:latest"])
+    monkeypatch.setattr(container_pool, "warm", {})
+    monkeypatch.setattr(container_pool, "claims", {})
+    monkeypatch.setattr(container_pool, "published", {})
+    monkeypatch.setattr(container_pool, "refill_in_background", lambda template: None)
+    monkeypatch.setattr(port_allocator, "reserve", reserve)
+    monkeypatch.setattr(port_allocator, "attach", attach)
+    monkeypatch.setattr(port_allocator, "assign", assign)
+    client.ports = ports
+    return client
+
+
+def fill():
+    # Fills the pool to DOCKER_WARM_POOL_MIN, one container with no claims yet
+    container_pool.warm["nginx:latest"] = deque()
+    asyncio.run(container_pool._resize("nginx:latest"))
+
+
+def test_warm_containers_publish_the_image_ports(pool):
+    fill()
+    (container_id, created), = pool.api.created.items()
+    assert created["host_config"]["port_bindings"] == {"80/tcp": [{"HostPort": "20001"}]}
+    assert pool.ports["owners"] == {container_id: None}
+
+
+def test_auto_bindings_claim_a_warm_container(pool):
+    fill()
+    claimed = asyncio.run(container_pool.claim(
+        "nginx", "web", {"Name": "always"}, {"80/tcp": [{"HostPort": "auto"}]}, "user@example.com"
+    ))
+    assert claimed == ("id0", {"80/tcp": [{"HostPort": "20001"}]})
+    assert pool.api.created["id0"]["name"] == "web"
+    assert pool.api.started == ["id0"]
+    assert pool.ports["owners"]["id0"] == "user@example.com"
+
+
+@pytest.mark.parametrize("port_bindings", [
+    {"80/tcp": [{"HostPort": "8080"}]},
+    {"80/tcp": [{"HostPort": "auto"}], "443/tcp": [{"HostPort": "auto"}]},
+    {},
+])
+def test_other_bindings_are_left_to_a_cold_create(pool, port_bindings):
+    fill()
+    claimed = asyncio.run(container_pool.claim("nginx", "web", {"Name": "always"}, port_bindings, "user@example.com"))
+    assert claimed is None
+    assert list(container_pool.warm["nginx:latest"]) == ["id0"]
+    assert pool.api.started == []
+
+
+def test_only_unclaimed_pool_containers_are_pool_members():
+    labels = {container_pool.POOL_LABEL: "nginx:latest"}
+    assert container_pool.is_pool_member(FakeContainer("virtcloud-warm-abc", labels))
+    # Claiming renames the container but can't drop its label
+    assert not container_pool.is_pool_member(FakeContainer("web", labels))
+    assert not container_pool.is_pool_member(FakeContainer("virtcloud-warm-abc", {}))
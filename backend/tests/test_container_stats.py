@@ -0,0 +1,58 @@
+"""Stream bookkeeping of utils/container_stats.py."""
+import threading
+
+import pytest
+
+from utils import container_stats
+
+
+class FakeContainer:
+    def __init__(self, container_id):
+        self.id = container_id
+
+
+class BlockingAPI:
+    """Stats streams that stay open until the test releases them."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def stats(self, container_id, stream=True, decode=True):
+        self.release.wait(5)
+        return iter(())
+
+
+class FakeClient:
+    def __init__(self, running):
+        self.running = running
+        self.api = BlockingAPI()
+        self.containers = self
+
+    def list(self, **kwargs):
+        return [FakeContainer(container_id) for container_id in self.running]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeClient([f"c{i}" for i in range(5)])
+    monkeypatch.setattr(container_stats, "_client", fake)
+    monkeypatch.setattr(container_stats, "DOCKER_STATS_MAX_STREAMS", 3)
+    monkeypatch.setattr(container_stats, "streams", set())
+    monkeypatch.setattr(container_stats, "skipped", set())
+    yield fake
+    fake.api.release.set()
+
+
+def test_containers_past_the_stream_cap_are_reported(client):
+    assert container_stats.sync_streams() == 3
+    assert len(container_stats.streams) == 3
+    assert container_stats.skipped == set(client.running) - container_stats.streams
+
+
+def test_skipped_containers_get_a_stream_once_one_frees_up(client):
+    container_stats.sync_streams()
+    client.running = client.running[3:]
+    with container_stats._streams_lock:
+        container_stats.streams.clear()
+    assert container_stats.sync_streams() == 2
+    assert container_stats.skipped == set()
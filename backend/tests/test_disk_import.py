@@ -0,0 +1,68 @@
+"""Quota checks of chunked disk imports (POST /vm/disk/import)."""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routers import vm_disk
+from routers.auth import get_current_user
+from utils import disk_transfer, storage_quota
+
+USER = {"email": "user@example.com", "plan": "free"}
+QUOTA_LEFT = 64 * 1024
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query, *args):
+        return self.docs.get(query["_id"])
+
+    async def insert_one(self, doc):
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def update_one(self, query, update, upsert=False):
+        if query["_id"] in self.docs:
+            self.docs[query["_id"]].update(update["$set"])
+
+
+class FakeDB:
+    def __init__(self):
+        self.disk_uploads = FakeCollection()
+        self.disks = FakeCollection()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    database = FakeDB()
+    monkeypatch.setattr(vm_disk, "db", database)
+    monkeypatch.setattr(vm_disk, "get_store_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(disk_transfer, "get_store_dir", lambda: str(tmp_path))
+
+    async def get_usage(email):
+        return {"allocated_bytes": vm_disk.disk_quota_bytes(USER) - QUOTA_LEFT, "reserved_bytes": 0}
+    monkeypatch.setattr(storage_quota, "get_usage", get_usage)
+
+    app = FastAPI()
+    app.include_router(vm_disk.router, prefix="/vm/disk")
+    app.dependency_overrides[get_current_user] = lambda: USER
+    client = TestClient(app)
+    client.uploads = database.disk_uploads
+    return client
+
+
+def chunks(total, size=8192):
+    for start in range(0, total, size):
+        yield b"\0" * min(size, total - start)
+
+
+def test_chunked_body_without_content_length_is_held_to_the_quota(client):
+    response = client.post("/vm/disk/import", params={"name": "big.raw"}, content=chunks(QUOTA_LEFT * 2))
+    assert response.status_code == 403
+    assert client.uploads.docs["big.raw"]["offset"] <= QUOTA_LEFT
+
+
+def test_chunked_body_within_the_quota_is_stored(client):
+    response = client.post("/vm/disk/import", params={"name": "small.raw"}, content=chunks(QUOTA_LEFT // 2))
+    assert response.status_code == 200
+    assert response.json()["offset"] == QUOTA_LEFT // 2
@@ -0,0 +1,67 @@
+"""Storage usage accounting of utils/disk_inventory.py."""
+import asyncio
+
+import pytest
+
+from utils import disk_inventory, storage_quota
+
+
+class FakeDisks:
+    def __init__(self, records):
+        self.records = records
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            record = self.records.get(operation._filter["_id"])
+            if record is not None:
+                record.update(operation._doc["$set"])
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        record = self.records.get(query["_id"])
+        if record is None or record.get("owner_email") != query["owner_email"]:
+            return None
+        before = dict(record)
+        record.update(update["$set"])
+        return before
+
+
+class FakeUsage:
+    def __init__(self):
+        self.counters = {}
+
+    async def update_one(self, query, update, upsert=False):
+        counters = self.counters.setdefault(query["_id"], {})
+        for field, value in update["$inc"].items():
+            counters[field] = counters.get(field, 0) + value
+
+
+class FakeDB:
+    def __init__(self, disks):
+        self.disks = FakeDisks(disks)
+        self.storage_usage = FakeUsage()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = FakeDB({
+        "found.qcow2": {"_id": "found.qcow2", "owner_email": None, "virtual_size": 10 << 30, "actual_size": 2 << 30},
+        "mine.qcow2": {"_id": "mine.qcow2", "owner_email": "a@example.com", "virtual_size": 5 << 30, "actual_size": 1 << 30},
+    })
+    monkeypatch.setattr(disk_inventory, "db", database)
+    monkeypatch.setattr(storage_quota, "db", database)
+
+    async def attached_vms(names):
+        return {name: [{"vm_id": "vm1", "user_email": "b@example.com"}] for name in names}
+    monkeypatch.setattr(disk_inventory, "attached_vms", attached_vms)
+    return database
+
+
+def test_adopting_an_ownerless_disk_charges_the_new_owner(db):
+    asyncio.run(disk_inventory.sync_attachments(["found.qcow2", "mine.qcow2"]))
+    assert db.disks.records["found.qcow2"]["owner_email"] == "b@example.com"
+    assert db.disks.records["found.qcow2"]["attached_vms"] == [{"vm_id": "vm1", "user_email": "b@example.com"}]
+    # Owned disks keep their owner and nobody else is charged for them
+    assert db.disks.records["mine.qcow2"]["owner_email"] == "a@example.com"
+    assert db.storage_usage.counters == {
+        "b@example.com": {"allocated_bytes": 10 << 30, "actual_bytes": 2 << 30, "disk_count": 1}
+    }
@@ -0,0 +1,128 @@
+"""Build helpers of utils/docker_tools.py that don't need a Docker daemon."""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+from utils import docker_tools
+from utils.docker_tools import build_context, classic_build
+
+
+class SlowBuildAPI:
+    """Stands in for docker-py's APIClient: a blocking generator of build entries."""
+
+    def __init__(self, entries, delay=0.05, error=None):
+        self.entries = entries
+        self.delay = delay
+        self.error = error
+
+    def build(self, **kwargs):
+        self.kwargs = kwargs
+        for entry in self.entries:
+            time.sleep(self.delay)
+            yield entry
+        if self.error:
+            raise self.error
+
+
+class FakeClient:
+    def __init__(self, api):
+        self.api = api
+
+
+def collect(client):
+    async def run():
+        ticks = 0
+        entries = []
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.get_event_loop().create_task(tick())
+        try:
+            async for entry in classic_build(client, build_context("FROM scratch\n"), "demo:latest"):
+                entries.append(entry)
+        finally:
+            ticker.cancel()
+        return entries, ticks
+    return asyncio.run(run())
+
+
+def test_classic_build_streams_without_blocking_the_loop():
+    entries = [{"stream": "Step 1/1 : FROM scratch"}, {"aux": {"ID": "sha256:abc"}}, {"stream": "Successfully tagged demo:latest"}]
+    api = SlowBuildAPI(entries)
+    received, ticks = collect(FakeClient(api))
+    assert received == entries
+    assert api.kwargs["tag"] == "demo:latest" and api.kwargs["custom_context"] is True
+    # The loop kept running while the build slept between entries
+    assert ticks >= 5
+
+
+def test_classic_build_raises_stream_errors():
+    api = SlowBuildAPI([{"stream": "Step 1/1"}], delay=0, error=RuntimeError("daemon went away"))
+    with pytest.raises(RuntimeError, match="daemon went away"):
+        collect(FakeClient(api))
+
+
+FAKE_DOCKER = """#!{python}
+import json, os, sys, time
+args = sys.argv[1:]
+if args[:2] != ["buildx", "build"]:
+    sys.exit(0)
+options = dict(zip(args, args[1:]))
+sys.stdin.buffer.read()
+print("#1 [1/1] FROM scratch", flush=True)
+source = options.get("--cache-from", "").partition("src=")[2]
+time.sleep(0.3)
+if source and not os.path.isfile(os.path.join(source, "index.json")):
+    print("cache import failed: " + source, flush=True)
+    sys.exit(1)
+dest = options["--cache-to"].split("dest=")[1].split(",")[0]
+with open(os.path.join(dest, "index.json"), "w") as f:
+    f.write("{{}}")
+with open(options["--metadata-file"], "w") as f:
+    json.dump({{"containerimage.config.digest": "sha256:demo"}}, f)
+"""
+
+
+@pytest.fixture
+def fake_buildx(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "docker"
+    script.write_text(FAKE_DOCKER.format(python=sys.executable))
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(docker_tools, "BUILDKIT_CACHE_DIR", str(tmp_path / "cache"))
+    return docker_tools
+
+
+def test_concurrent_buildkit_builds_share_a_user_cache(fake_buildx):
+    cache_dir = fake_buildx.user_cache_dir("user@example.com")
+    lines = []
+
+    async def log(line):
+        lines.append(line)
+
+    async def build():
+        return await fake_buildx.buildkit_build(build_context("FROM scratch\n"), "demo:latest", cache_dir, log)
+
+    async def run():
+        await build()
+        # Both builds import the version that was current when they started
+        return await asyncio.gather(build(), build())
+
+    results = asyncio.run(run())
+    assert [r["image_id"] for r in results] == ["sha256:demo", "sha256:demo"]
+    assert not any("WARNING" in line or "failed" in line for line in lines)
+    assert os.path.islink(cache_dir)
+    assert os.path.isfile(os.path.join(cache_dir, "index.json"))
+    # Only the current version is left once no build uses the others
+    prefix = os.path.basename(cache_dir) + ".v"
+    versions = [name for name in os.listdir(fake_buildx.BUILDKIT_CACHE_DIR) if name.startswith(prefix) and not name.endswith(".lock")]
+    assert versions == [os.path.basename(os.path.realpath(cache_dir))]
@@ -0,0 +1,140 @@
+"""Golden qemu-system command lines for every preset and host-feature fallback."""
+import pytest
+from fastapi import HTTPException
+
+from utils import qemu_tools
+from utils.qemu_tools import QemuCommandBuilder
+
+EXE = "qemu-system-x86_64"
+DISK = "/store/vm.qcow2"
+ALL_FEATURES = {"kvm": True, f"direct_io:{DISK}": True, "io_uring": True, "hugepages_free_mb": 4096}
+
+VIRTIO_NET = ["-netdev", "user,id=net0", "-device", "virtio-net-pci,netdev=net0"]
+
+
+@pytest.fixture(autouse=True)
+def host_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(qemu_tools, "QEMU_AIO", "")
+    monkeypatch.setattr(qemu_tools, "QEMU_HUGEPAGES_PATH", str(tmp_path))
+    return tmp_path
+
+
+def command(preset, features, disk=DISK):
+    return QemuCommandBuilder(EXE, preset, features=dict(features)).memory(2048).cpus(2).display("none").disk(disk).build()
+
+
+def test_compat_keeps_emulated_devices():
+    assert command("compat", ALL_FEATURES) == [
+        EXE, "-enable-kvm", "-m", "2048", "-smp", "2",
+        "-drive", f"id=disk0,file={DISK},format=qcow2,cache=writeback,aio=threads",
+        "-display", "none"
+    ]
+
+
+def test_compat_without_kvm():
+    assert command("compat", {**ALL_FEATURES, "kvm": False}) == [
+        EXE, "-m", "2048", "-smp", "2",
+        "-drive", f"id=disk0,file={DISK},format=qcow2,cache=writeback,aio=threads",
+        "-display", "none"
+    ]
+
+
+def test_records_without_preset_use_compat():
+    assert command(None, ALL_FEATURES) == command("compat", ALL_FEATURES)
+
+
+@pytest.mark.parametrize("features, drive_cache", [
+    (ALL_FEATURES, "cache=none,aio=io_uring"),
+    ({**ALL_FEATURES, "io_uring": False}, "cache=none,aio=native"),
+    ({**ALL_FEATURES, f"direct_io:{DISK}": False}, "cache=writeback,aio=threads"),
+])
+def test_balanced_disk_io_fallbacks(features, drive_cache):
+    assert command("balanced", features) == [
+        EXE, "-enable-kvm", "-cpu", "host", "-m", "2048", "-smp", "2",
+        "-drive", f"if=none,id=disk0,file={DISK},format=qcow2,{drive_cache}",
+        "-device", "virtio-blk-pci,drive=disk0",
+        *VIRTIO_NET,
+        "-display", "none"
+    ]
+
+
+def test_balanced_without_kvm_drops_host_cpu():
+    assert command("balanced", {**ALL_FEATURES, "kvm": False}) == [
+        EXE, "-m", "2048", "-smp", "2",
+        "-drive", f"if=none,id=disk0,file={DISK},format=qcow2,cache=none,aio=io_uring",
+        "-device", "virtio-blk-pci,drive=disk0",
+        *VIRTIO_NET,
+        "-display", "none"
+    ]
+
+
+def test_balanced_raw_disk():
+    disk = "/store/vm.img"
+    assert command("balanced", {**ALL_FEATURES, f"direct_io:{disk}": True}, disk=disk) == [
+        EXE, "-enable-kvm", "-cpu", "host", "-m", "2048", "-smp", "2",
+        "-drive", f"if=none,id=disk0,file={disk},format=raw,cache=none,aio=io_uring",
+        "-device", "virtio-blk-pci,drive=disk0",
+        *VIRTIO_NET,
+        "-display", "none"
+    ]
+
+
+def test_performance_adds_hugepages_and_iothread(host_settings):
+    assert command("performance", ALL_FEATURES) == [
+        EXE, "-enable-kvm", "-cpu", "host", "-m", "2048", "-smp", "2",
+        "-mem-path", str(host_settings), "-mem-prealloc",
+        "-object", "iothread,id=iothread0",
+        "-drive", f"if=none,id=disk0,file={DISK},format=qcow2,cache=none,aio=io_uring",
+        "-device", "virtio-blk-pci,drive=disk0,iothread=iothread0",
+        *VIRTIO_NET,
+        "-display", "none"
+    ]
+
+
+def test_performance_without_enough_hugepages():
+    assert command("performance", {**ALL_FEATURES, "hugepages_free_mb": 1024}) == [
+        EXE, "-enable-kvm", "-cpu", "host", "-m", "2048", "-smp", "2",
+        "-object", "iothread,id=iothread0",
+        "-drive", f"if=none,id=disk0,file={DISK},format=qcow2,cache=none,aio=io_uring",
+        "-device", "virtio-blk-pci,drive=disk0,iothread=iothread0",
+        *VIRTIO_NET,
+        "-display", "none"
+    ]
+
+
+def test_performance_without_hugepages_mount(monkeypatch, tmp_path):
+    monkeypatch.setattr(qemu_tools, "QEMU_HUGEPAGES_PATH", str(tmp_path / "missing"))
+    assert "-mem-path" not in command("performance", ALL_FEATURES)
+
+
+def test_forced_aio_backend(monkeypatch):
+    monkeypatch.setattr(qemu_tools, "QEMU_AIO", "threads")
+    assert f"if=none,id=disk0,file={DISK},format=qcow2,cache=none,aio=threads" in command("balanced", ALL_FEATURES)
+
+
+def test_cdrom_console_and_qmp():
+    cmd = (QemuCommandBuilder(EXE, "balanced", features=dict(ALL_FEATURES))
+           .display("none").disk(DISK).cdrom("/isos/install.iso")
+           .console("/run/vnc.sock").qmp("/run/qmp.sock").build())
+    assert cmd[cmd.index("-netdev"):] == [
+        *VIRTIO_NET,
+        "-cdrom", "/isos/install.iso", "-boot", "d",
+        "-display", "none",
+        "-vnc", "unix:/run/vnc.sock,share=force-shared",
+        "-qmp", "unix:/run/qmp.sock,server=on,wait=off"
+    ]
+
+
+def test_unknown_preset_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        QemuCommandBuilder(EXE, "turbo")
+    assert error.value.status_code == 400
+
+
+def test_missing_iso_fails_the_launch(tmp_path):
+    (tmp_path / "vm.qcow2").write_bytes(b"")
+    vm = {"disk_name": "vm.qcow2", "iso_path": "iso:" + "0" * 64, "memory_mb": 512, "cpu_count": 1}
+    with pytest.raises(HTTPException) as error:
+        qemu_tools.spawn_vm_process(EXE, vm, True, str(tmp_path))
+    assert error.value.status_code == 404
+    assert "not available on this host" in error.value.detail
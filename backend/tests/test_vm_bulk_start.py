@@ -0,0 +1,56 @@
+"""Queueing in routers/vm_management.py bulk_start_vms."""
+import asyncio
+
+from bson.objectid import ObjectId
+
+from routers import vm_management
+from utils import host_pool
+
+USER = {"email": "user@example.com", "plan": "free"}
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeVMs:
+    def __init__(self, vms):
+        self.vms = {vm["_id"]: vm for vm in vms}
+
+    def find(self, query):
+        return FakeCursor([vm for _id, vm in self.vms.items() if _id in query["_id"]["$in"]])
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.vms[operation._filter["_id"]].update(operation._doc["$set"])
+
+
+class FakeDB:
+    def __init__(self, vms):
+        self.vms = FakeVMs(vms)
+
+
+def test_bulk_queued_vms_keep_their_own_reason(monkeypatch):
+    small = {"_id": ObjectId(), "user_email": USER["email"], "status": "stopped", "cpu_count": 1, "memory_mb": 512}
+    large = {"_id": ObjectId(), "user_email": USER["email"], "status": "stopped", "cpu_count": 2, "memory_mb": 2048}
+    fake = FakeDB([small, large])
+
+    async def get_cluster_usage():
+        return {}
+
+    monkeypatch.setattr(vm_management, "db", fake)
+    monkeypatch.setattr(vm_management, "check_host_fit", lambda usages, cpu_count, memory_mb: None)
+    monkeypatch.setattr(host_pool, "get_cluster_usage", get_cluster_usage)
+    monkeypatch.setattr(host_pool, "place", lambda usages, cpu_count, memory_mb: (None, f"node1: no room for {memory_mb} MB"))
+
+    req = vm_management.BulkVMActionRequest(vm_ids=[str(small["_id"]), str(large["_id"])])
+    result = asyncio.run(vm_management.bulk_start_vms(req, user=USER))
+
+    assert result["queued"] == 2
+    assert small["status"] == large["status"] == "queued"
+    assert small["queue_reason"] == "node1: no room for 512 MB"
+    assert large["queue_reason"] == "node1: no room for 2048 MB"
@@ -0,0 +1,73 @@
+"""Routes of routers/vm.py that hand off to routers/vm_management.py."""
+import pytest
+from bson.objectid import ObjectId
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routers import vm, vm_management
+from routers.auth import get_current_user
+
+USER = {"email": "user@example.com", "plan": "free"}
+
+
+class FakeVMs:
+    def __init__(self, vm):
+        self.vm = vm
+        self.updates = []
+
+    async def find_one(self, query, *args):
+        return self.vm if query.get("_id") == self.vm["_id"] else None
+
+    async def update_one(self, query, update):
+        self.updates.append(update)
+        self.vm.update(update.get("$set", {}))
+
+
+class FakeDB:
+    def __init__(self, vm):
+        self.vms = FakeVMs(vm)
+
+
+@pytest.fixture
+def stopped_vm(monkeypatch):
+    record = {"_id": ObjectId(), "user_email": USER["email"], "status": "stopped",
+              "cpu_count": 1, "memory_mb": 1024, "disk_name": "disk.qcow2"}
+    fake = FakeDB(record)
+    monkeypatch.setattr(vm_management, "db", fake)
+    return fake
+
+
+@pytest.fixture
+def client():
+    # Same registration order as main.py: the older vm router wins shared paths
+    app = FastAPI()
+    app.include_router(vm.router, prefix="/vm")
+    app.include_router(vm_management.router, prefix="/vm")
+    app.dependency_overrides[get_current_user] = lambda: USER
+    return TestClient(app)
+
+
+def test_update_resources_sets_preset(client, stopped_vm):
+    response = client.post("/vm/update-resources", json={
+        "vm_id": str(stopped_vm.vms.vm["_id"]), "cpu_count": 2, "memory_mb": 2048, "preset": "performance"
+    })
+    assert response.status_code == 200
+    assert response.json()["preset"] == "performance"
+    assert stopped_vm.vms.vm["qemu_preset"] == "performance"
+    assert stopped_vm.vms.vm["cpu_count"] == 2
+
+
+def test_update_resources_rejects_unknown_preset(client, stopped_vm):
+    response = client.post("/vm/update-resources", json={
+        "vm_id": str(stopped_vm.vms.vm["_id"]), "cpu_count": 1, "memory_mb": 1024, "preset": "turbo"
+    })
+    assert response.status_code == 400
+    assert "qemu_preset" not in stopped_vm.vms.vm
+
+
+def test_update_resources_enforces_plan_limits(client, stopped_vm):
+    response = client.post("/vm/update-resources", json={
+        "vm_id": str(stopped_vm.vms.vm["_id"]), "cpu_count": 64, "memory_mb": 1024
+    })
+    assert response.status_code == 403
+    assert stopped_vm.vms.updates == []
@@ -0,0 +1,56 @@
+import asyncio
+import hashlib
+import os
+from typing import Dict, List
+
+from routers.billing import plans
+
+# Builds the Docker daemon runs at once; the rest wait in docker_builds with status "queued"
+DOCKER_BUILD_CONCURRENCY = int(os.getenv("DOCKER_BUILD_CONCURRENCY", "2"))
+# How often the build queue is re-checked (also refreshes the heartbeat of running builds)
+DOCKER_BUILD_QUEUE_POLL_SECONDS = int(os.getenv("DOCKER_BUILD_QUEUE_POLL_SECONDS", "15"))
+# A running build whose heartbeat is this old belonged to a worker that died
+DOCKER_BUILD_HEARTBEAT_TIMEOUT_SECONDS = int(os.getenv("DOCKER_BUILD_HEARTBEAT_TIMEOUT_SECONDS", "120"))
+# Share of the build slots each plan gets when users compete for them, from the billing plan table
+PLAN_BUILD_WEIGHTS = {plan["id"]: plan["build_weight"] for plan in plans}
+
+# Serialises slot counting + dispatch so two requests can't take the same slot
+dispatch_lock = asyncio.Lock()
+
+
+def build_key(context: bytes, image_tag: str, engine: str) -> str:
+    """Identity of a build: the exact context bytes (Dockerfile + files), tag and engine."""
+    digest = hashlib.sha256(context)
+    digest.update(f"\0{image_tag}\0{engine}".encode())
+    return digest.hexdigest()
+
+
+def plan_weight(plan_id) -> int:
+    # Unknown plans are treated like the first (free) plan, as the VM plan limits do
+    return PLAN_BUILD_WEIGHTS.get(plan_id, plans[0]["build_weight"])
+
+
+def fair_order(queued: List[dict], running: Dict[str, int]) -> List[dict]:
+    """
+    Order in which queued builds get slots.
+
+    Each pick goes to the user with the fewest running-or-picked builds per
+    unit of plan weight; ties go to whoever has waited longest. A user's own
+    builds stay FIFO, so one user submitting twenty builds can't push anyone
+    else to the back.
+    """
+    per_user = {}
+    for build in sorted(queued, key=lambda b: b["queued_at"]):
+        per_user.setdefault(build["user_email"], []).append(build)
+    active = dict(running)
+    order = []
+    while per_user:
+        user = min(
+            per_user,
+            key=lambda u: (active.get(u, 0) / plan_weight(per_user[u][0].get("plan")), per_user[u][0]["queued_at"])
+        )
+        order.append(per_user[user].pop(0))
+        active[user] = active.get(user, 0) + 1
+        if not per_user[user]:
+            del per_user[user]
+    return order
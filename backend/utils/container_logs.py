@@ -0,0 +1,180 @@
+import asyncio
+import codecs
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+# Lines buffered per viewer; a viewer that falls further behind loses the oldest lines
+DOCKER_LOG_VIEWER_QUEUE = int(os.getenv("DOCKER_LOG_VIEWER_QUEUE", "1000"))
+# Upper bound on `tail` so one request can't pull a container's whole history into memory
+DOCKER_LOG_MAX_TAIL = int(os.getenv("DOCKER_LOG_MAX_TAIL", "5000"))
+# Seconds between SSE keep-alive comments on an idle follow stream
+DOCKER_LOG_KEEPALIVE_SECONDS = float(os.getenv("DOCKER_LOG_KEEPALIVE_SECONDS", "15"))
+
+# Put on a viewer's queue when the daemon stream ends
+END_OF_STREAM = None
+
+
+class Viewer:
+    """One client following a container's logs: a bounded queue and a count of lines it missed."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=DOCKER_LOG_VIEWER_QUEUE)
+        self.dropped = 0
+
+    def offer(self, line) -> None:
+        """Queue a line without ever blocking the daemon reader (runs on the event loop)."""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+
+class LogBroadcaster:
+    """
+    A single `follow` stream from the daemon, shared by every viewer of one
+    container. The stream is read on its own thread and closed when the last
+    viewer leaves or the container stops.
+    """
+
+    def __init__(self, client, container_id: str):
+        self.client = client
+        self.container_id = container_id
+        self.viewers = set()
+        self.stream = None
+        self.closed = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        threading.Thread(target=self._read, name=f"docker-logs-{self.container_id[:12]}", daemon=True).start()
+
+    def _read(self) -> None:
+        try:
+            # tail=0: viewers fetch their own history; this stream carries only new output
+            stream = self.client.api.logs(self.container_id, stream=True, follow=True, timestamps=True, tail=0)
+            with self.lock:
+                if self.closed:
+                    stream.close()
+                    return
+                self.stream = stream
+            # TTY containers send raw socket chunks that don't end on line breaks;
+            # keep the unfinished tail and complete it with the next chunk
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            partial = ""
+            for chunk in stream:
+                # Only "\n" ends a line, so a "\r\n" split between chunks stays one break
+                lines = (partial + decoder.decode(chunk)).split("\n")
+                partial = lines.pop()
+                for line in lines:
+                    self._publish(line.rstrip("\r"))
+            partial += decoder.decode(b"", final=True)
+            if partial.rstrip("\r"):
+                self._publish(partial.rstrip("\r"))
+        except Exception as e:
+            if not self.closed:
+                print(f"⚠️ Log stream of container {self.container_id[:12]} ended: {str(e)}")
+        finally:
+            with self.lock:
+                self.finished = True
+            if broadcasters.get(self.container_id) is self:
+                del broadcasters[self.container_id]
+            self._publish(END_OF_STREAM)
+
+    def _publish(self, line) -> None:
+        with self.lock:
+            viewers = list(self.viewers)
+        for viewer in viewers:
+            viewer.loop.call_soon_threadsafe(viewer.offer, line)
+
+    def add(self, viewer: Viewer) -> bool:
+        """Attach a viewer; False if the stream already ended and a new broadcaster is needed."""
+        with self.lock:
+            if self.closed or self.finished:
+                return False
+            self.viewers.add(viewer)
+            return True
+
+    def remove(self, viewer: Viewer) -> None:
+        with self.lock:
+            self.viewers.discard(viewer)
+            last = not self.viewers
+        if last:
+            self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            stream = self.stream
+        if broadcasters.get(self.container_id) is self:
+            del broadcasters[self.container_id]
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+
+# container id -> broadcaster with at least one viewer
+broadcasters: Dict[str, LogBroadcaster] = {}
+
+
+def subscribe(client, container_id: str) -> Tuple[LogBroadcaster, Viewer]:
+    """Join the container's shared follow stream, starting it for the first viewer."""
+    viewer = Viewer(asyncio.get_event_loop())
+    broadcaster = broadcasters.get(container_id)
+    if broadcaster is None or not broadcaster.add(viewer):
+        broadcaster = broadcasters[container_id] = LogBroadcaster(client, container_id)
+        broadcaster.add(viewer)
+        broadcaster.start()
+    return broadcaster, viewer
+
+
+def history(client, container_id: str, tail: Optional[int], since: Optional[int]) -> list:
+    """Past log lines (with timestamps), at most DOCKER_LOG_MAX_TAIL of them."""
+    tail = DOCKER_LOG_MAX_TAIL if tail is None else max(0, min(tail, DOCKER_LOG_MAX_TAIL))
+    if tail == 0:
+        return []
+    kwargs = {"stream": False, "timestamps": True, "tail": tail}
+    if since is not None:
+        kwargs["since"] = since
+    output = client.api.logs(container_id, **kwargs)
+    return output.decode("utf-8", errors="replace").splitlines()
+
+
+def sse_event(line: str, event: Optional[str] = None) -> str:
+    """One Server-Sent Event; a log line never contains a newline after splitlines()."""
+    return (f"event: {event}\n" if event else "") + f"data: {line}\n\n"
+
+
+async def follow(client, container_id: str, tail: Optional[int], since: Optional[int]):
+    """
+    SSE stream of a container's logs: its history, then new lines as they come.
+
+    Each viewer reads from its own bounded queue, so a slow client only makes
+    the server drop its oldest unread lines (reported as a `dropped` event),
+    never buffer without limit or slow down other viewers.
+    """
+    broadcaster, viewer = subscribe(client, container_id)
+    try:
+        # Subscribing before reading the history means no line falls in between
+        # (one written at the moment of joining may show up twice)
+        loop = asyncio.get_event_loop()
+        for line in await loop.run_in_executor(None, history, client, container_id, tail, since):
+            yield sse_event(line)
+        while True:
+            try:
+                line = await asyncio.wait_for(viewer.queue.get(), DOCKER_LOG_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if viewer.dropped:
+                yield sse_event(str(viewer.dropped), event="dropped")
+                viewer.dropped = 0
+            if line is END_OF_STREAM:
+                yield sse_event("container stopped", event="end")
+                return
+            yield sse_event(line)
+    finally:
+        broadcaster.remove(viewer)
@@ -0,0 +1,264 @@
+import asyncio
+import math
+import os
+import time
+import uuid
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+import docker
+
+from utils import port_allocator
+
+# Images kept warm, comma separated; requests for other images are created from scratch
+DOCKER_WARM_TEMPLATES = [t.strip() for t in os.getenv("DOCKER_WARM_TEMPLATES", "nginx:latest,python:3.12-slim").split(",") if t.strip()]
+# Bounds on the warm containers kept per template
+DOCKER_WARM_POOL_MIN = int(os.getenv("DOCKER_WARM_POOL_MIN", "1"))
+DOCKER_WARM_POOL_MAX = int(os.getenv("DOCKER_WARM_POOL_MAX", "5"))
+# Window over which the recent claim rate of a template is measured
+DOCKER_WARM_POOL_WINDOW_SECONDS = int(os.getenv("DOCKER_WARM_POOL_WINDOW_SECONDS", "600"))
+# Seconds between pool resizing passes
+DOCKER_WARM_POOL_INTERVAL_SECONDS = float(os.getenv("DOCKER_WARM_POOL_INTERVAL_SECONDS", "30"))
+
+POOL_LABEL = "virtcloud.pool"
+POOL_NAME_PREFIX = "virtcloud-warm-"
+# Create-to-running latencies kept per path ("warm" or "cold")
+LATENCY_SAMPLES = 500
+
+# template -> ids of created, never-started containers ready to be claimed
+warm: Dict[str, deque] = {}
+# container id -> host port bindings the warm container was created with
+published: Dict[str, dict] = {}
+# template -> monotonic times of recent claims
+claims: Dict[str, deque] = {}
+# path -> recent create-to-running latencies in seconds
+latencies: Dict[str, deque] = {"warm": deque(maxlen=LATENCY_SAMPLES), "cold": deque(maxlen=LATENCY_SAMPLES)}
+_lock = asyncio.Lock()
+# Templates being resized right now, so a refill and the worker don't both create containers
+_resizing = set()
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = docker.from_env()
+    return _client
+
+
+def template_for(image: str) -> Optional[str]:
+    """The template serving an image reference, if any ("nginx" means "nginx:latest")."""
+    reference = image if ":" in image.rsplit("/", 1)[-1] or "@" in image else f"{image}:latest"
+    return reference if reference in DOCKER_WARM_TEMPLATES else None
+
+
+def target_size(template: str) -> int:
+    """
+    Warm containers to keep for a template: the minimum plus the claims
+    expected during one resize interval at the recent claim rate, capped.
+    """
+    cutoff = time.monotonic() - DOCKER_WARM_POOL_WINDOW_SECONDS
+    demand = sum(1 for at in claims.get(template, ()) if at >= cutoff)
+    expected = demand / DOCKER_WARM_POOL_WINDOW_SECONDS * DOCKER_WARM_POOL_INTERVAL_SECONDS
+    return min(DOCKER_WARM_POOL_MAX, DOCKER_WARM_POOL_MIN + math.ceil(expected))
+
+
+def is_pool_member(container) -> bool:
+    """Whether a container is an unclaimed warm container; claiming renames it."""
+    return POOL_LABEL in (container.labels or {}) and container.name.startswith(POOL_NAME_PREFIX)
+
+
+def auto_ports(port_bindings: dict) -> Optional[frozenset]:
+    """
+    The container ports of bindings that all ask for an "auto" host port,
+    or None when any binding pins a host port (those can't use the pool).
+    """
+    ports = set()
+    for container_port, bindings in port_bindings.items():
+        bindings = bindings or [{}]
+        if len(bindings) != 1:
+            return None
+        binding = bindings[0] if isinstance(bindings[0], dict) else {"HostPort": str(bindings[0])}
+        if binding.get("HostPort") not in port_allocator.AUTO_PORT_VALUES or binding.get("HostIp"):
+            return None
+        ports.add(container_port if "/" in container_port else f"{container_port}/tcp")
+    return frozenset(ports)
+
+
+def image_ports(template: str) -> list:
+    """Ports the template image exposes."""
+    config = get_client().api.inspect_image(template).get("Config") or {}
+    return sorted(config.get("ExposedPorts") or {})
+
+
+def create_warm(template: str, port_bindings: dict) -> str:
+    """Create one stopped container for a template, publishing the given host ports; returns its id."""
+    client = get_client()
+    # Restart policy stays "no" until the container is claimed, so a daemon restart never starts pool members
+    container = client.api.create_container(
+        image=template,
+        name=f"{POOL_NAME_PREFIX}{uuid.uuid4().hex[:12]}",
+        host_config=client.api.create_host_config(port_bindings=port_bindings, restart_policy={"Name": "no"}),
+        detach=True,
+        tty=True,
+        stdin_open=True,
+        labels={POOL_LABEL: template}
+    )
+    return container["Id"]
+
+
+def recover() -> None:
+    """Pick up warm containers left by an earlier run of the server."""
+    for container in get_client().containers.list(all=True, filters={"label": POOL_LABEL, "status": "created"}):
+        template = container.labels.get(POOL_LABEL)
+        if is_pool_member(container) and template in DOCKER_WARM_TEMPLATES:
+            queue = warm.setdefault(template, deque())
+            if container.id not in queue:
+                queue.append(container.id)
+                published[container.id] = (container.attrs.get("HostConfig") or {}).get("PortBindings") or {}
+
+
+async def resize(template: str) -> None:
+    """Create or remove warm containers until the template's pool is at its target size."""
+    if template in _resizing:
+        return
+    _resizing.add(template)
+    try:
+        await _resize(template)
+    finally:
+        _resizing.discard(template)
+
+
+async def _resize(template: str) -> None:
+    loop = asyncio.get_event_loop()
+    target = target_size(template)
+    queue = warm.setdefault(template, deque())
+    while len(queue) < target:
+        try:
+            ports = await loop.run_in_executor(None, image_ports, template)
+        except docker.errors.ImageNotFound:
+            print(f"⚠️ Warm pool skipped {template}: image not present locally")
+            return
+        # Exposed ports are published on "auto" host ports now, since bindings can't be added after creation
+        reservation, port_bindings = None, {}
+        if ports:
+            reservation, port_bindings = await port_allocator.reserve({p: [{"HostPort": "auto"}] for p in ports}, None)
+        try:
+            container_id = await loop.run_in_executor(None, create_warm, template, port_bindings)
+        except Exception:
+            if reservation:
+                await port_allocator.release(reservation)
+            raise
+        if reservation:
+            await port_allocator.attach(reservation, container_id)
+        published[container_id] = port_bindings
+        queue.append(container_id)
+    while len(queue) > target:
+        async with _lock:
+            if len(queue) <= target:
+                break
+            container_id = queue.pop()
+        await discard(container_id)
+
+
+async def discard(container_id: str) -> None:
+    """Remove a warm container and free its host ports."""
+    published.pop(container_id, None)
+    await asyncio.get_event_loop().run_in_executor(None, lambda: get_client().api.remove_container(container_id, force=True))
+    await port_allocator.release_container(container_id)
+
+
+def refill_in_background(template: str) -> None:
+    async def run():
+        try:
+            await resize(template)
+        except Exception as e:
+            print(f"Warm pool refill of {template} failed: {str(e)}")
+    asyncio.get_event_loop().create_task(run())
+
+
+async def claim(image: str, name: str, restart_policy: dict, port_bindings: dict,
+                user_email: str) -> Optional[Tuple[str, dict]]:
+    """
+    Turn a warm container into the user's container: rename it, give it the
+    requested restart policy, hand its host ports to the user and start it.
+
+    Warm containers publish every port their image exposes on "auto" host
+    ports, so only requests binding exactly those ports, all to "auto" (or
+    binding none on an image exposing none), can be served. Returns the id
+    and the published bindings, or None when the image has no template, the
+    ports don't match or its pool is empty (the caller creates one).
+    """
+    template = template_for(image)
+    wanted = auto_ports(port_bindings)
+    if template is None or wanted is None:
+        return None
+    async with _lock:
+        queue = warm.get(template)
+        if queue and frozenset(published.get(queue[0], {})) != wanted:
+            return None
+        claims.setdefault(template, deque(maxlen=1000)).append(time.monotonic())
+        container_id = queue.popleft() if queue else None
+    refill_in_background(template)
+    if container_id is None:
+        return None
+    bindings = published.pop(container_id, {})
+
+    def activate():
+        api = get_client().api
+        api.rename(container_id, name)
+        api.update_container(container_id, restart_policy=restart_policy)
+        api.start(container_id)
+
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, activate)
+    except docker.errors.APIError as e:
+        print(f"⚠️ Warm container {container_id[:12]} could not be claimed: {str(e)}")
+        await discard(container_id)
+        if "Conflict" in str(e) or getattr(e, "status_code", None) == 409:
+            # The requested name is taken; the cold path reports that as usual
+            return None
+        raise
+    await port_allocator.assign(container_id, user_email)
+    return container_id, bindings
+
+
+def record_latency(path: str, seconds: float) -> None:
+    latencies[path].append(seconds)
+
+
+def percentile(values, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)], 3)
+
+
+def status() -> dict:
+    return {
+        "templates": {
+            template: {"warm": len(warm.get(template, ())), "target": target_size(template)}
+            for template in DOCKER_WARM_TEMPLATES
+        },
+        "latency_seconds": {
+            path: {"samples": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+            for path, values in latencies.items()
+        }
+    }
+
+
+async def pool_worker():
+    """Background loop resizing every template's pool to its recent demand."""
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, recover)
+    except Exception as e:
+        print(f"Warm pool recovery failed: {str(e)}")
+    while True:
+        for template in DOCKER_WARM_TEMPLATES:
+            try:
+                await resize(template)
+            except Exception as e:
+                print(f"Warm pool resize of {template} failed: {str(e)}")
+        await asyncio.sleep(DOCKER_WARM_POOL_INTERVAL_SECONDS)
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import docker
+
+# Seconds between checks for containers that started or stopped
+DOCKER_STATS_SYNC_SECONDS = float(os.getenv("DOCKER_STATS_SYNC_SECONDS", "5"))
+# Points kept in memory per container (the daemon sends one a second: 300 = five minutes)
+DOCKER_STATS_RING_SIZE = int(os.getenv("DOCKER_STATS_RING_SIZE", "300"))
+# Stats streams followed at once. docker-py reads a stats stream with blocking
+# socket calls, so each stream holds one pool thread while its container runs;
+# running containers past this cap get no stats and are listed in `skipped`
+DOCKER_STATS_MAX_STREAMS = int(os.getenv("DOCKER_STATS_MAX_STREAMS", "64"))
+
+# Field order of the compact points stored in the ring buffers
+POINT_FIELDS = (
+    "timestamp", "cpu_percent", "memory_bytes", "memory_limit_bytes",
+    "rx_bytes_per_sec", "tx_bytes_per_sec", "read_bytes_per_sec", "write_bytes_per_sec"
+)
+
+# container id -> deque of points (tuples laid out as POINT_FIELDS)
+history: Dict[str, deque] = {}
+# container id -> (monotonic time, rx, tx, read, write) of the previous sample
+last_counters: Dict[str, tuple] = {}
+# container ids with a stream being read
+streams = set()
+# running container ids left without a stream by the last sync because of DOCKER_STATS_MAX_STREAMS
+skipped = set()
+_streams_lock = threading.Lock()
+_pool = ThreadPoolExecutor(max_workers=DOCKER_STATS_MAX_STREAMS, thread_name_prefix="docker-stats")
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = docker.from_env()
+    return _client
+
+
+def memory_used(memory_stats: dict) -> int:
+    """Memory in use without the page cache, as `docker stats` shows it (cgroup v1 and v2)."""
+    usage = memory_stats.get("usage") or 0
+    stats = memory_stats.get("stats") or {}
+    cache = stats.get("inactive_file", stats.get("total_inactive_file", stats.get("cache", 0)))
+    return max(usage - cache, 0)
+
+
+def block_io(blkio_stats: dict):
+    read = write = 0
+    for entry in (blkio_stats or {}).get("io_service_bytes_recursive") or []:
+        op = entry.get("op", "").lower()
+        if op == "read":
+            read += entry.get("value", 0)
+        elif op == "write":
+            write += entry.get("value", 0)
+    return read, write
+
+
+def record_sample(container_id: str, sample: dict, now: float) -> None:
+    """Turn one streamed stats document into a point in the container's ring buffer."""
+    cpu, precpu = sample.get("cpu_stats") or {}, sample.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (precpu.get("cpu_usage") or {}).get("total_usage", 0)
+    system_delta = (cpu.get("system_cpu_usage") or 0) - (precpu.get("system_cpu_usage") or 0)
+    online_cpus = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    # Same formula as `docker stats`: 100 per fully used host CPU
+    cpu_percent = round(cpu_delta / system_delta * online_cpus * 100, 1) if cpu_delta > 0 and system_delta > 0 else 0.0
+
+    networks = (sample.get("networks") or {}).values()
+    rx = sum(n.get("rx_bytes", 0) for n in networks)
+    tx = sum(n.get("tx_bytes", 0) for n in networks)
+    read, write = block_io(sample.get("blkio_stats"))
+
+    previous = last_counters.get(container_id)
+    last_counters[container_id] = (now, rx, tx, read, write)
+    rates = [0, 0, 0, 0]
+    if previous is not None and now > previous[0]:
+        elapsed = now - previous[0]
+        # Counters restart with the container; clamp instead of going negative
+        rates = [int(max(value - before, 0) / elapsed) for value, before in zip((rx, tx, read, write), previous[1:])]
+
+    memory_stats = sample.get("memory_stats") or {}
+    point = (int(time.time()), cpu_percent, memory_used(memory_stats), memory_stats.get("limit") or 0, *rates)
+    history.setdefault(container_id, deque(maxlen=DOCKER_STATS_RING_SIZE)).append(point)
+
+
+def drop_container(container_id: str) -> None:
+    """Forget the in-memory series of a container that is gone."""
+    history.pop(container_id, None)
+    last_counters.pop(container_id, None)
+
+
+def read_stream(container_id: str) -> None:
+    """
+    Follow one container's stats stream until the daemon ends it (the
+    container stopped or was removed). Runs on a pool thread.
+    """
+    try:
+        for sample in get_client().api.stats(container_id, stream=True, decode=True):
+            record_sample(container_id, sample, time.monotonic())
+    except Exception as e:
+        print(f"⚠️ Stats stream of container {container_id[:12]} ended: {str(e)}")
+    finally:
+        with _streams_lock:
+            streams.discard(container_id)
+        last_counters.pop(container_id, None)
+
+
+def sync_streams() -> int:
+    """Open a stream for every running container that has none; returns the number opened."""
+    running = {c.id for c in get_client().containers.list(sparse=True, filters={"status": "running"})}
+    opened = 0
+    left_out = set()
+    with _streams_lock:
+        for container_id in running - streams:
+            if len(streams) >= DOCKER_STATS_MAX_STREAMS:
+                left_out.add(container_id)
+                continue
+            streams.add(container_id)
+            _pool.submit(read_stream, container_id)
+            opened += 1
+        if left_out and not skipped:
+            print(f"⚠️ Container stats stream limit ({DOCKER_STATS_MAX_STREAMS}) reached: {len(left_out)} running container(s) without stats")
+        skipped.clear()
+        skipped.update(left_out)
+        gone = [container_id for container_id in list(history) if container_id not in running and container_id not in streams]
+    for container_id in gone:
+        drop_container(container_id)
+    return opened
+
+
+async def collector_worker():
+    """Background loop keeping one stats stream open per running container."""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, sync_streams)
+        except Exception as e:
+            print(f"Container stats sync failed: {str(e)}")
+        await asyncio.sleep(DOCKER_STATS_SYNC_SECONDS)
+
+
+def latest(container_id: str) -> Optional[dict]:
+    points = history.get(container_id)
+    return dict(zip(POINT_FIELDS, points[-1])) if points else None
+
+
+def live_points(container_id: str, since: float = 0) -> list:
+    """In-memory points of a container newer than the `since` epoch timestamp."""
+    return [dict(zip(POINT_FIELDS, point)) for point in history.get(container_id, ()) if point[0] > since]
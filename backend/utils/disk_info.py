@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import subprocess
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from utils.qemu_tools import find_qemu_binary
+
+# Probes run in the default thread pool; this caps how many qemu-img processes run at once
+DISK_INFO_CONCURRENCY = int(os.getenv("DISK_INFO_CONCURRENCY", "4"))
+DISK_INFO_CACHE_SIZE = int(os.getenv("DISK_INFO_CACHE_SIZE", "1024"))
+
+
+class BackingImage(BaseModel):
+    filename: str
+    format: Optional[str] = None
+    virtual_size: int
+    actual_size: Optional[int] = None
+
+
+class DiskImageInfo(BaseModel):
+    """Parsed `qemu-img info --output=json --backing-chain` of one image."""
+    filename: str
+    format: str
+    virtual_size: int
+    actual_size: Optional[int] = None
+    cluster_size: Optional[int] = None
+    dirty: bool = False
+    encrypted: bool = False
+    corrupt: Optional[bool] = None
+    compat: Optional[str] = None
+    backing_file: Optional[str] = None
+    backing_format: Optional[str] = None
+    backing_chain: List[BackingImage] = []
+    snapshot_count: int = 0
+
+    def summary(self, name: str) -> str:
+        """Human-readable text in the style of plain `qemu-img info`."""
+        lines = [
+            f"image: {name}",
+            f"file format: {self.format}",
+            f"virtual size: {format_bytes(self.virtual_size)} ({self.virtual_size} bytes)",
+        ]
+        if self.actual_size is not None:
+            lines.append(f"disk size: {format_bytes(self.actual_size)}")
+        if self.cluster_size:
+            lines.append(f"cluster_size: {self.cluster_size}")
+        if self.backing_file:
+            lines.append(f"backing file: {self.backing_file}")
+            if self.backing_format:
+                lines.append(f"backing file format: {self.backing_format}")
+        if self.snapshot_count:
+            lines.append(f"snapshots: {self.snapshot_count}")
+        if self.compat:
+            lines.append(f"compat: {self.compat}")
+        if self.corrupt is not None:
+            lines.append(f"corrupt: {str(self.corrupt).lower()}")
+        lines.append(f"dirty flag: {str(self.dirty).lower()}")
+        return "\n".join(lines) + "\n"
+
+
+def format_bytes(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if value < 1024 or unit == "TiB":
+            return f"{value:g} {unit}" if unit == "B" else f"{value:.3g} {unit}"
+        value /= 1024
+    return f"{size} B"
+
+
+def parse_info(layers: list) -> DiskImageInfo:
+    """Build the model from the JSON list qemu-img prints for a backing chain (top image first)."""
+    top = layers[0]
+    format_data = (top.get("format-specific") or {}).get("data") or {}
+    return DiskImageInfo(
+        filename=top["filename"],
+        format=top["format"],
+        virtual_size=top["virtual-size"],
+        actual_size=top.get("actual-size"),
+        cluster_size=top.get("cluster-size"),
+        dirty=top.get("dirty-flag", False),
+        encrypted=top.get("encrypted", False),
+        corrupt=format_data.get("corrupt"),
+        compat=format_data.get("compat"),
+        backing_file=top.get("full-backing-filename") or top.get("backing-filename"),
+        backing_format=top.get("backing-filename-format"),
+        backing_chain=[
+            BackingImage(
+                filename=layer["filename"],
+                format=layer.get("format"),
+                virtual_size=layer["virtual-size"],
+                actual_size=layer.get("actual-size")
+            )
+            for layer in layers[1:]
+        ],
+        snapshot_count=len(top.get("snapshots") or [])
+    )
+
+
+def run_probe(disk_path: str) -> DiskImageInfo:
+    # -U: read images a running VM holds locked instead of failing
+    command = [find_qemu_binary("qemu-img"), "info", "--output=json", "--backing-chain", "-U", disk_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise HTTPException(status_code=500, detail=f"💥 qemu-img info failed: {result.stderr.strip()}")
+    layers = json.loads(result.stdout)
+    return parse_info(layers if isinstance(layers, list) else [layers])
+
+
+# path -> ((mtime_ns, size), info), least recently used first
+_cache: "OrderedDict[str, Tuple[Tuple[int, int], DiskImageInfo]]" = OrderedDict()
+# path -> probe already running, so concurrent requests for one disk share it
+_in_flight: Dict[str, asyncio.Future] = {}
+_probe_slots = asyncio.Semaphore(DISK_INFO_CONCURRENCY)
+
+
+def invalidate(disk_path: str) -> None:
+    """Drop a cached probe; call after anything rewrites, resizes or renames the image."""
+    _cache.pop(disk_path, None)
+
+
+async def get_disk_info(disk_path: str) -> DiskImageInfo:
+    """Info for an image, probed only when its mtime or size changed since the last probe."""
+    try:
+        st = os.stat(disk_path)
+    except FileNotFoundError:
+        invalidate(disk_path)
+        raise HTTPException(status_code=404, detail=f"Disk '{os.path.basename(disk_path)}' not found in store.")
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _cache.get(disk_path)
+    if cached and cached[0] == key:
+        _cache.move_to_end(disk_path)
+        return cached[1]
+
+    if disk_path in _in_flight:
+        return await asyncio.shield(_in_flight[disk_path])
+    future = asyncio.get_event_loop().create_future()
+    _in_flight[disk_path] = future
+    try:
+        async with _probe_slots:
+            loop = asyncio.get_event_loop()
+            info = await loop.run_in_executor(None, run_probe, disk_path)
+        _cache[disk_path] = (key, info)
+        _cache.move_to_end(disk_path)
+        while len(_cache) > DISK_INFO_CACHE_SIZE:
+            _cache.popitem(last=False)
+        future.set_result(info)
+        return info
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Waiters re-raise it; mark it retrieved so asyncio doesn't warn when there are none
+        future.exception()
+        raise
+    finally:
+        del _in_flight[disk_path]
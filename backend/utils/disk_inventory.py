@@ -0,0 +1,238 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+from datetime import datetime
+from typing import Iterable, Optional
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument, UpdateOne
+
+from database import db
+from utils import disk_info, storage_quota
+from utils.qemu_tools import get_store_dir
+
+# Files in store/ that are tracked as disk images
+DISK_EXTENSIONS = (".qcow2", ".raw", ".img", ".vmdk", ".vhdx", ".vdi")
+# Full store scan interval; the inotify watcher handles changes in between
+DISK_RECONCILE_SECONDS = int(os.getenv("DISK_RECONCILE_SECONDS", "300"))
+# Events for one file within this window are folded into a single refresh
+DISK_WATCH_DEBOUNCE_SECONDS = float(os.getenv("DISK_WATCH_DEBOUNCE_SECONDS", "1"))
+
+# inotify(7) constants. IN_MODIFY is left out on purpose: a running guest
+# would fire it on every write; those size changes are picked up by the reconciler.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+# Disk names with a pending refresh; None asks for a full reconcile
+_pending = set()
+_wakeup: Optional[asyncio.Event] = None
+
+
+def is_disk_file(name: str) -> bool:
+    return name.endswith(DISK_EXTENSIONS) and not name.startswith(".")
+
+
+async def attached_vms(disk_names: Iterable[str]) -> dict:
+    """disk_name -> [{vm_id, user_email}] from the vms collection."""
+    attached = {name: [] for name in disk_names}
+    cursor = db.vms.find({"disk_name": {"$in": list(attached)}}, {"disk_name": 1, "user_email": 1})
+    async for vm in cursor:
+        attached[vm["disk_name"]].append({"vm_id": str(vm["_id"]), "user_email": vm["user_email"]})
+    return attached
+
+
+async def refresh_disk(disk_name: str, owner_email: Optional[str] = None) -> Optional[dict]:
+    """
+    Bring one disk's record in line with the file in store/.
+
+    The owner is kept once set; records for files that appeared without an
+    API call (copied in, restored) get the owner of the first VM using them.
+    """
+    disk_path = os.path.join(get_store_dir(), disk_name)
+    try:
+        info = await disk_info.get_disk_info(disk_path)
+        st = os.stat(disk_path)
+    except (HTTPException, OSError) as e:
+        if not os.path.exists(disk_path):
+            await remove_disk(disk_name)
+            return None
+        print(f"⚠️ Could not index disk {disk_name}: {getattr(e, 'detail', str(e))}")
+        return None
+
+    vms = (await attached_vms([disk_name]))[disk_name]
+    fields = {
+        "format": info.format,
+        "virtual_size": info.virtual_size,
+        "actual_size": info.actual_size,
+        "backing_file": info.backing_file,
+        "attached_vms": vms,
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "updated_at": datetime.utcnow()
+    }
+    on_insert = {"created_at": datetime.utcnow()}
+    if owner_email:
+        fields["owner_email"] = owner_email
+    else:
+        on_insert["owner_email"] = vms[0]["user_email"] if vms else None
+    old = await db.disks.find_one_and_update(
+        {"_id": disk_name}, {"$set": fields, "$setOnInsert": on_insert},
+        upsert=True, return_document=ReturnDocument.BEFORE
+    )
+    await account(old, {**(old or on_insert), **fields})
+    return fields
+
+
+async def account(old: Optional[dict], new: Optional[dict]) -> None:
+    """Carry a record change over to its owner's storage usage counters."""
+    for email, allocated, actual, disks in storage_quota.record_delta(old, new):
+        await storage_quota.apply_delta(email, allocated, actual, disks)
+
+
+async def remove_disk(disk_name: str) -> Optional[dict]:
+    old = await db.disks.find_one_and_delete({"_id": disk_name})
+    await account(old, None)
+    return old
+
+
+async def rename_disk(old_name: str, new_name: str) -> None:
+    """Move a record to a disk's new filename, keeping its owner."""
+    record = await remove_disk(old_name)
+    await refresh_disk(new_name, record.get("owner_email") if record else None)
+
+
+async def sync_attachments(disk_names: Iterable[str]) -> None:
+    """Recompute attached_vms after VMs were created, deleted or pointed at another disk."""
+    names = [name for name in set(disk_names) if name]
+    if not names:
+        return
+    operations = []
+    adopters = {}
+    for name, vms in (await attached_vms(names)).items():
+        operations.append(UpdateOne({"_id": name}, {"$set": {"attached_vms": vms}}))
+        if vms:
+            adopters[name] = vms[0]["user_email"]
+    await db.disks.bulk_write(operations, ordered=False)
+    for name, email in adopters.items():
+        # Adopt disks nobody has claimed yet; the owner condition makes this a no-op for owned disks
+        old = await db.disks.find_one_and_update(
+            {"_id": name, "owner_email": None},
+            {"$set": {"owner_email": email}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if old:
+            await account(old, {**old, "owner_email": email})
+
+
+async def user_owns_disk(disk_name: str, email: str) -> bool:
+    """Whether the user owns the disk or has a VM using it."""
+    if await db.disks.count_documents({"_id": disk_name, "owner_email": email}, limit=1):
+        return True
+    return bool(await db.vms.count_documents({"disk_name": disk_name, "user_email": email}, limit=1))
+
+
+async def reconcile() -> dict:
+    """Full pass over store/: index new or changed files, drop records of missing ones."""
+    store_dir = get_store_dir()
+    os.makedirs(store_dir, exist_ok=True)
+    on_disk = {}
+    with os.scandir(store_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and is_disk_file(entry.name):
+                st = entry.stat()
+                on_disk[entry.name] = (st.st_mtime_ns, st.st_size)
+
+    known = {}
+    async for record in db.disks.find({}, {"mtime_ns": 1, "size": 1}):
+        known[record["_id"]] = (record.get("mtime_ns"), record.get("size"))
+
+    changed = [name for name, key in on_disk.items() if known.get(name) != key]
+    for name in changed:
+        await refresh_disk(name)
+    removed = [name for name in known if name not in on_disk]
+    for name in removed:
+        await remove_disk(name)
+    # Attachments drift as VMs come and go; refresh them for everything unchanged too
+    await sync_attachments(name for name in on_disk if name not in changed)
+    return {"indexed": len(changed), "removed": len(removed), "total": len(on_disk)}
+
+
+def _queue(name: Optional[str]) -> None:
+    _pending.add(name)
+    _wakeup.set()
+
+
+def _watch_store(store_dir: str, loop: asyncio.AbstractEventLoop) -> None:
+    """Blocking inotify read loop, run in a daemon thread."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0 or libc.inotify_add_watch(fd, store_dir.encode(), WATCH_MASK) < 0:
+        print(f"⚠️ inotify unavailable for {store_dir} (errno {ctypes.get_errno()}); relying on the reconciler")
+        return
+    print(f"👀 Watching {store_dir} for disk changes")
+    while True:
+        data = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_len].rstrip(b"\0").decode(errors="replace")
+            offset += EVENT_HEADER.size + name_len
+            if mask & IN_Q_OVERFLOW:
+                loop.call_soon_threadsafe(_queue, None)
+            elif is_disk_file(name):
+                loop.call_soon_threadsafe(_queue, name)
+
+
+async def inventory_worker():
+    """Reconcile at startup and periodically, and apply watcher events in between."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    store_dir = get_store_dir()
+    os.makedirs(store_dir, exist_ok=True)
+    if os.name != 'nt':
+        threading.Thread(target=_watch_store, args=(store_dir, loop), daemon=True, name="disk-watcher").start()
+
+    next_reconcile = 0.0
+    while True:
+        if loop.time() >= next_reconcile:
+            _pending.discard(None)
+            try:
+                result = await reconcile()
+                if result["indexed"] or result["removed"]:
+                    print(f"🗂️ Disk inventory reconciled: {result}")
+                # Usage counters are kept incrementally; the recount only fixes drift
+                corrections = await storage_quota.reconcile_usage()
+                if corrections:
+                    print(f"🗂️ Storage usage corrected for {corrections} record(s)")
+            except Exception as e:
+                print(f"Disk inventory reconcile failed: {str(e)}")
+            next_reconcile = loop.time() + DISK_RECONCILE_SECONDS
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), max(next_reconcile - loop.time(), 0.1))
+        except asyncio.TimeoutError:
+            continue
+        # Let a burst of events (e.g. a copy in progress) settle first
+        await asyncio.sleep(DISK_WATCH_DEBOUNCE_SECONDS)
+        _wakeup.clear()
+        names = set(_pending)
+        _pending.clear()
+        if None in names:
+            next_reconcile = 0.0
+            continue
+        for name in names:
+            try:
+                await refresh_disk(name)
+            except Exception as e:
+                print(f"Disk inventory update for {name} failed: {str(e)}")
@@ -0,0 +1,106 @@
+import errno
+import os
+from typing import Iterator, Tuple
+
+from utils.qemu_tools import get_store_dir
+
+# Bytes read, compressed or written per step; memory per transfer stays around this
+TRANSFER_CHUNK_BYTES = int(os.getenv("DISK_TRANSFER_CHUNK_BYTES", str(4 * 1024 * 1024)))
+EXPORT_ZSTD_LEVEL = int(os.getenv("DISK_EXPORT_ZSTD_LEVEL", "3"))
+# Largest single import chunk accepted per request
+IMPORT_MAX_CHUNK_BYTES = int(os.getenv("DISK_IMPORT_MAX_CHUNK_BYTES", str(512 * 1024 * 1024)))
+
+
+def export_dir() -> str:
+    """Scratch space for export copies; inside store/ so it shares its filesystem."""
+    path = os.path.join(get_store_dir(), ".exports")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def upload_dir() -> str:
+    """Partial imports live here until their last chunk arrives."""
+    path = os.path.join(get_store_dir(), ".uploads")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def data_extents(fd: int, size: int) -> Iterator[Tuple[int, int, bool]]:
+    """
+    Yield (start, end, is_data) ranges covering a file.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE; where the OS or filesystem
+    doesn't support them the whole file is reported as one data range.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size, True
+        return
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO: only a hole is left up to EOF; anything else: no SEEK_DATA support here
+            yield offset, size, e.errno != errno.ENXIO
+            return
+        if data_start > offset:
+            yield offset, data_start, False
+        if data_start >= size:
+            return
+        data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+        yield data_start, data_end, True
+        offset = data_end
+
+
+def iter_zstd_raw(path: str, remove_after: bool = False) -> Iterator[bytes]:
+    """
+    Stream a raw image as one zstd frame.
+
+    Data ranges are read with pread; holes are never read and are fed to the
+    compressor as zeros, which compress to almost nothing.
+    """
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=EXPORT_ZSTD_LEVEL).compressobj()
+    zeros = bytes(TRANSFER_CHUNK_BYTES)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for start, end, is_data in data_extents(fd, size):
+            position = start
+            while position < end:
+                length = min(TRANSFER_CHUNK_BYTES, end - position)
+                chunk = os.pread(fd, length, position) if is_data else zeros[:length]
+                if not chunk:
+                    break
+                position += len(chunk)
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    yield compressed
+        yield compressor.flush()
+    finally:
+        os.close(fd)
+        if remove_after:
+            os.remove(path)
+
+
+def write_chunk(path: str, offset: int, chunks) -> int:
+    """
+    Write buffered upload chunks to a partial file at offset; return the new size.
+
+    All-zero chunks are skipped so the file keeps holes where the source had
+    them, and the file is truncated to offset first to drop any bytes a
+    previous, interrupted request left behind.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, offset)
+        position = offset
+        for chunk in chunks:
+            if chunk.count(0) != len(chunk):
+                os.pwrite(fd, chunk, position)
+            position += len(chunk)
+        # Extends the file over a trailing run of skipped zeros
+        os.ftruncate(fd, position)
+        return position
+    finally:
+        os.close(fd)
@@ -0,0 +1,399 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import uuid
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import docker
+from fastapi import HTTPException
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only this process's own builds are protected from pruning
+    fcntl = None
+
+# Name of the Dockerfile inside every build context
+CONTEXT_DOCKERFILE = "Dockerfile"
+# Cap on the declared files sent along with a Dockerfile
+BUILD_CONTEXT_MAX_BYTES = int(os.getenv("DOCKER_BUILD_CONTEXT_MAX_BYTES", str(10 * 1024 * 1024)))
+
+
+def context_path(path: str) -> str:
+    """Normalized relative path for a declared context file; rejects paths leaving the context."""
+    normalized = posixpath.normpath(path.replace("\\", "/"))
+    if not path or normalized.startswith(("/", "../")) or normalized in (".", "..", CONTEXT_DOCKERFILE):
+        raise HTTPException(status_code=400, detail=f"Invalid build context path '{path}'")
+    return normalized
+
+
+def build_context(dockerfile: str, files: Optional[Dict[str, str]] = None) -> io.BytesIO:
+    """
+    Tar a build context in memory: the Dockerfile plus the declared files.
+
+    Entries get fixed owners and timestamps, so the same inputs always give
+    the same bytes regardless of when or where the context was built.
+    """
+    entries = {CONTEXT_DOCKERFILE: dockerfile.encode("utf-8")}
+    for path, content in (files or {}).items():
+        entries[context_path(path)] = content.encode("utf-8")
+    total = sum(len(data) for data in entries.values())
+    if total > BUILD_CONTEXT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Build context is {total} bytes; the limit is {BUILD_CONTEXT_MAX_BYTES}")
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path in sorted(entries):
+            data = entries[path]
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+
+async def classic_build(client, context: io.BytesIO, image_tag: str) -> AsyncIterator[dict]:
+    """
+    Build through the daemon's API, yielding its decoded progress entries.
+
+    docker-py reads the build stream with blocking socket calls, so the stream
+    is consumed on a thread of its own and handed to the event loop through a
+    queue; other requests and the build queue's heartbeat keep running.
+    """
+    loop = asyncio.get_event_loop()
+    entries: asyncio.Queue = asyncio.Queue()
+    finished = object()
+    stop = threading.Event()
+
+    def hand_over(item, error=None):
+        try:
+            loop.call_soon_threadsafe(entries.put_nowait, (item, error))
+        except RuntimeError:
+            # The event loop is gone (server shutdown); nobody is waiting
+            stop.set()
+
+    def read():
+        try:
+            stream = client.api.build(
+                fileobj=context,
+                custom_context=True,
+                dockerfile=CONTEXT_DOCKERFILE,
+                tag=image_tag,
+                rm=True,
+                decode=True
+            )
+            for entry in stream:
+                if stop.is_set():
+                    break
+                hand_over(entry)
+            hand_over(finished)
+        except Exception as e:
+            hand_over(finished, e)
+
+    threading.Thread(target=read, name=f"docker-build-{image_tag}", daemon=True).start()
+    try:
+        while True:
+            entry, error = await entries.get()
+            if entry is finished:
+                if error is not None:
+                    raise error
+                return
+            yield entry
+    finally:
+        # Stops the reader after its next entry when the caller gives up early
+        stop.set()
+
+
+# Content-addressed copies of Dockerfile versions, written when a build needs one
+DOCKERFILE_CACHE_DIR = os.getenv(
+    "DOCKERFILE_CACHE_DIR",
+    os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "dockerfiles", ".cache")
+)
+# Cached Dockerfiles kept before the least recently used ones are removed
+DOCKERFILE_CACHE_MAX_FILES = int(os.getenv("DOCKERFILE_CACHE_MAX_FILES", "500"))
+# Versions kept in each Dockerfile's history
+DOCKERFILE_MAX_VERSIONS = int(os.getenv("DOCKERFILE_MAX_VERSIONS", "20"))
+
+
+def dockerfile_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def dockerfile_cache_path(content_hash: str) -> str:
+    return os.path.join(DOCKERFILE_CACHE_DIR, f"{content_hash}.Dockerfile")
+
+
+def materialize_dockerfile(content: str) -> str:
+    """
+    Path of a file holding `content`, written once per distinct content.
+
+    Files are named by their hash and never modified, so concurrent builds
+    can share them; a new file is written to a temp name and renamed in.
+    """
+    path = dockerfile_cache_path(dockerfile_hash(content))
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(DOCKERFILE_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=DOCKERFILE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+    cached = [entry for entry in os.scandir(DOCKERFILE_CACHE_DIR) if entry.name.endswith(".Dockerfile")]
+    if len(cached) > DOCKERFILE_CACHE_MAX_FILES:
+        cached.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in cached[:len(cached) - DOCKERFILE_CACHE_MAX_FILES]:
+            if entry.path != path:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    return path
+
+
+# FROM [--platform=...] image [AS name]
+FROM_PATTERN = re.compile(r"^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?", re.IGNORECASE | re.MULTILINE)
+
+
+def base_images(dockerfile: str) -> List[str]:
+    """Images a Dockerfile builds on, in order, leaving out `scratch` and earlier stages."""
+    images, stages = [], set()
+    for match in FROM_PATTERN.finditer(dockerfile):
+        image, stage = match.group(1), match.group(2)
+        if image.lower() not in stages and image.lower() != "scratch" and image not in images:
+            images.append(image)
+        if stage:
+            stages.add(stage.lower())
+    return images
+
+
+def content_key(client, context: bytes, dockerfile: str) -> Optional[str]:
+    """
+    Hash of a build's inputs: the context bytes and the local ID of every base image.
+
+    Returns None when the result can't be predicted: a base image is missing
+    locally (the build would pull whatever is current) or its name comes from
+    a build ARG.
+    """
+    digest = hashlib.sha256(context)
+    for image in base_images(dockerfile):
+        if "$" in image:
+            return None
+        try:
+            digest.update(f"\0{image}={client.images.get(image).id}".encode())
+        except docker.errors.ImageNotFound:
+            return None
+    return digest.hexdigest()
+
+
+# "classic" builds through the daemon's API; "buildkit" runs `docker buildx build`
+DOCKER_BUILD_ENGINE = os.getenv("DOCKER_BUILD_ENGINE", "classic")
+BUILD_ENGINES = ("classic", "buildkit")
+# Local layer caches, one directory per user
+BUILDKIT_CACHE_DIR = os.getenv(
+    "BUILDKIT_CACHE_DIR",
+    os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)), "build-cache")
+)
+# docker-container builder used for BuildKit builds (the default docker driver can't export caches)
+BUILDX_BUILDER = os.getenv("BUILDX_BUILDER", "virtcloud")
+
+# "#5 [stage-1 2/4] RUN ...", "#5 CACHED", "#5 DONE 1.2s"
+BUILDKIT_STEP_PATTERN = re.compile(r"^#(\d+) \[(?!internal\])[^\]]*\d+/\d+\]")
+BUILDKIT_CACHED_PATTERN = re.compile(r"^#(\d+) CACHED")
+
+
+def check_engine(engine: Optional[str]) -> str:
+    engine = engine or DOCKER_BUILD_ENGINE
+    if engine not in BUILD_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown build engine '{engine}'. Available: {', '.join(BUILD_ENGINES)}")
+    if engine == "buildkit" and not buildx_available():
+        raise HTTPException(status_code=503, detail="BuildKit builds need the docker CLI with the buildx plugin on the server")
+    return engine
+
+
+@lru_cache(maxsize=1)
+def buildx_available() -> bool:
+    if shutil.which("docker") is None:
+        return False
+    return subprocess.run(["docker", "buildx", "version"], capture_output=True).returncode == 0
+
+
+def ensure_builder() -> None:
+    """Create the docker-container buildx builder on first use."""
+    if subprocess.run(["docker", "buildx", "inspect", BUILDX_BUILDER], capture_output=True).returncode != 0:
+        result = subprocess.run(
+            ["docker", "buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container"],
+            capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not create buildx builder: {result.stderr.strip()}")
+
+
+def user_cache_dir(user_email: str) -> str:
+    """
+    Per-user BuildKit cache, so users never share (or poison) each other's layers.
+
+    The path is a symlink to the user's current cache version; every build
+    exports a new version next to it and swaps the link.
+    """
+    key = hashlib.sha256(user_email.lower().encode()).hexdigest()[:16]
+    return os.path.join(BUILDKIT_CACHE_DIR, key)
+
+
+# In-process count of builds reading or writing each cache version (flock covers other processes)
+_cache_version_users: Dict[str, int] = {}
+
+
+def _use_cache_version(path: str):
+    """Mark a cache version as in use until _release_cache_version; pruning skips it."""
+    _cache_version_users[path] = _cache_version_users.get(path, 0) + 1
+    handle = open(path + ".lock", "a+")
+    if fcntl is not None:
+        fcntl.flock(handle, fcntl.LOCK_SH)
+    return path, handle
+
+
+def _release_cache_version(use) -> None:
+    path, handle = use
+    handle.close()
+    _cache_version_users[path] -= 1
+    if not _cache_version_users[path]:
+        del _cache_version_users[path]
+
+
+def _swap_cache(cache_dir: str, version_dir: str) -> None:
+    """Point cache_dir at a new version atomically; builds that already started keep theirs."""
+    if os.path.isdir(cache_dir) and not os.path.islink(cache_dir):
+        # A cache from before versioning: keep it as an old version so pruning handles it
+        os.rename(cache_dir, f"{cache_dir}.v{uuid.uuid4().hex[:8]}-legacy")
+    link = f"{version_dir}.link"
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, cache_dir)
+
+
+def _prune_cache_versions(cache_dir: str) -> None:
+    """Remove a user's old cache versions that no build is reading or writing anymore."""
+    current = os.path.realpath(cache_dir)
+    prefix = os.path.basename(cache_dir) + ".v"
+    for name in os.listdir(BUILDKIT_CACHE_DIR):
+        path = os.path.join(BUILDKIT_CACHE_DIR, name)
+        if not name.startswith(prefix) or not os.path.isdir(path) or path == current or path in _cache_version_users:
+            continue
+        with open(path + ".lock", "a+") as handle:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another server process is still using it
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.remove(path + ".lock")
+        except OSError:
+            pass
+
+
+async def buildkit_build(context: io.BytesIO, image_tag: str, cache_dir: str,
+                         log: Callable[[str], Awaitable[None]]) -> dict:
+    """
+    Build with `docker buildx build`, importing and exporting a local layer cache.
+
+    Independent stages run in parallel inside BuildKit. Progress lines go to
+    `log` as they arrive. Returns the image id and how many build steps were
+    served from cache. Concurrent builds of one user each read the version
+    that was current when they started; the last to finish becomes current.
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, ensure_builder)
+    os.makedirs(BUILDKIT_CACHE_DIR, exist_ok=True)
+    # Export into a fresh version and swap it in; exporting over the import
+    # source would keep every old layer forever
+    version_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + ".v", dir=BUILDKIT_CACHE_DIR)
+    work_dir = tempfile.mkdtemp(prefix="buildkit-")
+    metadata_file = os.path.join(work_dir, "metadata.json")
+    uses = [_use_cache_version(version_dir)]
+    command = [
+        "docker", "buildx", "build",
+        "--builder", BUILDX_BUILDER,
+        "--progress", "plain",
+        "--cache-to", f"type=local,dest={version_dir},mode=max",
+        "--metadata-file", metadata_file,
+        "--load",
+        "-t", image_tag,
+        "-f", CONTEXT_DOCKERFILE,
+        "-"
+    ]
+    if os.path.isdir(cache_dir):
+        source = os.path.realpath(cache_dir)
+        uses.append(_use_cache_version(source))
+        command[5:5] = ["--cache-from", f"type=local,src={source}"]
+
+    steps, cached = set(), set()
+    swapped = False
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        # The context is small (see build_context); write it and close stdin
+        process.stdin.write(context.getvalue())
+        await process.stdin.drain()
+        process.stdin.close()
+        async for raw in process.stdout:
+            line = raw.decode(errors="replace").rstrip()
+            if not line:
+                continue
+            step = BUILDKIT_STEP_PATTERN.match(line)
+            if step:
+                steps.add(step.group(1))
+            hit = BUILDKIT_CACHED_PATTERN.match(line)
+            if hit:
+                cached.add(hit.group(1))
+            await log(line)
+        if await process.wait() != 0:
+            raise RuntimeError(f"docker buildx build exited with status {process.returncode}")
+
+        with open(metadata_file, encoding="utf-8") as f:
+            metadata = json.load(f)
+        # The image is built and loaded; a cache that can't be swapped in only costs the next build time
+        try:
+            _swap_cache(cache_dir, version_dir)
+            swapped = True
+        except OSError as e:
+            await log(f"WARNING: BuildKit cache not updated: {str(e)}")
+    finally:
+        for use in uses:
+            _release_cache_version(use)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not swapped:
+            shutil.rmtree(version_dir, ignore_errors=True)
+            try:
+                os.remove(version_dir + ".lock")
+            except OSError:
+                pass
+    try:
+        _prune_cache_versions(cache_dir)
+    except OSError as e:
+        await log(f"WARNING: Old BuildKit cache versions not removed: {str(e)}")
+
+    return {
+        "image_id": metadata.get("containerimage.config.digest"),
+        "cache": {
+            "steps": len(steps),
+            "cached": len(cached & steps),
+            "hit_rate": round(len(cached & steps) / len(steps), 3) if steps else None
+        }
+    }
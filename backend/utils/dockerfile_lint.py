@@ -0,0 +1,249 @@
+import asyncio
+import json
+import os
+import re
+import shlex
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+from database import db
+
+# Bump when rules change so cached results for unchanged content are recomputed
+RULES_VERSION = 2
+# Processes linting Dockerfiles off the event loop
+DOCKERFILE_LINT_WORKERS = int(os.getenv("DOCKERFILE_LINT_WORKERS", "2"))
+# Layer-creating instructions (RUN/COPY/ADD) in one stage before it is flagged
+DOCKERFILE_MAX_LAYERS = int(os.getenv("DOCKERFILE_MAX_LAYERS", "20"))
+
+INSTRUCTIONS = {
+    "ADD", "ARG", "CMD", "COPY", "ENTRYPOINT", "ENV", "EXPOSE", "FROM", "HEALTHCHECK", "LABEL",
+    "MAINTAINER", "ONBUILD", "RUN", "SHELL", "STOPSIGNAL", "USER", "VOLUME", "WORKDIR"
+}
+LAYER_INSTRUCTIONS = {"RUN", "COPY", "ADD"}
+# Instructions that take BuildKit heredocs (`RUN <<EOF` ... `EOF`)
+HEREDOC_INSTRUCTIONS = {"RUN", "COPY", "ADD"}
+HEREDOC_PATTERN = re.compile(r"<<(-?)([\"']?)([A-Za-z_][A-Za-z0-9_]*)\2")
+INSTRUCTION_PATTERN = re.compile(r"^\s*([A-Za-z]+)(?:\s+(.*))?$", re.DOTALL)
+DIRECTIVE_PATTERN = re.compile(r"^#\s*(\w+)\s*=\s*(\S+)\s*$")
+
+_pool = None
+
+
+def parse(content: str) -> List[dict]:
+    """
+    Split a Dockerfile into instructions: {"line", "instruction", "args"}.
+
+    Handles line continuations (with the `escape` parser directive), comments
+    and blank lines inside continued instructions the way the builder does.
+    Heredoc bodies of RUN/COPY/ADD are kept in the instruction's args, one
+    line each, so they are never read as instructions of their own.
+    """
+    escape = "\\"
+    instructions = []
+    lines = content.splitlines()
+    index = 0
+    # Parser directives are only recognised before the first instruction or comment
+    while index < len(lines):
+        directive = DIRECTIVE_PATTERN.match(lines[index].strip())
+        if not directive:
+            break
+        if directive.group(1).lower() == "escape" and directive.group(2) in ("\\", "`"):
+            escape = directive.group(2)
+        index += 1
+
+    while index < len(lines):
+        start = index
+        line = lines[index].strip()
+        index += 1
+        if not line or line.startswith("#"):
+            continue
+        parts = []
+        while line.endswith(escape):
+            parts.append(line[:-1])
+            line = ""
+            while index < len(lines):
+                following = lines[index].strip()
+                index += 1
+                if following and not following.startswith("#"):
+                    line = following
+                    break
+        parts.append(line)
+        match = INSTRUCTION_PATTERN.match(" ".join(part.strip() for part in parts))
+        if match:
+            name, args = match.group(1).upper(), (match.group(2) or "").strip()
+            if name in HEREDOC_INSTRUCTIONS:
+                # Bodies follow the instruction in the order their markers appear
+                for heredoc in HEREDOC_PATTERN.finditer(args):
+                    strip_tabs, terminator = heredoc.group(1) == "-", heredoc.group(3)
+                    while index < len(lines):
+                        body = lines[index]
+                        index += 1
+                        if (body.lstrip("\t") if strip_tabs else body) == terminator:
+                            break
+                        args += "\n" + body
+            instructions.append({"line": start + 1, "instruction": name, "args": args})
+        else:
+            instructions.append({"line": start + 1, "instruction": "", "args": line})
+    return instructions
+
+
+def looks_like_dockerfile(text: str) -> bool:
+    """True if the text parses as at least one known instruction and nothing else."""
+    instructions = parse(text)
+    return bool(instructions) and all(i["instruction"] in INSTRUCTIONS for i in instructions)
+
+
+def _finding(rule: str, severity: str, line: Optional[int], message: str) -> dict:
+    return {"rule": rule, "severity": severity, "line": line, "message": message}
+
+
+def _from_parts(args: str):
+    """(image, stage alias) of a FROM instruction, skipping flags like --platform."""
+    words = [w for w in args.split() if not w.startswith("--")]
+    image = words[0] if words else ""
+    alias = words[2] if len(words) >= 3 and words[1].upper() == "AS" else None
+    return image, alias
+
+
+def _run_commands(args: str) -> str:
+    """Shell text of a RUN, whether written in shell or exec (JSON) form."""
+    if args.startswith("["):
+        try:
+            return " ".join(json.loads(args))
+        except ValueError:
+            return args
+    return args
+
+
+def _copy_sources(args: str) -> List[str]:
+    # Heredoc bodies after the first line are file contents, not sources
+    args = args.split("\n", 1)[0]
+    if args.startswith("["):
+        try:
+            words = json.loads(args)
+        except ValueError:
+            return []
+    else:
+        try:
+            words = shlex.split(args)
+        except ValueError:
+            words = args.split()
+    words = [w for w in words if not w.startswith("--")]
+    return words[:-1]
+
+
+def lint(content: str) -> dict:
+    """Run every rule over a Dockerfile; returns findings ordered by line plus counts per severity."""
+    instructions = parse(content)
+    findings = []
+    stages = set()
+    seen_from = False
+    layers = 0
+    stage_line = None
+
+    for i, instruction in enumerate(instructions):
+        name, args, line = instruction["instruction"], instruction["args"], instruction["line"]
+        if name not in INSTRUCTIONS:
+            findings.append(_finding("unknown-instruction", "error", line, f"Unknown instruction '{name or args[:30]}'"))
+            continue
+
+        if name == "FROM":
+            if seen_from and layers > DOCKERFILE_MAX_LAYERS:
+                findings.append(_finding("too-many-layers", "warning", stage_line,
+                                         f"Stage creates {layers} layers; combine RUN steps (limit {DOCKERFILE_MAX_LAYERS})"))
+            seen_from, layers, stage_line = True, 0, line
+            image, alias = _from_parts(args)
+            if not image:
+                findings.append(_finding("missing-from", "error", line, "FROM needs an image"))
+            elif image.lower() not in stages and image.lower() != "scratch" and "$" not in image and "@" not in image:
+                # The tag is after the last ':' that follows the last '/' (registry ports have ':' too)
+                last = image.rsplit("/", 1)[-1]
+                if ":" not in last:
+                    findings.append(_finding("unpinned-base", "warning", line,
+                                             f"Base image '{image}' has no tag and floats with 'latest'; pin a version"))
+                elif last.rsplit(":", 1)[1] == "latest":
+                    findings.append(_finding("unpinned-base", "warning", line,
+                                             f"Base image '{image}' uses 'latest'; pin a version so rebuilds are repeatable"))
+            if alias:
+                stages.add(alias.lower())
+            continue
+
+        if not seen_from and name != "ARG":
+            findings.append(_finding("missing-from", "error", line, f"{name} comes before any FROM"))
+            seen_from = True
+
+        if name in LAYER_INSTRUCTIONS:
+            layers += 1
+
+        if name == "RUN":
+            commands = _run_commands(args)
+            if re.search(r"\bapt(?:-get)?\s+(?:-\S+\s+)*install\b", commands) and "/var/lib/apt/lists" not in commands:
+                findings.append(_finding("apt-cache", "warning", line,
+                                         "apt install without 'rm -rf /var/lib/apt/lists/*' in the same RUN leaves the package index in the layer"))
+            if re.search(r"\bapk\s+add\b", commands) and "--no-cache" not in commands and "/var/cache/apk" not in commands:
+                findings.append(_finding("apk-cache", "warning", line, "apk add without --no-cache keeps the package index in the layer"))
+            if re.search(r"\bpip3?\s+install\b", commands) and "--no-cache-dir" not in commands:
+                findings.append(_finding("pip-cache", "info", line, "pip install without --no-cache-dir keeps wheels in the layer"))
+            # Reported once, at the second RUN of each chain
+            previous = [instructions[j]["instruction"] for j in range(max(0, i - 2), i)]
+            if previous[-1:] == ["RUN"] and previous != ["RUN", "RUN"]:
+                findings.append(_finding("consecutive-run", "info", line, "Consecutive RUN instructions; chain them with && to save a layer"))
+
+        if name in ("COPY", "ADD"):
+            for source in _copy_sources(args):
+                if source in (".", "./", "*", "./*"):
+                    findings.append(_finding("copy-whole-context", "warning", line,
+                                             f"{name} {source} sends the whole build context into the layer; copy only the files needed"))
+                    break
+                if name == "ADD" and re.match(r"https?://", source):
+                    findings.append(_finding("add-url", "info", line, "ADD of a URL is not cached by checksum; prefer RUN curl in a cleaned-up step"))
+
+    if not seen_from:
+        findings.append(_finding("missing-from", "error", None, "No FROM instruction; every Dockerfile needs a base image"))
+    elif layers > DOCKERFILE_MAX_LAYERS:
+        findings.append(_finding("too-many-layers", "warning", stage_line,
+                                 f"Stage creates {layers} layers; combine RUN steps (limit {DOCKERFILE_MAX_LAYERS})"))
+
+    findings.sort(key=lambda f: (f["line"] is None, f["line"] or 0))
+    summary = {severity: sum(1 for f in findings if f["severity"] == severity) for severity in ("error", "warning", "info")}
+    return {"findings": findings, "summary": summary, "instructions": len(instructions)}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=DOCKERFILE_LINT_WORKERS)
+    return _pool
+
+
+async def lint_cached(content_hash: str, content: str) -> dict:
+    """
+    Lint results for a Dockerfile version, computed once per content hash.
+
+    Results live in the dockerfile_lint collection, so every user and version
+    with the same content shares them.
+    """
+    key = f"{content_hash}:{RULES_VERSION}"
+    cached = await db.dockerfile_lint.find_one({"_id": key})
+    if cached:
+        return cached["result"]
+    loop = asyncio.get_event_loop()
+    result = await loop.run_in_executor(_get_pool(), lint, content)
+    await db.dockerfile_lint.update_one(
+        {"_id": key},
+        {"$set": {"result": result, "linted_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return result
+
+
+def lint_in_background(content_hash: str, content: str) -> None:
+    """Start linting a just-saved Dockerfile without delaying the save response."""
+    async def run():
+        try:
+            result = await lint_cached(content_hash, content)
+            print(f"🔎 Dockerfile {content_hash[:12]} linted: {result['summary']}")
+        except Exception as e:
+            print(f"Dockerfile lint failed: {str(e)}")
+    asyncio.get_event_loop().create_task(run())
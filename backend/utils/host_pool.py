@@ -0,0 +1,210 @@
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+from fastapi import HTTPException
+
+from database import db
+from utils import vm_scheduler
+from utils.proc_stats import local_host_stats, sample_processes
+from utils.qemu_tools import find_qemu_binary, spawn_vm_process, terminate_process
+from utils.vnc_console import UnixConsole, AgentConsole
+from utils.qmp import QMPError, qmp_execute
+
+# VM records without a host_id were launched on the API server itself
+LOCAL_HOST_ID = "local"
+# Shared secret sent to host agents in the X-Agent-Token header
+AGENT_TOKEN = os.getenv("AGENT_TOKEN", "")
+AGENT_TIMEOUT_SECONDS = float(os.getenv("AGENT_TIMEOUT_SECONDS", "10"))
+
+
+class LocalHost:
+    """Runs QEMU directly on the API server host."""
+
+    host_id = LOCAL_HOST_ID
+
+    async def stats(self, pids) -> dict:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, local_host_stats, pids)
+
+    async def samples(self, pids) -> dict:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, sample_processes, pids, True)
+
+    async def spawn(self, vm: dict, include_iso: bool) -> dict:
+        exe = find_qemu_binary("qemu-system-x86_64")
+        loop = asyncio.get_event_loop()
+        process, placement = await loop.run_in_executor(None, spawn_vm_process, exe, vm, include_iso)
+        return {"pid": process.pid, **placement}
+
+    async def stop(self, pid: int) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, terminate_process, pid)
+
+    async def open_console(self, vm_id: str):
+        return await UnixConsole.connect(vm_id)
+
+    async def qmp(self, vm_id: str, command: str, arguments: Optional[dict] = None):
+        return await qmp_execute(vm_id, command, arguments)
+
+
+class AgentHost:
+    """A remote node reached through its host agent (see host_agent.py)."""
+
+    def __init__(self, host_id: str, url: str):
+        self.host_id = host_id
+        self.url = url.rstrip("/")
+
+    def _call(self, method: str, path: str, payload: Optional[dict] = None) -> requests.Response:
+        return requests.request(
+            method,
+            f"{self.url}{path}",
+            json=payload,
+            headers={"X-Agent-Token": AGENT_TOKEN},
+            timeout=AGENT_TIMEOUT_SECONDS
+        )
+
+    async def _request(self, method: str, path: str, payload: Optional[dict] = None) -> dict:
+        loop = asyncio.get_event_loop()
+        try:
+            response = await loop.run_in_executor(None, self._call, method, path, payload)
+        except requests.RequestException as e:
+            raise HTTPException(status_code=502, detail=f"Host '{self.host_id}' unreachable: {str(e)}")
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise HTTPException(status_code=response.status_code, detail=f"Host '{self.host_id}': {detail}")
+        return response.json()
+
+    async def stats(self, pids) -> dict:
+        return await self._request("POST", "/stats", {"pids": [pid for pid in pids if pid]})
+
+    async def samples(self, pids) -> dict:
+        result = await self._request("POST", "/samples", {"pids": [pid for pid in pids if pid]})
+        return result["samples"]
+
+    async def spawn(self, vm: dict, include_iso: bool) -> dict:
+        payload = {
+            "vm_id": str(vm["_id"]),
+            "disk_name": vm["disk_name"],
+            "iso_path": vm.get("iso_path"),
+            "memory_mb": vm["memory_mb"],
+            "cpu_count": vm["cpu_count"],
+            "display": vm.get("display"),
+            "qemu_preset": vm.get("qemu_preset"),
+            "include_iso": include_iso
+        }
+        result = await self._request("POST", "/spawn", payload)
+        return {"pid": result["pid"], "cgroup": result.get("cgroup"), "cpus": result.get("cpus"),
+                "console": result.get("console"), "qmp": result.get("qmp")}
+
+    async def stop(self, pid: int) -> None:
+        try:
+            await self._request("POST", "/stop", {"pid": pid})
+        except HTTPException as e:
+            if e.status_code == 404:
+                raise ProcessLookupError(pid)
+            raise
+
+    async def qmp(self, vm_id: str, command: str, arguments: Optional[dict] = None):
+        try:
+            result = await self._request("POST", "/qmp", {"vm_id": vm_id, "execute": command, "arguments": arguments})
+        except HTTPException as e:
+            if e.status_code == 409:
+                # The agent reached QEMU, which rejected the command
+                raise QMPError({"desc": e.detail})
+            raise
+        return result["return"]
+
+    async def open_console(self, vm_id: str):
+        ws_url = "ws" + self.url[len("http"):] if self.url.startswith("http") else self.url
+        query = f"?{urlencode({'token': AGENT_TOKEN})}" if AGENT_TOKEN else ""
+        return await AgentConsole.connect(f"{ws_url}/console/{vm_id}{query}")
+
+
+def load_hosts() -> Dict[str, object]:
+    """
+    Hosts available for placement.
+
+    VM_HOSTS lists agents as comma-separated id=url pairs, e.g.
+    "node1=http://10.0.0.11:9001,node2=http://10.0.0.12:9001". Without it the
+    API server runs every VM itself, as before.
+    """
+    spec = os.getenv("VM_HOSTS", "").strip()
+    if not spec:
+        return {LOCAL_HOST_ID: LocalHost()}
+    hosts = {}
+    for entry in spec.split(","):
+        host_id, _, url = entry.strip().partition("=")
+        if host_id and url:
+            hosts[host_id] = LocalHost() if url == LOCAL_HOST_ID else AgentHost(host_id, url)
+    return hosts
+
+
+hosts = load_hosts()
+
+
+def local_only() -> bool:
+    """Whether every VM runs on the API server host itself."""
+    return list(hosts) == [LOCAL_HOST_ID]
+
+
+def get_host(host_id: Optional[str]):
+    """Host object for a VM record's host_id."""
+    host = hosts.get(host_id or LOCAL_HOST_ID)
+    if host is None:
+        raise HTTPException(status_code=503, detail=f"Host '{host_id}' is not configured on this server")
+    return host
+
+
+async def get_cluster_usage() -> Dict[str, dict]:
+    """Usage of every reachable host, keyed by host_id. Unreachable hosts are left out."""
+    running_by_host = {host_id: [] for host_id in hosts}
+    cursor = db.vms.find({"status": "running"}, {"cpu_count": 1, "memory_mb": 1, "pid": 1, "host_id": 1})
+    async for vm in cursor:
+        running_by_host.setdefault(vm.get("host_id") or LOCAL_HOST_ID, []).append(vm)
+
+    async def host_usage(host_id, host):
+        running = running_by_host.get(host_id, [])
+        try:
+            stats = await host.stats([vm.get("pid") for vm in running])
+        except HTTPException as e:
+            print(f"⚠️ Skipping host {host_id} for placement: {e.detail}")
+            return host_id, None
+        return host_id, vm_scheduler.build_usage(stats, running)
+
+    results = await asyncio.gather(*(host_usage(host_id, host) for host_id, host in hosts.items()))
+    return {host_id: usage for host_id, usage in results if usage is not None}
+
+
+def fits_cluster(usages: Dict[str, dict], cpu_count: int, memory_mb: int) -> bool:
+    """Whether any host could ever run a VM of this size."""
+    return any(vm_scheduler.fits_host(usage, cpu_count, memory_mb) for usage in usages.values())
+
+
+def place(usages: Dict[str, dict], cpu_count: int, memory_mb: int) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Best-fit bin packing: pick the host left with the least spare capacity.
+
+    Returns (host_id, None) on success or (None, reason) when no host has room.
+    Packing tightly keeps whole nodes free for large VMs.
+    """
+    best_host, best_score, reason = None, None, None
+    for host_id, usage in usages.items():
+        rejection = vm_scheduler.admission_check(usage, cpu_count, memory_mb)
+        if rejection:
+            reason = reason or f"{host_id}: {rejection}"
+            continue
+        spare_cpu = 1 - (usage["committed_cpus"] + cpu_count) / vm_scheduler.cpu_capacity(usage)
+        mem_capacity = vm_scheduler.memory_capacity_mb(usage)
+        spare_mem = 1 - (usage["committed_memory_mb"] + memory_mb) / mem_capacity if mem_capacity else 0
+        score = spare_cpu + spare_mem
+        if best_score is None or score < best_score:
+            best_host, best_score = host_id, score
+    if best_host is None:
+        return None, reason or "No VM host is reachable"
+    return best_host, None
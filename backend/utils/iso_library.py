@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+
+from database import db
+from utils.qemu_tools import ISO_REF_PREFIX, iso_library_dir
+
+ISO_MAX_BYTES = int(os.getenv("ISO_MAX_BYTES", str(16 * 1024 ** 3)))
+ISO_GC_INTERVAL_SECONDS = int(os.getenv("ISO_GC_INTERVAL_SECONDS", "3600"))
+# Unreferenced ISOs are kept this long in case someone re-adds them
+ISO_GC_GRACE_SECONDS = int(os.getenv("ISO_GC_GRACE_SECONDS", "86400"))
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Serializes publishing new files with the GC deleting old ones
+_library_lock = asyncio.Lock()
+
+
+def iso_ref(sha256: str) -> str:
+    return ISO_REF_PREFIX + sha256
+
+
+def iso_file(sha256: str) -> str:
+    return os.path.join(iso_library_dir(), f"{sha256}.iso")
+
+
+def parse_ref(iso_path: Optional[str]) -> Optional[str]:
+    """The hash in a library reference, or None for plain paths."""
+    if iso_path and iso_path.startswith(ISO_REF_PREFIX):
+        return iso_path[len(ISO_REF_PREFIX):]
+    return None
+
+
+class IsoWriter:
+    """Writes an upload to a scratch file while hashing it, so no second pass is needed."""
+
+    def __init__(self):
+        incoming = os.path.join(iso_library_dir(), ".incoming")
+        os.makedirs(incoming, exist_ok=True)
+        self.path = os.path.join(incoming, uuid.uuid4().hex)
+        self.file = open(self.path, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunks) -> None:
+        for chunk in chunks:
+            self.digest.update(chunk)
+            self.file.write(chunk)
+            self.size += len(chunk)
+        if self.size > ISO_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"ISOs are limited to {ISO_MAX_BYTES} bytes")
+
+    def discard(self) -> None:
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def publish(writer: IsoWriter, filename: str, email: str) -> dict:
+    """Move a finished upload into the library (or drop it if the content is already there) and add it to the user's library."""
+    writer.file.close()
+    sha256 = writer.digest.hexdigest()
+    async with _library_lock:
+        deduplicated = os.path.exists(iso_file(sha256))
+        if deduplicated:
+            os.remove(writer.path)
+        else:
+            # Read-only: one copy is shared by every VM booting from it
+            os.chmod(writer.path, 0o444)
+            os.rename(writer.path, iso_file(sha256))
+        await db.isos.update_one(
+            {"_id": sha256},
+            {
+                "$setOnInsert": {"size": writer.size, "filename": filename, "vm_refs": 0, "created_at": datetime.utcnow()},
+                "$addToSet": {"owners": email},
+                "$unset": {"unreferenced_at": ""}
+            },
+            upsert=True
+        )
+    return {"id": sha256, "iso_path": iso_ref(sha256), "size": writer.size, "deduplicated": deduplicated}
+
+
+async def check_access(iso_path: Optional[str], email: str) -> None:
+    """Reject VM create requests for library ISOs the user hasn't added."""
+    sha256 = parse_ref(iso_path)
+    if sha256 is None:
+        return
+    if not await db.isos.count_documents({"_id": sha256, "owners": email}, limit=1):
+        raise HTTPException(status_code=404, detail=f"ISO '{iso_path}' not found in your library.")
+
+
+async def add_vm_refs(iso_paths, delta: int) -> None:
+    """Count VMs created on (+1) or deleted from (-1) library ISOs."""
+    for iso_path in iso_paths:
+        sha256 = parse_ref(iso_path)
+        if sha256:
+            await db.isos.update_one({"_id": sha256}, {"$inc": {"vm_refs": delta}})
+
+
+async def collect_garbage() -> int:
+    """
+    Delete ISOs nobody has in their library and no VM references.
+
+    The vm_refs counter is only trusted for display; references are recounted
+    from vms before anything is deleted, which also repairs counter drift.
+    """
+    removed = 0
+    async for iso in db.isos.find({"owners": {"$size": 0}}):
+        vm_refs = await db.vms.count_documents({"iso_path": iso_ref(iso["_id"])})
+        if vm_refs != iso.get("vm_refs", 0):
+            await db.isos.update_one({"_id": iso["_id"]}, {"$set": {"vm_refs": vm_refs}})
+        if vm_refs or iso.get("owners"):
+            continue
+        unreferenced_at = iso.get("unreferenced_at")
+        if unreferenced_at is None:
+            await db.isos.update_one({"_id": iso["_id"]}, {"$set": {"unreferenced_at": datetime.utcnow()}})
+            continue
+        if datetime.utcnow() - unreferenced_at < timedelta(seconds=ISO_GC_GRACE_SECONDS):
+            continue
+        async with _library_lock:
+            result = await db.isos.delete_one({"_id": iso["_id"], "owners": {"$size": 0}, "unreferenced_at": unreferenced_at})
+            if result.deleted_count:
+                try:
+                    os.remove(iso_file(iso["_id"]))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                print(f"🗑️ Removed unused ISO {iso.get('filename')} ({iso['_id'][:12]})")
+    return removed
+
+
+async def gc_worker():
+    """Periodically drop unreferenced ISOs."""
+    while True:
+        try:
+            await collect_garbage()
+        except Exception as e:
+            print(f"ISO library GC failed: {str(e)}")
+        await asyncio.sleep(ISO_GC_INTERVAL_SECONDS)
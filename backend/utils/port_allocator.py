@@ -0,0 +1,208 @@
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import docker
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+
+# Host ports handed out when a binding asks for "auto" (or leaves HostPort empty)
+HOST_PORT_RANGE = os.getenv("HOST_PORT_RANGE", "20000-29999")
+HOST_PORT_MIN, HOST_PORT_MAX = (int(p) for p in HOST_PORT_RANGE.split("-"))
+# Reservations not tied to a container after this long belong to a create that died midway
+HOST_PORT_PENDING_TTL_SECONDS = int(os.getenv("HOST_PORT_PENDING_TTL_SECONDS", "300"))
+# Seconds between passes that drop reservations of containers that no longer exist
+HOST_PORT_RECONCILE_SECONDS = int(os.getenv("HOST_PORT_RECONCILE_SECONDS", "120"))
+
+AUTO_PORT_VALUES = (None, "", "0", "auto")
+
+# One bit per host port: set while host_ports has a document for it
+taken = bytearray(65536 // 8)
+_next_port = HOST_PORT_MIN
+_lock = asyncio.Lock()
+
+
+class PortConflict(Exception):
+    pass
+
+
+def _set(port: int, value: bool) -> None:
+    if value:
+        taken[port >> 3] |= 1 << (port & 7)
+    else:
+        taken[port >> 3] &= ~(1 << (port & 7)) & 0xFF
+
+
+def is_taken(port: int) -> bool:
+    return bool(taken[port >> 3] & (1 << (port & 7)))
+
+
+def host_can_bind(port: int) -> bool:
+    """False if something outside Docker already listens on the port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        try:
+            probe.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
+
+
+async def load() -> None:
+    """Rebuild the in-memory bitmap from host_ports."""
+    bitmap = bytearray(len(taken))
+    async for doc in db.host_ports.find({}, {"_id": 1}):
+        bitmap[doc["_id"] >> 3] |= 1 << (doc["_id"] & 7)
+    taken[:] = bitmap
+
+
+async def _claim(port: int, reservation: str, user_email: str) -> bool:
+    """Insert the port's document; the unique _id makes this the atomic reserve."""
+    try:
+        await db.host_ports.insert_one({
+            "_id": port,
+            "reservation": reservation,
+            "user_email": user_email,
+            "container_id": None,
+            "reserved_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        _set(port, True)
+        return False
+    _set(port, True)
+    return True
+
+
+async def _auto_port(reservation: str, user_email: str) -> int:
+    """Next free port of HOST_PORT_RANGE, scanning round-robin so released ports cool down."""
+    global _next_port
+    span = HOST_PORT_MAX - HOST_PORT_MIN + 1
+    for _ in range(span):
+        port = _next_port
+        _next_port = HOST_PORT_MIN + (_next_port - HOST_PORT_MIN + 1) % span
+        if is_taken(port) or not host_can_bind(port):
+            continue
+        if await _claim(port, reservation, user_email):
+            return port
+    raise PortConflict(f"No free host port left in {HOST_PORT_RANGE}")
+
+
+async def reserve(port_bindings: Dict[str, list], user_email: str):
+    """
+    Reserve every host port of a container's bindings before it is created.
+
+    Bindings asking for "auto" get a free port from HOST_PORT_RANGE. Returns
+    the reservation id and the bindings with concrete ports; on a conflict
+    nothing stays reserved and PortConflict is raised.
+    """
+    reservation = uuid.uuid4().hex
+    resolved = {}
+    claimed: List[int] = []
+    async with _lock:
+        try:
+            for container_port, bindings in port_bindings.items():
+                resolved[container_port] = []
+                for binding in bindings or [{}]:
+                    binding = dict(binding) if isinstance(binding, dict) else {"HostPort": str(binding)}
+                    host_port = binding.get("HostPort")
+                    if host_port in AUTO_PORT_VALUES:
+                        port = await _auto_port(reservation, user_email)
+                    else:
+                        port = int(host_port)
+                        if not 1 <= port <= 65535:
+                            raise PortConflict(f"Host port {port} is out of range")
+                        # The bitmap may lag other workers, so only host_ports decides for pinned ports
+                        if port in claimed or not host_can_bind(port):
+                            raise PortConflict(f"Host port {port} is already in use")
+                        if not await _claim(port, reservation, user_email):
+                            raise PortConflict(f"Host port {port} is already in use")
+                    claimed.append(port)
+                    binding["HostPort"] = str(port)
+                    resolved[container_port].append(binding)
+        except (PortConflict, ValueError) as e:
+            await _release({"reservation": reservation}, claimed)
+            raise PortConflict(str(e) if isinstance(e, PortConflict) else f"Invalid host port: {str(e)}")
+    return reservation, resolved
+
+
+async def attach(reservation: str, container_id: str) -> None:
+    """Tie a reservation to the container that was created with it."""
+    await db.host_ports.update_many({"reservation": reservation}, {"$set": {"container_id": container_id}})
+
+
+async def assign(container_id: str, user_email: str) -> None:
+    """Hand the host ports of a container to another user, e.g. when a warm container is claimed."""
+    await db.host_ports.update_many({"container_id": container_id}, {"$set": {"user_email": user_email}})
+
+
+async def _release(query: dict, ports: Optional[List[int]] = None) -> int:
+    if ports is None:
+        ports = [doc["_id"] async for doc in db.host_ports.find(query, {"_id": 1})]
+    if not ports:
+        return 0
+    await db.host_ports.delete_many({**query, "_id": {"$in": ports}})
+    for port in ports:
+        _set(port, False)
+    return len(ports)
+
+
+async def release(reservation: str) -> int:
+    return await _release({"reservation": reservation})
+
+
+async def release_container(container_id: str) -> int:
+    """Free the host ports of a container that was deleted."""
+    return await _release({"container_id": container_id})
+
+
+async def reconcile(client) -> dict:
+    """
+    Make host_ports match the daemon: drop reservations of containers that
+    no longer exist or of creates that never finished, and adopt ports of
+    containers published outside the allocator.
+    """
+    loop = asyncio.get_event_loop()
+    containers = await loop.run_in_executor(None, lambda: client.containers.list(all=True))
+    existing = {c.id for c in containers}
+    # Only old reservations are considered, so a container created after the listing above is safe
+    stale_before = datetime.utcnow() - timedelta(seconds=HOST_PORT_PENDING_TTL_SECONDS)
+    dropped = 0
+    async for doc in db.host_ports.find({"reserved_at": {"$lt": stale_before}}):
+        if doc.get("container_id") not in existing:
+            dropped += await _release({"_id": doc["_id"], "reservation": doc["reservation"]}, [doc["_id"]])
+    # Pick up reservations made and released by other worker processes
+    await load()
+
+    adopted = 0
+    for container in containers:
+        bindings = (container.attrs.get("HostConfig") or {}).get("PortBindings") or {}
+        for binding_list in bindings.values():
+            for binding in binding_list or []:
+                host_port = binding.get("HostPort")
+                if host_port and host_port.isdigit() and not is_taken(int(host_port)):
+                    reservation = f"adopted-{container.id[:12]}"
+                    if await _claim(int(host_port), reservation, None):
+                        await attach(reservation, container.id)
+                        adopted += 1
+    return {"dropped": dropped, "adopted": adopted}
+
+
+async def reconcile_worker():
+    """Load the bitmap, then keep host_ports in step with the daemon."""
+    try:
+        await load()
+    except Exception as e:
+        print(f"Host port bitmap load failed: {str(e)}")
+    client = None
+    while True:
+        try:
+            client = client or docker.from_env()
+            result = await reconcile(client)
+            if result["dropped"] or result["adopted"]:
+                print(f"🔌 Host ports reconciled: {result['dropped']} released, {result['adopted']} adopted")
+        except Exception as e:
+            print(f"Host port reconcile failed: {str(e)}")
+        await asyncio.sleep(HOST_PORT_RECONCILE_SECONDS)
@@ -0,0 +1,157 @@
+import os
+from typing import Optional
+
+
+def read_meminfo() -> Optional[dict]:
+    """Total and available host memory in MB from /proc/meminfo (None where unavailable)."""
+    try:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("MemTotal", "MemAvailable"):
+                    values[key] = int(rest.split()[0]) // 1024
+        return {"total_mb": values["MemTotal"], "available_mb": values["MemAvailable"]}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def pid_alive(pid: int) -> bool:
+    """Whether a process with this PID still exists."""
+    if not pid:
+        return False
+    if os.path.isdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # Zombies (exited but not yet reaped by the API server) count as gone
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except (OSError, IndexError):
+            return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def process_rss_mb(pid: int) -> int:
+    """Resident set size of a process in MB, 0 if it can't be read."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def local_host_stats(pids=()) -> dict:
+    """
+    Capacity of this machine plus live RSS (MB) of those `pids` still running.
+
+    The API server uses this for its own host and each host agent serves it
+    from /stats, so placement sees every node the same way.
+    """
+    meminfo = read_meminfo()
+    return {
+        "total_cpus": os.cpu_count() or 1,
+        "total_memory_mb": meminfo["total_mb"] if meminfo else None,
+        "available_memory_mb": meminfo["available_mb"] if meminfo else None,
+        "processes": {str(pid): process_rss_mb(pid) for pid in pids if pid and pid_alive(pid)}
+    }
+
+
+# Kernel clock ticks per second, the unit of utime/stime in /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def read_cgroup_path(pid: int) -> Optional[str]:
+    """cgroup v2 directory of a process, None on cgroup v1 or non-Linux hosts."""
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return os.path.join(CGROUP_ROOT, line[3:].strip().lstrip("/"))
+    except OSError:
+        pass
+    return None
+
+
+def read_cgroup_sample(path: str) -> Optional[dict]:
+    """CPU time, memory and I/O bytes charged to a cgroup v2 directory."""
+    sample = {"cpu_seconds": None, "memory_mb": None, "read_bytes": 0, "write_bytes": 0}
+    try:
+        with open(os.path.join(path, "cpu.stat")) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if key == "usage_usec":
+                    sample["cpu_seconds"] = int(value) / 1_000_000
+        with open(os.path.join(path, "memory.current")) as f:
+            sample["memory_mb"] = int(f.read()) // (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+    try:
+        # One line per device: "8:0 rbytes=... wbytes=... rios=... ..."
+        with open(os.path.join(path, "io.stat")) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        sample["read_bytes"] += int(value)
+                    elif key == "wbytes":
+                        sample["write_bytes"] += int(value)
+    except (OSError, ValueError):
+        pass
+    return sample
+
+
+def read_process_sample(pid: int, cgroup: bool = False) -> Optional[dict]:
+    """
+    Cumulative CPU seconds, RSS and I/O bytes of a process, None if it is gone.
+
+    With `cgroup` set, the process's own cgroup v2 counters are included too;
+    they only describe the VM when QEMU runs in a cgroup of its own.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # fields[0] is the state (field 3 of stat); utime/stime are fields 14 and 15
+    if fields[0] == "Z":
+        return None
+    sample = {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "rss_mb": process_rss_mb(pid),
+        "read_bytes": 0,
+        "write_bytes": 0
+    }
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "read_bytes":
+                    sample["read_bytes"] = int(value)
+                elif key == "write_bytes":
+                    sample["write_bytes"] = int(value)
+    except (OSError, ValueError):
+        # /proc/<pid>/io needs the same user (or CAP_SYS_PTRACE)
+        pass
+    if cgroup:
+        path = read_cgroup_path(pid)
+        sample["cgroup"] = read_cgroup_sample(path) if path else None
+    return sample
+
+
+def sample_processes(pids=(), cgroup: bool = False) -> dict:
+    """Samples of every live PID in `pids` in one pass, keyed by str(pid)."""
+    samples = {}
+    for pid in pids:
+        if not pid:
+            continue
+        sample = read_process_sample(pid, cgroup)
+        if sample is not None:
+            samples[str(pid)] = sample
+    return samples
@@ -0,0 +1,400 @@
+import os
+import re
+import shutil
+import signal
+import subprocess
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from utils import vm_cgroups
+from utils.vnc_console import CONSOLE_DIR, console_socket_path
+from utils.qmp import QMP_DIR, qmp_socket_path
+
+# Hourly pricing constants, kept in sync with the frontend cost estimator
+BASE_COST = 0.5
+CPU_COST = 0.2
+RAM_COST = 0.1
+
+
+def get_store_dir() -> str:
+    """Absolute path of the directory holding VM disk images."""
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+    return os.path.join(base_dir, "store")
+
+
+# vms.iso_path values of this form point at the content-addressed ISO library
+ISO_REF_PREFIX = "iso:"
+
+
+def iso_library_dir(store_dir: Optional[str] = None) -> str:
+    """Directory holding library ISOs as <sha256>.iso."""
+    return os.getenv("ISO_LIBRARY_DIR") or os.path.join(store_dir or get_store_dir(), "isos")
+
+
+def resolve_iso_path(iso_path: str, store_dir: Optional[str] = None) -> str:
+    """File to boot for a vms.iso_path: a library reference or a plain server path."""
+    if iso_path.startswith(ISO_REF_PREFIX):
+        return os.path.join(iso_library_dir(store_dir), iso_path[len(ISO_REF_PREFIX):] + ".iso")
+    return iso_path
+
+
+def find_qemu_binary(name: str) -> str:
+    """
+    Locate a QEMU executable on PATH, falling back to the default Windows install.
+
+    An explicit path in e.g. QEMU_SYSTEM_X86_64_BINARY or QEMU_IMG_BINARY wins,
+    which is how host agents are pointed at fake QEMU binaries for testing.
+    """
+    override = os.getenv(name.upper().replace("-", "_") + "_BINARY")
+    if override:
+        return override
+    exe = shutil.which(name)
+    if exe is None:
+        default_path = os.path.join(r"C:\Program Files\qemu", f"{name}.exe")
+        if os.path.exists(default_path):
+            exe = default_path
+        else:
+            raise HTTPException(status_code=500, detail=f"❌ {name} not found. Install QEMU or adjust PATH.")
+    return exe
+
+
+def disk_format_for(disk_name: str) -> str:
+    """Format passed to -drive for a disk file in the store."""
+    return "qcow2" if disk_name.endswith(".qcow2") else "raw"
+
+
+# Device/tuning presets: "compat" keeps the old emulated IDE/e1000 hardware for
+# guests without virtio drivers (e.g. a fresh Windows install)
+QEMU_PRESETS = {
+    "compat": {"cpu_host": False, "virtio": False, "direct_io": False, "iothread": False, "hugepages": False},
+    "balanced": {"cpu_host": True, "virtio": True, "direct_io": True, "iothread": False, "hugepages": False},
+    "performance": {"cpu_host": True, "virtio": True, "direct_io": True, "iothread": True, "hugepages": True},
+}
+# Preset recorded for newly created VMs that don't ask for one
+DEFAULT_QEMU_PRESET = os.getenv("QEMU_PRESET", "balanced")
+# VMs created before presets existed were installed on emulated hardware and may lack virtio drivers
+LEGACY_QEMU_PRESET = "compat"
+# Force an AIO backend (io_uring, native or threads) instead of detecting one
+QEMU_AIO = os.getenv("QEMU_AIO", "")
+QEMU_HUGEPAGES_PATH = os.getenv("QEMU_HUGEPAGES_PATH", "/dev/hugepages")
+# "none" runs guests headless with their screen served over VNC; "sdl"/"gtk" open a window on the host
+DEFAULT_DISPLAY = os.getenv("VM_DEFAULT_DISPLAY", "none")
+
+
+def check_preset(preset: str) -> None:
+    if preset not in QEMU_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Unknown QEMU preset '{preset}'. Use one of: {', '.join(QEMU_PRESETS)}")
+
+
+def kvm_available() -> bool:
+    """Whether this host can run guests with KVM acceleration."""
+    return os.name != 'nt' and os.access("/dev/kvm", os.R_OK | os.W_OK)
+
+
+@lru_cache(maxsize=None)
+def qemu_version(exe: str) -> Tuple[int, int]:
+    """(major, minor) reported by `exe --version`, (0, 0) if it can't be read."""
+    try:
+        output = subprocess.run([exe, "--version"], capture_output=True, text=True, timeout=10).stdout
+        match = re.search(r"version (\d+)\.(\d+)", output)
+        return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+    except (OSError, subprocess.SubprocessError):
+        return (0, 0)
+
+
+def supports_direct_io(path: str) -> bool:
+    """Whether the filesystem holding `path` accepts O_DIRECT (tmpfs, for one, does not)."""
+    if not hasattr(os, "O_DIRECT"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def io_uring_available(exe: str) -> bool:
+    """io_uring needs Linux 5.1+, QEMU 5.0+ and must not be disabled by sysctl."""
+    if os.name == 'nt':
+        return False
+    try:
+        kernel = tuple(int(part) for part in re.findall(r"\d+", os.uname().release)[:2])
+        with open("/proc/sys/kernel/io_uring_disabled") as f:
+            if f.read().strip() != "0":
+                return False
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        return False
+    return kernel >= (5, 1) and qemu_version(exe) >= (5, 0)
+
+
+def free_hugepages_mb() -> int:
+    """Free hugepage memory in MB from /proc/meminfo, 0 where unavailable."""
+    values = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("HugePages_Free", "Hugepagesize"):
+                    values[key] = int(rest.split()[0])
+        return values["HugePages_Free"] * values["Hugepagesize"] // 1024
+    except (OSError, KeyError, ValueError):
+        return 0
+
+
+class QemuCommandBuilder:
+    """
+    Builds the qemu-system argument list for a VM from a preset.
+
+    Host features (KVM, O_DIRECT, io_uring, free hugepages) are detected when
+    the command is built; pass `features` to pin them, e.g. to print the
+    command another host would get. Without a preset (a VM record from before
+    presets) the builder uses LEGACY_QEMU_PRESET.
+    """
+
+    def __init__(self, exe: str, preset: Optional[str] = None, features: Optional[dict] = None):
+        preset = preset or LEGACY_QEMU_PRESET
+        check_preset(preset)
+        self.exe = exe
+        self.preset = preset
+        self.options = QEMU_PRESETS[preset]
+        self.features = features or {}
+        self.memory_mb = 1024
+        self.cpu_count = 1
+        self.display_type = DEFAULT_DISPLAY
+        self.console_socket = None
+        self.qmp_socket = None
+        self.disks: List[str] = []
+        self.iso_path = None
+
+    def memory(self, memory_mb: int) -> "QemuCommandBuilder":
+        self.memory_mb = memory_mb
+        return self
+
+    def cpus(self, cpu_count: int) -> "QemuCommandBuilder":
+        self.cpu_count = cpu_count
+        return self
+
+    def display(self, display: str) -> "QemuCommandBuilder":
+        self.display_type = display
+        return self
+
+    def console(self, socket_path: Optional[str]) -> "QemuCommandBuilder":
+        """Serve the screen over VNC on a unix socket."""
+        self.console_socket = socket_path
+        return self
+
+    def qmp(self, socket_path: Optional[str]) -> "QemuCommandBuilder":
+        """Accept QMP control connections (snapshots of the running guest) on a unix socket."""
+        self.qmp_socket = socket_path
+        return self
+
+    def disk(self, disk_path: str) -> "QemuCommandBuilder":
+        self.disks.append(disk_path)
+        return self
+
+    def cdrom(self, iso_path: Optional[str]) -> "QemuCommandBuilder":
+        self.iso_path = iso_path
+        return self
+
+    def feature(self, name: str, detect) -> bool:
+        if name not in self.features:
+            self.features[name] = detect()
+        return self.features[name]
+
+    def drive_options(self, disk_path: str) -> str:
+        """cache/aio flags: O_DIRECT with a native async backend when the host allows it."""
+        if not self.options["direct_io"] or not self.feature(f"direct_io:{disk_path}", lambda: supports_direct_io(disk_path)):
+            return "cache=writeback,aio=threads"
+        aio = QEMU_AIO or ("io_uring" if self.feature("io_uring", lambda: io_uring_available(self.exe)) else "native")
+        # aio=native is only valid with O_DIRECT, which cache=none implies
+        return f"cache=none,aio={aio}"
+
+    def build(self) -> List[str]:
+        cmd = [self.exe]
+        if self.feature("kvm", kvm_available):
+            cmd += ["-enable-kvm"]
+            if self.options["cpu_host"]:
+                cmd += ["-cpu", "host"]
+        cmd += ["-m", str(self.memory_mb), "-smp", str(self.cpu_count)]
+
+        if self.options["hugepages"] and os.path.isdir(QEMU_HUGEPAGES_PATH) and \
+                self.feature("hugepages_free_mb", free_hugepages_mb) >= self.memory_mb:
+            cmd += ["-mem-path", QEMU_HUGEPAGES_PATH, "-mem-prealloc"]
+
+        for index, disk_path in enumerate(self.disks):
+            drive = f"file={disk_path},format={disk_format_for(disk_path)},{self.drive_options(disk_path)}"
+            # Drives are named disk<N> in every preset so QMP commands can address them
+            if not self.options["virtio"]:
+                cmd += ["-drive", f"id=disk{index},{drive}"]
+                continue
+            device = f"virtio-blk-pci,drive=disk{index}"
+            if self.options["iothread"]:
+                # A dedicated iothread per disk keeps I/O off the main loop
+                cmd += ["-object", f"iothread,id=iothread{index}"]
+                device += f",iothread=iothread{index}"
+            cmd += ["-drive", f"if=none,id=disk{index},{drive}", "-device", device]
+
+        if self.options["virtio"]:
+            cmd += ["-netdev", "user,id=net0", "-device", "virtio-net-pci,netdev=net0"]
+        if self.iso_path:
+            cmd += ["-cdrom", self.iso_path, "-boot", "d"]
+        cmd += ["-display", self.display_type]
+        if self.console_socket:
+            # force-shared lets several browsers watch one guest, each with its own encoder
+            cmd += ["-vnc", f"unix:{self.console_socket},share=force-shared"]
+        if self.qmp_socket:
+            cmd += ["-qmp", f"unix:{self.qmp_socket},server=on,wait=off"]
+        return cmd
+
+
+def spawn_vm_process(exe: str, vm: dict, include_iso: bool,
+                     store_dir: Optional[str] = None) -> Tuple[subprocess.Popen, dict]:
+    """
+    Launch the QEMU process for a VM record.
+
+    Returns the Popen handle and where the guest landed: its cgroup and
+    pinned cores (None when it runs without a cgroup of its own), the VNC
+    console socket (None for guests shown in a host window) and the QMP
+    control socket.
+    """
+    disk_path = os.path.join(store_dir or get_store_dir(), vm["disk_name"])
+    if not os.path.exists(disk_path):
+        raise HTTPException(status_code=404, detail=f"Disk '{vm['disk_name']}' not found in store.")
+
+    # Add ISO if specified and user wants it included
+    iso_path = None
+    if vm.get("iso_path") and include_iso:
+        iso_path = resolve_iso_path(vm["iso_path"], store_dir)
+        if not os.path.exists(iso_path):
+            # Library ISOs live in the store of the server they were uploaded to; an agent
+            # host has them only if they were copied into its own store/isos
+            raise HTTPException(
+                status_code=404,
+                detail=f"ISO '{vm['iso_path']}' is not available on this host. Start without the ISO or copy it to {iso_path}"
+            )
+        print(f"Including ISO: {vm['iso_path']}")
+    else:
+        print("Starting VM without ISO")
+
+    builder = (QemuCommandBuilder(exe, vm.get("qemu_preset"))
+           .memory(vm["memory_mb"])
+           .cpus(vm["cpu_count"])
+           .display(vm.get("display") or DEFAULT_DISPLAY)
+           .disk(disk_path)
+           .cdrom(iso_path))
+    placement = {"cgroup": None, "cpus": None, "console": None, "qmp": None}
+
+    # Headless guests get a VNC socket for the websocket console (QEMU on Windows lacks unix sockets)
+    if vm.get("_id") and os.name != 'nt' and builder.display_type == "none":
+        os.makedirs(CONSOLE_DIR, mode=0o700, exist_ok=True)
+        placement["console"] = console_socket_path(str(vm["_id"]))
+        builder.console(placement["console"])
+    if vm.get("_id") and os.name != 'nt':
+        os.makedirs(QMP_DIR, mode=0o700, exist_ok=True)
+        placement["qmp"] = qmp_socket_path(str(vm["_id"]))
+        builder.qmp(placement["qmp"])
+    cmd = builder.build()
+
+    # Confine the guest to its own cgroup so it can't starve other guests or the API
+    if vm.get("_id") and os.name != 'nt':
+        cgroup = vm_cgroups.create_vm_cgroup(str(vm["_id"]), vm["cpu_count"], vm["memory_mb"], disk_path)
+        if cgroup:
+            placement.update(cgroup)
+            cmd = vm_cgroups.wrap_command(cmd, cgroup["cgroup"])
+    return subprocess.Popen(cmd), placement
+
+
+def run_qemu_img(args: List[str]) -> str:
+    """Run qemu-img with `args` and return its stdout; failures become HTTP 500s."""
+    result = subprocess.run([find_qemu_binary("qemu-img"), *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise HTTPException(status_code=500, detail=f"💥 qemu-img {args[0]} failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+# qemu-img size suffixes (powers of 1024; a bare number is bytes)
+SIZE_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([kKMGTPE]?)(?:i?B)?$")
+SIZE_UNITS = {"": 1, "k": 1024, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5, "E": 1024 ** 6}
+
+
+def parse_size(size: str) -> int:
+    """Bytes in a qemu-img size like "10G", "512M" or "1073741824"."""
+    match = SIZE_PATTERN.match(size.strip())
+    if not match:
+        raise HTTPException(status_code=400, detail=f"Invalid size '{size}'. Use e.g. 10G or 512M")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+# qemu-img convert tuning. -m is qemu-img's number of parallel coroutines (its
+# default is 8); out-of-order writes (-W) only pay off on targets without
+# allocation metadata, so by default they are used for raw targets only.
+CONVERT_FORMATS = ("qcow2", "raw", "vmdk", "vhdx", "vdi")
+CONVERT_COROUTINES = int(os.getenv("QEMU_IMG_CONVERT_COROUTINES", "8"))
+CONVERT_OUT_OF_ORDER_FORMATS = tuple(os.getenv("QEMU_IMG_CONVERT_OUT_OF_ORDER", "raw").split(","))
+# Preallocation modes each target format accepts through -o preallocation=
+PREALLOCATION_MODES = {
+    "qcow2": ("off", "metadata", "falloc", "full"),
+    "raw": ("off", "falloc", "full"),
+}
+
+
+def convert_args(source: str, source_format: str, target: str, target_format: str,
+                 coroutines: Optional[int] = None, out_of_order: Optional[bool] = None,
+                 compress: bool = False, preallocation: Optional[str] = None) -> List[str]:
+    """qemu-img convert arguments for the given options; invalid combinations are HTTP 400s."""
+    for fmt in (source_format, target_format):
+        if fmt not in CONVERT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}'. Supported: {', '.join(CONVERT_FORMATS)}")
+    coroutines = coroutines or CONVERT_COROUTINES
+    if not 1 <= coroutines <= 16:
+        raise HTTPException(status_code=400, detail="coroutines must be between 1 and 16")
+    if out_of_order is None:
+        out_of_order = target_format in CONVERT_OUT_OF_ORDER_FORMATS and not compress
+    if compress and target_format != "qcow2":
+        raise HTTPException(status_code=400, detail="Compression is only available for qcow2 targets")
+    if compress and out_of_order:
+        raise HTTPException(status_code=400, detail="Compressed output is written in order; drop out_of_order")
+    if compress and preallocation not in (None, "off"):
+        raise HTTPException(status_code=400, detail="Compressed images can't be preallocated")
+    if preallocation and preallocation not in PREALLOCATION_MODES.get(target_format, ("off",)):
+        modes = ", ".join(PREALLOCATION_MODES.get(target_format, ("off",)))
+        raise HTTPException(status_code=400, detail=f"Preallocation for {target_format} targets can be: {modes}")
+
+    args = ["convert", "-q", "-f", source_format, "-O", target_format, "-m", str(coroutines)]
+    if out_of_order:
+        args.append("-W")
+    if compress:
+        args.append("-c")
+    if preallocation and preallocation != "off":
+        args += ["-o", f"preallocation={preallocation}"]
+    return args + [source, target]
+
+
+def terminate_process(pid: int) -> None:
+    """Ask a VM process to exit (taskkill on Windows, SIGTERM elsewhere)."""
+    if os.name == 'nt':
+        subprocess.run(["taskkill", "/F", "/PID", str(pid)], check=True)
+    else:
+        os.kill(pid, signal.SIGTERM)
+
+
+def hourly_rate_for(vm: dict) -> float:
+    """Credits per hour for a VM's CPU and memory allocation."""
+    return BASE_COST + (vm["cpu_count"] * CPU_COST) + ((vm["memory_mb"] / 1024) * RAM_COST)
+
+
+def session_usage(vm: dict, stop_time: datetime) -> dict:
+    """Runtime and cost of the VM session ending at stop_time."""
+    runtime_minutes = (stop_time - vm["started_at"]).total_seconds() / 60
+    hourly_rate = hourly_rate_for(vm)
+    return {
+        "runtime_minutes": runtime_minutes,
+        "hourly_rate": hourly_rate,
+        "session_cost": round(hourly_rate * (runtime_minutes / 60), 2)
+    }
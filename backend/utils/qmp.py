@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+import tempfile
+from typing import Optional
+
+# QEMU listens for QMP (its JSON control protocol) on a unix socket per VM in this directory
+QMP_DIR = os.getenv("VM_QMP_DIR", os.path.join(tempfile.gettempdir(), "virtcloud-qmp"))
+QMP_TIMEOUT_SECONDS = float(os.getenv("VM_QMP_TIMEOUT_SECONDS", "30"))
+
+
+class QMPError(Exception):
+    """QEMU answered a command with an error."""
+
+    def __init__(self, error: dict):
+        self.error_class = error.get("class", "GenericError")
+        self.desc = error.get("desc", "")
+        super().__init__(f"{self.error_class}: {self.desc}")
+
+
+def qmp_socket_path(vm_id: str) -> str:
+    return os.path.join(QMP_DIR, f"vm-{vm_id}.qmp")
+
+
+class QMPClient:
+    """Minimal async QMP client: handshake, then one command at a time."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+
+    @classmethod
+    async def connect(cls, socket_path: str) -> "QMPClient":
+        # Large replies (e.g. query-block on many disks) fit in a 1 MB line buffer
+        reader, writer = await asyncio.open_unix_connection(socket_path, limit=1024 * 1024)
+        client = cls(reader, writer)
+        greeting = await client._read_message()
+        if "QMP" not in greeting:
+            await client.close()
+            raise ConnectionError(f"Unexpected QMP greeting: {greeting}")
+        await client.execute("qmp_capabilities")
+        return client
+
+    async def _read_message(self) -> dict:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("QMP connection closed")
+        return json.loads(line)
+
+    async def execute(self, command: str, arguments: Optional[dict] = None):
+        """Run a command and return its "return" value; asynchronous events are skipped."""
+        self.next_id += 1
+        request = {"execute": command, "id": self.next_id}
+        if arguments:
+            request["arguments"] = arguments
+        self.writer.write(json.dumps(request).encode() + b"\n")
+        await self.writer.drain()
+        while True:
+            message = await self._read_message()
+            if message.get("id") != self.next_id:
+                continue
+            if "error" in message:
+                raise QMPError(message["error"])
+            return message.get("return")
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def qmp_execute(vm_id: str, command: str, arguments: Optional[dict] = None,
+                      timeout: float = QMP_TIMEOUT_SECONDS):
+    """Connect to a VM's QMP socket, run one command and disconnect."""
+    async def run():
+        client = await QMPClient.connect(qmp_socket_path(vm_id))
+        try:
+            return await client.execute(command, arguments)
+        finally:
+            await client.close()
+    return await asyncio.wait_for(run(), timeout)
@@ -0,0 +1,134 @@
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from utils.disk_info import format_bytes
+
+# Reservations older than this were left behind by a crashed worker and are dropped
+STORAGE_RESERVATION_TTL_SECONDS = int(os.getenv("STORAGE_RESERVATION_TTL_SECONDS", "3600"))
+
+
+async def apply_delta(email: Optional[str], allocated: int, actual: int, disks: int) -> None:
+    """Adjust a user's counters after one of their disks was added, changed or removed."""
+    if not email or not (allocated or actual or disks):
+        return
+    await db.storage_usage.update_one(
+        {"_id": email},
+        {
+            "$inc": {"allocated_bytes": allocated, "actual_bytes": actual, "disk_count": disks},
+            "$set": {"updated_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+
+
+def record_delta(old: Optional[dict], new: Optional[dict]):
+    """Counter changes for a disk record going from old to new (either may be None)."""
+    changes = []
+    old_owner = old.get("owner_email") if old else None
+    new_owner = new.get("owner_email") if new else None
+    if old and old_owner != new_owner:
+        changes.append((old_owner, -(old.get("virtual_size") or 0), -(old.get("actual_size") or 0), -1))
+        old = None
+    if new:
+        changes.append((
+            new_owner,
+            (new.get("virtual_size") or 0) - ((old or {}).get("virtual_size") or 0),
+            (new.get("actual_size") or 0) - ((old or {}).get("actual_size") or 0),
+            0 if old else 1
+        ))
+    return changes
+
+
+async def get_usage(email: str) -> dict:
+    usage = await db.storage_usage.find_one({"_id": email}) or {}
+    return {
+        "allocated_bytes": usage.get("allocated_bytes", 0),
+        "actual_bytes": usage.get("actual_bytes", 0),
+        "reserved_bytes": sum(r["bytes"] for r in usage.get("reservations", [])),
+        "disk_count": usage.get("disk_count", 0)
+    }
+
+
+@asynccontextmanager
+async def reserve(email: str, limit_bytes: int, requested: int):
+    """
+    Hold `requested` bytes of the user's quota while a disk operation runs.
+
+    Admission is a single conditional update on the user's usage document, so
+    concurrent requests can't both squeeze under the limit. The reservation is
+    released once the operation's own disks-record update has been counted.
+    """
+    if requested <= 0:
+        yield
+        return
+    if requested > limit_bytes:
+        raise HTTPException(status_code=403, detail=f"Storage quota exceeded: {format_bytes(requested)} requested, plan allows {format_bytes(limit_bytes)}")
+    reservation = {"id": uuid.uuid4().hex, "bytes": requested, "at": datetime.utcnow()}
+    try:
+        result = await db.storage_usage.update_one(
+            {"_id": email, "$expr": {"$lte": [
+                {"$add": [{"$ifNull": ["$allocated_bytes", 0]}, {"$sum": {"$ifNull": ["$reservations.bytes", []]}}, requested]},
+                limit_bytes
+            ]}},
+            {"$push": {"reservations": reservation}},
+            upsert=True
+        )
+        admitted = True
+    except DuplicateKeyError:
+        # The upsert found the user over quota and tried to insert a second document
+        admitted = False
+    if not admitted or not (result.modified_count or result.upserted_id):
+        usage = await get_usage(email)
+        raise HTTPException(
+            status_code=403,
+            detail=(f"Storage quota exceeded: {format_bytes(usage['allocated_bytes'] + usage['reserved_bytes'])} "
+                    f"of {format_bytes(limit_bytes)} allocated, {format_bytes(requested)} more requested")
+        )
+    try:
+        yield
+    finally:
+        await db.storage_usage.update_one({"_id": email}, {"$pull": {"reservations": {"id": reservation["id"]}}})
+
+
+async def reconcile_usage() -> int:
+    """Recount every user's usage from the disks collection; returns the number of corrections."""
+    totals = {}
+    pipeline = [
+        {"$match": {"owner_email": {"$ne": None}}},
+        {"$group": {
+            "_id": "$owner_email",
+            "allocated_bytes": {"$sum": {"$ifNull": ["$virtual_size", 0]}},
+            "actual_bytes": {"$sum": {"$ifNull": ["$actual_size", 0]}},
+            "disk_count": {"$sum": 1}
+        }}
+    ]
+    async for row in db.disks.aggregate(pipeline):
+        totals[row.pop("_id")] = row
+
+    fields = ("allocated_bytes", "actual_bytes", "disk_count")
+    operations = []
+    async for usage in db.storage_usage.find({}):
+        expected = totals.pop(usage["_id"], dict.fromkeys(fields, 0))
+        update = {field: expected[field] for field in fields if usage.get(field) != expected[field]}
+        if update:
+            operations.append(UpdateOne({"_id": usage["_id"]}, {"$set": {**update, "updated_at": datetime.utcnow()}}))
+        stale_before = datetime.utcnow() - timedelta(seconds=STORAGE_RESERVATION_TTL_SECONDS)
+        if any(r["at"] < stale_before for r in usage.get("reservations", [])):
+            operations.append(UpdateOne({"_id": usage["_id"]}, {"$pull": {"reservations": {"at": {"$lt": stale_before}}}}))
+    for email, expected in totals.items():
+        operations.append(UpdateOne(
+            {"_id": email},
+            {"$set": {**expected, "updated_at": datetime.utcnow()}},
+            upsert=True
+        ))
+    if operations:
+        await db.storage_usage.bulk_write(operations, ordered=False)
+    return len(operations)
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Parent cgroup holding one vm-<id> child per guest
+VM_CGROUP_PARENT = os.path.join(CGROUP_ROOT, os.getenv("VM_CGROUP_PARENT", "virtcloud.slice"))
+VM_CGROUPS_ENABLED = os.getenv("VM_CGROUPS", "1") == "1"
+CPU_PERIOD_US = 100000
+# Headroom above the guest RAM for QEMU itself (device emulation, caches)
+VM_MEMORY_OVERHEAD_MB = int(os.getenv("VM_MEMORY_OVERHEAD_MB", "256"))
+# Disk throughput/IOPS granted per vCPU on the store's device; 0 leaves it unlimited
+VM_IO_MBPS_PER_CPU = int(os.getenv("VM_IO_MBPS_PER_CPU", "100"))
+VM_IO_IOPS_PER_CPU = int(os.getenv("VM_IO_IOPS_PER_CPU", "2000"))
+# Pin each guest to dedicated host cores instead of letting it float
+VM_CPU_PINNING = os.getenv("VM_CPU_PINNING", "0") == "1"
+# Cores kept for the API server; defaults to one per uvicorn worker (WEB_CONCURRENCY)
+API_RESERVED_CPUS = os.getenv("API_RESERVED_CPUS", "")
+
+# A fresh cgroup stays empty until its QEMU process has joined it
+NEW_CGROUP_GRACE_SECONDS = 60
+
+_parent_ready = None
+# Serialises prune/allocate/create across concurrent spawns
+_lock = threading.Lock()
+
+
+def parse_cpu_list(spec: str) -> List[int]:
+    """Expand a kernel CPU list such as "0-3,6" into [0, 1, 2, 3, 6]."""
+    cpus = []
+    for part in spec.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    return ",".join(str(cpu) for cpu in sorted(cpus))
+
+
+def _write(path: str, value: str) -> None:
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def vm_cgroup_in_use(path: str) -> bool:
+    """Whether a vm-* cgroup has processes or was created moments ago."""
+    if _read(os.path.join(path, "cgroup.procs")):
+        return True
+    try:
+        return time.time() - os.stat(path).st_mtime < NEW_CGROUP_GRACE_SECONDS
+    except OSError:
+        return False
+
+
+def ensure_parent() -> bool:
+    """Create the parent cgroup and delegate the cpu, memory, io and cpuset controllers to it."""
+    global _parent_ready
+    if _parent_ready is not None:
+        return _parent_ready
+    _parent_ready = False
+    if not VM_CGROUPS_ENABLED or not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        return False
+    try:
+        os.makedirs(VM_CGROUP_PARENT, exist_ok=True)
+        # Each level must enable a controller for the level below it
+        for path in (os.path.dirname(VM_CGROUP_PARENT), VM_CGROUP_PARENT):
+            available = _read(os.path.join(path, "cgroup.controllers")).split()
+            wanted = [c for c in ("cpu", "memory", "io", "cpuset") if c in available]
+            if wanted:
+                _write(os.path.join(path, "cgroup.subtree_control"), " ".join(f"+{c}" for c in wanted))
+        _parent_ready = True
+    except OSError as e:
+        print(f"⚠️ cgroup v2 isolation disabled, cannot set up {VM_CGROUP_PARENT}: {str(e)}")
+    return _parent_ready
+
+
+def backing_device(path: str) -> Optional[str]:
+    """MAJ:MIN of the whole disk holding `path`; io.max does not accept partitions."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    device = f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+    sys_path = f"/sys/dev/block/{device}"
+    if not os.path.exists(sys_path):
+        # overlayfs, tmpfs and friends have no block device to throttle
+        return None
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        return _read(os.path.join(sys_path, "..", "dev")) or None
+    return device
+
+
+def reserved_cpus() -> List[int]:
+    if API_RESERVED_CPUS:
+        return parse_cpu_list(API_RESERVED_CPUS)
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    return sorted(os.sched_getaffinity(0))[:workers]
+
+
+def allocate_cpus(count: int) -> List[int]:
+    """
+    Pick `count` host cores for a guest, least shared first.
+
+    Current assignments are read back from the live vm-* cgroups, so the
+    allocator needs no state of its own and survives restarts. Cores reserved
+    for the API server are never handed out unless nothing else is left.
+    """
+    usable = sorted(set(os.sched_getaffinity(0)) - set(reserved_cpus()))
+    if not usable:
+        usable = sorted(os.sched_getaffinity(0))
+    load: Dict[int, int] = {cpu: 0 for cpu in usable}
+    for name in os.listdir(VM_CGROUP_PARENT):
+        path = os.path.join(VM_CGROUP_PARENT, name)
+        if not name.startswith("vm-") or not vm_cgroup_in_use(path):
+            continue
+        for cpu in parse_cpu_list(_read(os.path.join(path, "cpuset.cpus"))):
+            if cpu in load:
+                load[cpu] += 1
+    ranked = sorted(usable, key=lambda cpu: (load[cpu], cpu))
+    return sorted(ranked[:min(count, len(ranked))])
+
+
+def vm_limits(cpu_count: int, memory_mb: int, device: Optional[str]) -> Dict[str, str]:
+    """cgroup interface files and values for a guest of this size."""
+    limits = {
+        "cpu.max": f"{cpu_count * CPU_PERIOD_US} {CPU_PERIOD_US}",
+        "memory.max": str((memory_mb + VM_MEMORY_OVERHEAD_MB) * 1024 * 1024)
+    }
+    if device and (VM_IO_MBPS_PER_CPU or VM_IO_IOPS_PER_CPU):
+        rules = []
+        if VM_IO_MBPS_PER_CPU:
+            bps = VM_IO_MBPS_PER_CPU * cpu_count * 1024 * 1024
+            rules += [f"rbps={bps}", f"wbps={bps}"]
+        if VM_IO_IOPS_PER_CPU:
+            iops = VM_IO_IOPS_PER_CPU * cpu_count
+            rules += [f"riops={iops}", f"wiops={iops}"]
+        limits["io.max"] = f"{device} {' '.join(rules)}"
+    return limits
+
+
+def prune_vm_cgroups() -> None:
+    """Remove cgroups of guests that have exited."""
+    for name in os.listdir(VM_CGROUP_PARENT):
+        path = os.path.join(VM_CGROUP_PARENT, name)
+        if name.startswith("vm-") and os.path.isdir(path) and not vm_cgroup_in_use(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+
+def create_vm_cgroup(vm_id: str, cpu_count: int, memory_mb: int, disk_path: str) -> Optional[dict]:
+    """
+    Set up vm-<vm_id> with limits derived from the VM size.
+
+    Returns {"cgroup": path, "cpus": pinned cores or None}, or None when
+    cgroup v2 isn't usable here (the VM then runs unconfined, as before).
+    """
+    if not ensure_parent():
+        return None
+    try:
+        with _lock:
+            prune_vm_cgroups()
+            path = os.path.join(VM_CGROUP_PARENT, f"vm-{vm_id}")
+            os.makedirs(path, exist_ok=True)
+            available = _read(os.path.join(path, "cgroup.controllers")).split()
+            cpus = None
+            # Written under the lock so the next allocation already sees these cores taken
+            if VM_CPU_PINNING and "cpuset" in available:
+                cpus = allocate_cpus(cpu_count)
+                _write(os.path.join(path, "cpuset.cpus"), format_cpu_list(cpus))
+        for name, value in vm_limits(cpu_count, memory_mb, backing_device(disk_path)).items():
+            if name.split(".")[0] not in available:
+                continue
+            try:
+                _write(os.path.join(path, name), value)
+            except OSError as e:
+                # e.g. io.max on a device the io controller can't throttle
+                print(f"⚠️ Could not set {name} for VM {vm_id}: {str(e)}")
+        return {"cgroup": path, "cpus": cpus}
+    except OSError as e:
+        print(f"⚠️ Running VM {vm_id} without a cgroup: {str(e)}")
+        return None
+
+
+def wrap_command(cmd: List[str], cgroup_path: str) -> List[str]:
+    """
+    Prefix a command so it joins the cgroup before exec'ing.
+
+    The shell moves itself into the cgroup and then execs QEMU, so the guest
+    never runs outside its limits and keeps the PID Popen reports.
+    """
+    return ["/bin/sh", "-c", 'echo $$ > "$0/cgroup.procs" && exec "$@"', cgroup_path, *cmd]
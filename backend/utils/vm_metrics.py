@@ -0,0 +1,199 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+from utils import host_pool
+
+# Seconds between two sampling passes over all running VMs
+SAMPLE_INTERVAL_SECONDS = float(os.getenv("VM_METRICS_INTERVAL", "5"))
+# Points kept in memory per VM (720 x 5s = one hour)
+RING_SIZE = int(os.getenv("VM_METRICS_RING_SIZE", "720"))
+# Width of the downsampled windows persisted to vm_metrics
+ROLLUP_SECONDS = int(os.getenv("VM_METRICS_ROLLUP_SECONDS", "60"))
+
+# Field order of the compact points stored in the ring buffers
+POINT_FIELDS = ("timestamp", "cpu_percent", "memory_mb", "read_bytes_per_sec", "write_bytes_per_sec")
+
+# vm_id -> deque of points (tuples laid out as POINT_FIELDS)
+history: Dict[str, deque] = {}
+# vm_id -> (monotonic time, pid, cumulative counters) of the previous sample
+last_counters: Dict[str, tuple] = {}
+# vm_id -> rollup window being accumulated
+pending_rollups: Dict[str, dict] = {}
+
+
+def vm_counters(vm: dict, sample: dict) -> dict:
+    """
+    Counters that describe a VM.
+
+    VMs confined to their own cgroup are measured there, which also covers
+    QEMU's helper threads and I/O done on its behalf; otherwise the QEMU
+    process itself is used.
+    """
+    cgroup = sample.get("cgroup")
+    if vm.get("cgroup") and cgroup and cgroup["cpu_seconds"] is not None:
+        return {
+            "cpu_seconds": cgroup["cpu_seconds"],
+            "memory_mb": cgroup["memory_mb"],
+            "read_bytes": cgroup["read_bytes"],
+            "write_bytes": cgroup["write_bytes"]
+        }
+    return {
+        "cpu_seconds": sample["cpu_seconds"],
+        "memory_mb": sample["rss_mb"],
+        "read_bytes": sample["read_bytes"],
+        "write_bytes": sample["write_bytes"]
+    }
+
+
+def record_sample(vm: dict, counters: dict, now: float) -> None:
+    """Turn cumulative counters into a rate point and add it to the VM's buffers."""
+    vm_id = str(vm["_id"])
+    previous = last_counters.get(vm_id)
+    last_counters[vm_id] = (now, vm["pid"], counters)
+    # The first sample of a process only sets the baseline for rates
+    if previous is None or previous[1] != vm["pid"]:
+        return
+    elapsed = now - previous[0]
+    if elapsed <= 0:
+        return
+    before = previous[2]
+    # Counters reset when a cgroup is recreated; clamp instead of going negative
+    cpu_delta = max(counters["cpu_seconds"] - before["cpu_seconds"], 0)
+    read_delta = max(counters["read_bytes"] - before["read_bytes"], 0)
+    write_delta = max(counters["write_bytes"] - before["write_bytes"], 0)
+    # Percent of the VM's own vCPU allocation, so 100 means every vCPU busy
+    cpu_percent = round(cpu_delta / elapsed / max(vm.get("cpu_count", 1), 1) * 100, 1)
+
+    point = (
+        int(time.time()),
+        cpu_percent,
+        counters["memory_mb"],
+        int(read_delta / elapsed),
+        int(write_delta / elapsed)
+    )
+    history.setdefault(vm_id, deque(maxlen=RING_SIZE)).append(point)
+
+    rollup = pending_rollups.get(vm_id)
+    if rollup is None:
+        rollup = pending_rollups[vm_id] = {
+            "vm_id": vm_id,
+            "user_email": vm.get("user_email"),
+            "host_id": vm.get("host_id") or host_pool.LOCAL_HOST_ID,
+            "timestamp": datetime.utcnow(),
+            "samples": 0,
+            "cpu_percent_sum": 0.0,
+            "cpu_percent_max": 0.0,
+            "memory_mb_sum": 0,
+            "memory_mb_max": 0,
+            "cpu_seconds": 0.0,
+            "read_bytes": 0,
+            "write_bytes": 0
+        }
+    rollup["samples"] += 1
+    rollup["cpu_percent_sum"] += cpu_percent
+    rollup["cpu_percent_max"] = max(rollup["cpu_percent_max"], cpu_percent)
+    rollup["memory_mb_sum"] += counters["memory_mb"]
+    rollup["memory_mb_max"] = max(rollup["memory_mb_max"], counters["memory_mb"])
+    rollup["cpu_seconds"] += cpu_delta
+    rollup["read_bytes"] += read_delta
+    rollup["write_bytes"] += write_delta
+
+
+def drop_vm(vm_id: str) -> None:
+    """Forget the in-memory series of a VM that is no longer running."""
+    history.pop(vm_id, None)
+    last_counters.pop(vm_id, None)
+
+
+async def flush_rollups(force: bool = False) -> None:
+    """Persist rollup windows that are due (or all of them) with one write per collection."""
+    now = datetime.utcnow()
+    documents, updates = [], []
+    for vm_id, rollup in list(pending_rollups.items()):
+        if not force and (now - rollup["timestamp"]).total_seconds() < ROLLUP_SECONDS:
+            continue
+        del pending_rollups[vm_id]
+        samples = rollup.pop("samples")
+        documents.append({
+            **{key: value for key, value in rollup.items() if not key.endswith("_sum")},
+            "interval_seconds": round((now - rollup["timestamp"]).total_seconds()),
+            "samples": samples,
+            "cpu_percent_avg": round(rollup["cpu_percent_sum"] / samples, 1),
+            "memory_mb_avg": int(rollup["memory_mb_sum"] / samples)
+        })
+        # Running totals on the VM record, a measured basis next to wall-clock billing
+        updates.append(UpdateOne(
+            {"_id": ObjectId(vm_id)},
+            {"$inc": {
+                "usage.cpu_seconds": round(rollup["cpu_seconds"], 2),
+                "usage.read_bytes": rollup["read_bytes"],
+                "usage.write_bytes": rollup["write_bytes"]
+            }}
+        ))
+    if documents:
+        await db.vm_metrics.insert_many(documents)
+        await db.vms.bulk_write(updates, ordered=False)
+
+
+async def sample_once() -> None:
+    """One batched pass: a single samples call per host covering all its running VMs."""
+    vms_by_host: Dict[str, list] = {}
+    cursor = db.vms.find(
+        {"status": "running", "pid": {"$ne": None}},
+        {"pid": 1, "cpu_count": 1, "host_id": 1, "user_email": 1, "cgroup": 1}
+    )
+    async for vm in cursor:
+        vms_by_host.setdefault(vm.get("host_id") or host_pool.LOCAL_HOST_ID, []).append(vm)
+
+    async def sample_host(host_id, vms):
+        try:
+            host = host_pool.get_host(host_id)
+            return vms, await host.samples([vm["pid"] for vm in vms])
+        except Exception as e:
+            print(f"⚠️ Metrics sampling skipped host {host_id}: {str(e)}")
+            return vms, None
+
+    results = await asyncio.gather(*(sample_host(h, vms) for h, vms in vms_by_host.items()))
+    now = time.monotonic()
+    seen = set()
+    for vms, samples in results:
+        for vm in vms:
+            vm_id = str(vm["_id"])
+            seen.add(vm_id)
+            if samples is None:
+                continue
+            sample = samples.get(str(vm["pid"]))
+            if sample is None:
+                # Process is gone; the next stop/queue pass will tidy the record
+                drop_vm(vm_id)
+                continue
+            record_sample(vm, vm_counters(vm, sample), now)
+
+    for vm_id in set(history) | set(last_counters):
+        if vm_id not in seen:
+            drop_vm(vm_id)
+    await flush_rollups()
+
+
+async def sampler_worker():
+    """Background loop sampling every running VM at SAMPLE_INTERVAL_SECONDS."""
+    while True:
+        started = time.monotonic()
+        try:
+            await sample_once()
+        except Exception as e:
+            print(f"VM metrics sampling failed: {str(e)}")
+        await asyncio.sleep(max(SAMPLE_INTERVAL_SECONDS - (time.monotonic() - started), 0.5))
+
+
+def live_points(vm_id: str, since: float = 0) -> list:
+    """In-memory points of a VM newer than the `since` epoch timestamp."""
+    return [dict(zip(POINT_FIELDS, point)) for point in history.get(vm_id, ()) if point[0] > since]
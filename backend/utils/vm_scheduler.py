@@ -0,0 +1,122 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import Optional
+
+from database import db
+
+# Overcommit ratios applied to the host's physical CPUs and RAM
+CPU_OVERCOMMIT_RATIO = float(os.getenv("VM_CPU_OVERCOMMIT", "4.0"))
+RAM_OVERCOMMIT_RATIO = float(os.getenv("VM_RAM_OVERCOMMIT", "1.0"))
+# Memory kept back for the host OS, the API server and QEMU overhead
+HOST_RESERVED_MEMORY_MB = int(os.getenv("HOST_RESERVED_MEMORY_MB", "1024"))
+# Session length assumed for wait estimates until enough billing history exists
+DEFAULT_SESSION_MINUTES = float(os.getenv("VM_DEFAULT_SESSION_MINUTES", "60"))
+
+# Serialises capacity check + launch so two requests can't claim the same headroom
+admission_lock = asyncio.Lock()
+
+
+def build_usage(stats: dict, running_vms: list) -> dict:
+    """
+    Committed resources of one host from its stats and its running VM records.
+
+    Records whose QEMU process is gone are skipped; a guest's memory counts at
+    the larger of its allocation and live RSS.
+    """
+    usage = {
+        "total_cpus": stats["total_cpus"],
+        "total_memory_mb": stats["total_memory_mb"],
+        "available_memory_mb": stats["available_memory_mb"],
+        "committed_cpus": 0,
+        "committed_memory_mb": 0,
+        "running_vms": 0
+    }
+    processes = stats.get("processes", {})
+    for vm in running_vms:
+        pid = vm.get("pid")
+        if pid and str(pid) not in processes:
+            continue
+        usage["committed_cpus"] += vm.get("cpu_count", 0)
+        usage["committed_memory_mb"] += max(vm.get("memory_mb", 0), processes.get(str(pid), 0) if pid else 0)
+        usage["running_vms"] += 1
+    return usage
+
+
+def cpu_capacity(usage: dict) -> float:
+    return usage["total_cpus"] * CPU_OVERCOMMIT_RATIO
+
+
+def memory_capacity_mb(usage: dict) -> Optional[float]:
+    if usage["total_memory_mb"] is None:
+        return None
+    return usage["total_memory_mb"] * RAM_OVERCOMMIT_RATIO - HOST_RESERVED_MEMORY_MB
+
+
+def admission_check(usage: dict, cpu_count: int, memory_mb: int) -> Optional[str]:
+    """Reason a VM of this size can't start right now, or None if it fits."""
+    if usage["committed_cpus"] + cpu_count > cpu_capacity(usage):
+        return (f"Host vCPU capacity reached ({usage['committed_cpus']} of "
+                f"{cpu_capacity(usage):g} committed)")
+    mem_capacity = memory_capacity_mb(usage)
+    if mem_capacity is not None and usage["committed_memory_mb"] + memory_mb > mem_capacity:
+        return (f"Host memory capacity reached ({usage['committed_memory_mb']} MB of "
+                f"{mem_capacity:g} MB committed)")
+    available = usage["available_memory_mb"]
+    if available is not None and memory_mb > available - HOST_RESERVED_MEMORY_MB:
+        return f"Not enough free host memory ({available} MB available)"
+    return None
+
+
+def commit(usage: dict, cpu_count: int, memory_mb: int) -> None:
+    """Account for a VM launched from this usage snapshot."""
+    usage["committed_cpus"] += cpu_count
+    usage["committed_memory_mb"] += memory_mb
+    if usage["available_memory_mb"] is not None:
+        usage["available_memory_mb"] -= memory_mb
+    usage["running_vms"] += 1
+
+
+def fits_host(usage: dict, cpu_count: int, memory_mb: int) -> bool:
+    """Whether a VM could ever fit on this host, even with nothing else running."""
+    if cpu_count > cpu_capacity(usage):
+        return False
+    mem_capacity = memory_capacity_mb(usage)
+    return mem_capacity is None or memory_mb <= mem_capacity
+
+
+async def average_session_minutes() -> float:
+    """Mean length of recent billed VM sessions."""
+    pipeline = [
+        {"$match": {"action": "vm_usage"}},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 200},
+        {"$group": {"_id": None, "avg": {"$avg": "$runtime_minutes"}}}
+    ]
+    result = await db.billing.aggregate(pipeline).to_list(1)
+    if result and result[0].get("avg"):
+        return result[0]["avg"]
+    return DEFAULT_SESSION_MINUTES
+
+
+async def estimate_wait_minutes(position: int) -> float:
+    """
+    Rough wait for the queued launch at 1-based `position`.
+
+    Each running VM is assumed to last an average session; the launch waits
+    until `position` of them have finished.
+    """
+    avg_session = await average_session_minutes()
+    now = datetime.utcnow()
+    remaining = []
+    async for vm in db.vms.find({"status": "running"}, {"started_at": 1}):
+        started_at = vm.get("started_at") or now
+        elapsed = (now - started_at).total_seconds() / 60
+        remaining.append(max(avg_session - elapsed, 1.0))
+    if not remaining:
+        return 0.0
+    remaining.sort()
+    index = min(position, len(remaining)) - 1
+    # Past the number of running VMs, each extra position waits another round
+    rounds = (position - 1) // len(remaining)
+    return round(remaining[index] + rounds * avg_session, 1)
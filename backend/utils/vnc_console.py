@@ -0,0 +1,171 @@
+import asyncio
+import os
+import tempfile
+from typing import Dict, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# QEMU listens for VNC on a unix socket per VM in this directory
+CONSOLE_DIR = os.getenv("VM_CONSOLE_DIR", os.path.join(tempfile.gettempdir(), "virtcloud-consoles"))
+# Drop a console after this long without keyboard/mouse/update-request traffic from the browser
+CONSOLE_IDLE_SECONDS = int(os.getenv("VM_CONSOLE_IDLE_SECONDS", "900"))
+# Drop a browser that can't take a frame chunk within this long
+CONSOLE_SEND_TIMEOUT_SECONDS = float(os.getenv("VM_CONSOLE_SEND_TIMEOUT_SECONDS", "15"))
+CONSOLE_MAX_CONNECTIONS = int(os.getenv("VM_CONSOLE_MAX_CONNECTIONS", "500"))
+CONSOLE_MAX_PER_VM = int(os.getenv("VM_CONSOLE_MAX_PER_VM", "8"))
+# At most one chunk per direction is buffered per console, which bounds memory per viewer
+CONSOLE_CHUNK_BYTES = int(os.getenv("VM_CONSOLE_CHUNK_BYTES", str(64 * 1024)))
+
+# Close codes sent to the browser (4000-4999 are free for applications)
+CLOSE_IDLE = 4000
+CLOSE_UNAVAILABLE = 4004
+CLOSE_TRY_AGAIN = 1013
+
+
+def console_socket_path(vm_id: str) -> str:
+    """Unix socket QEMU's VNC server listens on for a VM."""
+    return os.path.join(CONSOLE_DIR, f"vm-{vm_id}.vnc")
+
+
+class UnixConsole:
+    """VNC stream straight from a QEMU socket on this host."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, vm_id: str) -> "UnixConsole":
+        reader, writer = await asyncio.open_unix_connection(console_socket_path(vm_id), limit=CONSOLE_CHUNK_BYTES)
+        return cls(reader, writer)
+
+    async def read(self) -> bytes:
+        return await self.reader.read(CONSOLE_CHUNK_BYTES)
+
+    async def write(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AgentConsole:
+    """VNC stream relayed by the host agent of a remote node."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    async def connect(cls, url: str) -> "AgentConsole":
+        from websockets.asyncio.client import connect
+        # Small frame queue so a slow browser pushes back on the agent instead of buffering
+        connection = await connect(url, max_size=CONSOLE_CHUNK_BYTES * 2, max_queue=4, compression=None)
+        return cls(connection)
+
+    async def read(self) -> bytes:
+        from websockets.exceptions import ConnectionClosed
+        try:
+            data = await self.connection.recv()
+        except ConnectionClosed:
+            return b""
+        return data if isinstance(data, bytes) else data.encode()
+
+    async def write(self, data: bytes) -> None:
+        await self.connection.send(data)
+
+    async def close(self) -> None:
+        await self.connection.close()
+
+
+class ConsoleLimiter:
+    """Caps open consoles per process and per VM."""
+
+    def __init__(self):
+        self.total = 0
+        self.per_vm: Dict[str, int] = {}
+
+    def acquire(self, vm_id: str) -> Optional[str]:
+        """Reserve a slot, or return why there is none."""
+        if self.total >= CONSOLE_MAX_CONNECTIONS:
+            return "Console server is at capacity"
+        if self.per_vm.get(vm_id, 0) >= CONSOLE_MAX_PER_VM:
+            return f"Too many open consoles for this VM (max {CONSOLE_MAX_PER_VM})"
+        self.total += 1
+        self.per_vm[vm_id] = self.per_vm.get(vm_id, 0) + 1
+        return None
+
+    def release(self, vm_id: str) -> None:
+        self.total -= 1
+        self.per_vm[vm_id] -= 1
+        if not self.per_vm[vm_id]:
+            del self.per_vm[vm_id]
+
+
+limiter = ConsoleLimiter()
+
+
+async def accept(websocket: WebSocket) -> None:
+    """Accept a browser websocket, echoing noVNC's "binary" subprotocol when offered."""
+    offered = websocket.scope.get("subprotocols") or []
+    await websocket.accept(subprotocol="binary" if "binary" in offered else None)
+
+
+async def relay(websocket: WebSocket, upstream) -> None:
+    """
+    Pump VNC bytes between an accepted websocket and an upstream console.
+
+    QEMU runs its VNC server with share=force-shared, so each viewer gets its
+    own encoder and update rate; a slow viewer only slows itself down. The
+    console closes when either side hangs up, the browser stops sending for
+    CONSOLE_IDLE_SECONDS, or a chunk can't be delivered in time.
+    """
+    loop = asyncio.get_event_loop()
+    last_input = loop.time()
+
+    async def browser_to_vm():
+        nonlocal last_input
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return None
+            data = message.get("bytes") or (message.get("text") or "").encode()
+            last_input = loop.time()
+            if data:
+                await upstream.write(data)
+
+    async def vm_to_browser():
+        while True:
+            data = await upstream.read()
+            if not data:
+                return CLOSE_UNAVAILABLE
+            await asyncio.wait_for(websocket.send_bytes(data), CONSOLE_SEND_TIMEOUT_SECONDS)
+
+    async def idle_watch():
+        while True:
+            remaining = CONSOLE_IDLE_SECONDS - (loop.time() - last_input)
+            if remaining <= 0:
+                return CLOSE_IDLE
+            await asyncio.sleep(remaining)
+
+    tasks = [asyncio.create_task(coro()) for coro in (browser_to_vm, vm_to_browser, idle_watch)]
+    close_code = 1000
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                close_code = task.result() or close_code
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await upstream.close()
+        try:
+            await websocket.close(code=close_code)
+        except (RuntimeError, WebSocketDisconnect):
+            # The browser is already gone
+            pass